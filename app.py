@@ -1,45 +1,47 @@
-from flask import Flask, render_template, request, jsonify
-import faiss
+from flask import Flask, Response, g, has_request_context, make_response, redirect, render_template, request, jsonify, stream_with_context, url_for
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import hashlib
 import json
-import pickle
+import numpy as np
+import os
+import time
 # Import spatial
 from scipy import spatial
-from datetime import datetime
+
+from card_text import make_theoretical_card, render_card_text, get_query_instruction, theoretical_card_fields
+from embedding_service import EmbeddingService
+from deck_recommender import parse_decklist, recommend, resolve_deck
+from facets import parse_facet_filters
+import metrics
+from ranking_cache import RelatedCard, get_page
+from search_context import ActiveContext, SearchContext, SnapshotReloader
+from search_service import RemoteSearch
+from snapshot import get_default_snapshot, read_manifest
+from symbols import load_symbol_html
 
 app = Flask(__name__)
 
 # Load FAISS indices
-data_file = 'oracle-cards-20231113220154'
-
-db_dir = './data'
-
-# Load card data
-with open(f'./data/{data_file}.json') as f:
-    card_data = json.load(f)
-    print(f'Loaded {len(card_data)} cards')
-    # Remove every card that has layout 'art_series' or 'token' or 'double_faced_token'
-    # Remove every card that has a set_type of 'memorabilia' or 'token' or 'minigame'
-    for card in card_data[::-1]:
-        if card['layout'] in ['art_series', 'token', 'double_faced_token']:
-            card_data.remove(card)
-        elif card['set_type'] in ['memorabilia', 'token', 'minigame']:
-            card_data.remove(card)
-
-        # For every card, if it doesn't have an image, check to see if a card_face has it. If so, move that up to the parent. Otherwise, remove the card entirely.
-        if not 'image_uris' in card:
-            if 'card_faces' in card:
-                for card_face in card['card_faces']:
-                    if 'image_uris' in card_face:
-                        card['image_uris'] = card_face['image_uris']
-                        break
-            if not 'image_uris' in card:
-                print(f'  {card["name"]} ({card["id"]}) has no image_uris')
-                card_data.remove(card)
-
-    print(f' Culled to {len(card_data)} cards')
-
-    # Create a dictionary of card data by SFID
-    cards_by_sfid = {card['id']: card for card in card_data}
+# Both can be overridden from the environment, ex: to serve the synthetic corpus of benchmarks/bench_app.py
+data_file = os.environ.get('MTGMATRIX_DATA_FILE', 'oracle-cards-20231113220154')
+
+db_dir = os.environ.get('MTGMATRIX_DB_DIR', './data')
+
+# Snapshot manifest naming the card file and the files of every axis (see snapshot.py), ex: ./data/current.json
+# When it is set, the server watches it and hot swaps to a new snapshot when it changes (see search_context.py).
+# Every worker then loads its own copy of the new snapshot, see search_context.py for the memory cost.
+# Without it, the snapshot is data_file in db_dir.
+snapshot_file = os.environ.get('MTGMATRIX_SNAPSHOT')
+snapshot_poll_interval = float(os.environ.get('MTGMATRIX_SNAPSHOT_POLL', '10'))
+
+# Number of most popular cards shown on the home page
+num_popular_cards = 100
+
+# Cards per page on the home page and the related cards of a card page
+cards_per_page = 20
+
+# Mana symbol <img> tags by symbol, from static/symbols.json (see download_static_resources.py)
+symbol_html = load_symbol_html(os.path.join(app.static_folder, 'symbols.json'), f'{app.static_url_path}/symbols')
 
 # Load FAISS indices
 tags = ['similar',
@@ -53,138 +55,441 @@ tags = ['similar',
         #'flavor'
         ]
 
-faiss_indices = {}
-faiss_keys_by_index = {}
-faiss_indices_by_key = {}
-embeddings_by_sfid = {}
-
-for tag in tags:
-    filename = f'{db_dir}/faiss_{data_file}_db_{tag}.index'
-    faiss_indices[tag] = faiss.read_index(filename)
-    print(f'Loaded FAISS index for {tag}')
-    with open(f'{db_dir}/faiss_{data_file}_db_{tag}.keys', 'rb') as f:
-        faiss_indices_by_key[tag] = json.load(f)
-        faiss_keys_by_index[tag] = {v: k for k, v in faiss_indices_by_key[tag].items()}
-        print(f'Loaded FAISS keys for {tag}')
-    # ex: embeddings_oracle-cards-20231113220154_db_dupe2.pickle
-    with open(f'{db_dir}/embeddings_{data_file}_db_{tag}.pickle', 'rb') as f:
-        embeddings_by_sfid[tag] = pickle.load(f)
-        print(f'Loaded embeddings for {tag}')
+# Optional reduced-precision copy of every index, built in memory at load time from the embedding stores.
+# One of index_builder.compression_modes, ex: 'sq8', 'fp16' or 'pca256'. Indices built with
+# create_db.py --compression are already compressed on disk and don't need this.
+index_compression = None
+
+# Axes are loaded concurrently in the background (see index_loader.py). The app is ready (/readyz) as soon as
+# the primary axis is loaded. Lazy axes are only loaded by the first search that needs them, and
+# MTGMATRIX_INDEX_MMAP=1 memory-maps the FAISS indices instead of reading them into memory.
+primary_axis = 'similar'
+lazy_tags = [tag for tag in os.environ.get('MTGMATRIX_LAZY_AXES', '').split(',') if tag]
+index_mmap = os.environ.get('MTGMATRIX_INDEX_MMAP', '0') == '1'
+
+# Full related-card rankings per card
+max_related_results = 100
+
+# Related-card searches can go to search service shards instead of indices in every worker (see search_service.py),
+# ex: MTGMATRIX_SEARCH_SHARDS=http://127.0.0.1:8101,unix:/tmp/mtgmatrix-search-1.sock
+# Every axis is then lazy here, only loaded if another feature (decks, theoretical cards) searches it.
+# The shards have to serve the same snapshot as this server.
+search_shards = [shard for shard in os.environ.get('MTGMATRIX_SEARCH_SHARDS', '').split(',') if shard]
+search_timeout = float(os.environ.get('MTGMATRIX_SEARCH_TIMEOUT', '2'))
+remote_search = RemoteSearch(search_shards, timeout=search_timeout) if search_shards else None
+if remote_search is not None:
+    lazy_tags = list(tags)
+
+def make_context(snapshot, loader_workers=None):
+    # Cards, search engine, facets and caches of one snapshot
+    return SearchContext(snapshot, tags, primary_axis, lazy_axes=lazy_tags, mmap=index_mmap, index_compression=index_compression,
+                         symbol_html=symbol_html, num_popular_cards=num_popular_cards, max_related_results=max_related_results,
+                         loader_workers=loader_workers, remote_search=remote_search)
+
+# Every request uses the context that was active when it started, see get_context()
+initial_snapshot = read_manifest(snapshot_file) if snapshot_file else get_default_snapshot(db_dir, data_file, tags)
+contexts = ActiveContext(make_context(initial_snapshot))
+
+def get_context():
+    # The context of the current request, or the active one outside of requests
+    if has_request_context() and 'context' in g:
+        return g.context
+    return contexts.current
+
+# Embeds theoretical cards at request time, with the same instructions the indices were built with.
+# The model is loaded and warmed up in the background when the server starts (in every gunicorn worker, see post_fork
+# in gunicorn.conf.py), or on first use otherwise. Set MTGMATRIX_QUERY_EMBEDDER=stub to run without it.
+query_embedder_type = os.environ.get('MTGMATRIX_QUERY_EMBEDDER', 'instructor')
+def get_query_dimension():
+    # Dimension of the primary index of the active snapshot
+    context = contexts.current
+    context.index_loader.wait([primary_axis])
+    return context.search_engine.faiss_indices[primary_axis].d
+
+def get_query_embedder_kwargs():
+    # The stub embedder has to match the dimension of the indices
+    if query_embedder_type != 'stub':
+        return {}
+    return {'dimension': get_query_dimension()}
+
+query_embedder_kwargs = get_query_embedder_kwargs
+embedding_service = EmbeddingService(tags, query_embedder_type, query_embedder_kwargs)
+
+# New snapshots are loaded with one loader thread, so the searches of the active snapshot keep the other cores
+snapshot_reloader = None
+if snapshot_file:
+    snapshot_reloader = SnapshotReloader(contexts, snapshot_file, lambda snapshot: make_context(snapshot, loader_workers=1),
+                                         poll_interval=snapshot_poll_interval, dimension=get_query_dimension)
+
+# Cache statistics are read when /metrics is scraped
+metrics.cache_hit_rate.set_function(lambda: contexts.current.ranking_cache.stats()['hit_rate'], cache='ranking')
+metrics.cache_entries.set_function(lambda: len(contexts.current.ranking_cache), cache='ranking')
+metrics.cache_hit_rate.set_function(lambda: embedding_service.stats()['hit_rate'], cache='query_embedding')
+metrics.cache_entries.set_function(lambda: embedding_service.stats()['cache_size'], cache='query_embedding')
+metrics.cache_entries.set_function(lambda: len(contexts.current.home_page_cache), cache='home_page')
+metrics.active_requests.set_function(lambda: contexts.active_requests()[0], state='active')
+metrics.active_requests.set_function(lambda: contexts.active_requests()[1], state='draining')
+
+# Start reading the indices
+contexts.current.start()
+
+@app.before_request
+def start_request_timer():
+    request.started_at = time.perf_counter()
+    metrics.start_request_timings()
+
+    # The request runs on this snapshot to the end, even if another one is swapped in meanwhile
+    g.context = contexts.acquire()
+    if snapshot_reloader is not None:
+        snapshot_reloader.start()
+
+@app.teardown_request
+def release_context(exception=None):
+    # Streamed responses are torn down once the stream ends, so they hold their snapshot until then
+    context = g.pop('context', None)
+    if context is not None:
+        contexts.release(context)
+
+@app.after_request
+def record_request_metrics(response):
+    # Endpoints rather than paths as labels, so every card doesn't get its own time series
+    endpoint = request.endpoint or 'unknown'
+    seconds = time.perf_counter() - getattr(request, 'started_at', time.perf_counter())
+    metrics.request_seconds.observe(seconds, endpoint=endpoint)
+    metrics.requests_total.inc(endpoint=endpoint, status=response.status_code)
+
+    if metrics.server_timing:
+        metrics.add_timing('total', seconds)
+        header = metrics.pop_server_timing_header()
+        if header:
+            response.headers['Server-Timing'] = header
+    return response
+
+@app.route('/healthz')
+def healthz():
+    # The process is up, which snapshot it serves and which axes are loaded
+    status = dict(get_context().status(), status='ok')
+    if snapshot_reloader is not None:
+        status['reloader'] = snapshot_reloader.status()
+    return jsonify(status)
+
+@app.route('/readyz')
+def readyz():
+    # 200 once the primary axis can be searched, so load balancers can send traffic before every axis is loaded
+    status = get_context().status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text exposition format
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def render_timed(template, **context):
+    with metrics.render_seconds.time('render', template=template):
+        return render_template(template, **context)
 
 @app.route('/')
 @app.route('/page/<int:page>')
 def index(page=1):
-    print(f'Fetching home page of most popular cards in Magic, page #{page}...')
-    per_page = 20
-    num_results = 100
-    start = (page - 1) * per_page
-    end = start + per_page
-
-    popular_cards = sorted(card_data, key=lambda x: x.get('edhrec_rank', float('inf')))
-
+    per_page = cards_per_page
+    num_results = num_popular_cards
     total_pages = num_results // per_page + (1 if num_results % per_page else 0)
 
-    return render_template('index.html', cards=popular_cards[start:end], page=page, total_pages=total_pages)
+    # Only valid for the card data of this context
+    context = get_context()
+    home_page_cache = context.home_page_cache
+    cached_page = home_page_cache.get(page)
+    if cached_page is None:
+        start = (page - 1) * per_page
+        end = start + per_page
+
+        html = render_timed('index.html', cards=context.popular_cards[start:end], page=page, total_pages=total_pages)
+        cached_page = (html, hashlib.sha1(html.encode('utf-8')).hexdigest())
+
+        # Only cache real pages, so random page numbers can't grow the cache
+        if 1 <= page <= total_pages:
+            home_page_cache[page] = cached_page
+
+    html, etag = cached_page
+    response = make_response(html)
+    response.set_etag(etag)
+    response.last_modified = context.loaded_at
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+
+    # Answers with a 304 if the client already has this version of the page
+    return response.make_conditional(request)
+
+@app.route('/search')
+def search():
+    # Full results page for the sidebar search form
+    name = request.args.get('name', '')
+    context = get_context()
+    results = context.name_index.search(name, limit=60)
+    cards = [context.cards_by_sfid[result['id']] for result in results]
+
+    # A single hit goes straight to the card
+    if len(cards) == 1:
+        return redirect(url_for('card', sfid=cards[0]['id']))
+
+    return render_template('search.html', cards=cards, name=name)
+
+@app.route('/api/typeahead')
+def typeahead():
+    # Name completions for the search box, called on every keystroke
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+
+    context = get_context()
+    results = context.name_index.search(query, limit=limit)
+    for result in results:
+        result['image'] = context.cards_by_sfid[result['id']]['image_uris'].get('small')
+
+    return jsonify({'query': query, 'results': results})
 
 @app.route('/card/<sfid>')
 @app.route('/card/<sfid>/page/<int:page>')
 def card(sfid, page=1):
-    per_page = 20
-    num_results = 100
+    per_page = cards_per_page
+    num_results = max_related_results
+    cards_by_sfid = get_context().cards_by_sfid
     if not sfid in cards_by_sfid:
         return 'Card not found', 404
     card = cards_by_sfid[sfid]
 
     start = (page - 1) * per_page
-    end = start + per_page
-
-
-    related_cards = fetch_related_cards(sfid, start_index = start, end_index=end)  # Adjust this function to return paginated results
-
-    total_pages = num_results // per_page + (1 if num_results % per_page else 0)
-
-    #print(f'Related cards: {related_cards[start:end]}')
-    for related_card in related_cards:
-        if not 'image_uris' in related_card:
-            print(f'  {related_card["name"]} ({related_card["id"]}) has no image_uris')
 
-
-    return render_template('card.html', card=card, related_cards=related_cards, page=page, total_pages=total_pages)
+    # Optional facet filters, ex: ?identity=R&identity_mode=exact&type=creature&format=commander
+    try:
+        filters = parse_facet_filters(request.args)
+        ranking = fetch_related_ranking(sfid, filters)
+    except ValueError as e:
+        return f'Invalid filter: {e}', 400
+
+    # The Next link follows the cursor, so it disappears on the last page of a ranking shorter than num_results
+    related_cards, next_cursor = get_page(ranking, cursor=start, limit=per_page)
+    num_results = min(num_results, len(ranking))
+    if next_cursor is not None and next_cursor >= num_results:
+        next_cursor = None
+    total_pages = max(1, num_results // per_page + (1 if num_results % per_page else 0))
+
+    return render_timed('card.html', card=card, related_cards=related_cards, page=page, total_pages=total_pages,
+                        next_cursor=next_cursor, filters=filters)
+
+@app.route('/query')
+def query():
+    # Theoretical card search: related cards for a card typed in by the user
+    fields = {field: request.args.get(field, '') for field in theoretical_card_fields}
+    related_cards = []
+    error = None
+    if any(fields[field].strip() for field in theoretical_card_fields if field != 'name'):
+        try:
+            related_cards = fetch_theoretical_related_cards(fields, parse_facet_filters(request.args))[:60]
+        except ValueError as e:
+            return f'Invalid query: {e}', 400
+        except RuntimeError as e:
+            error = str(e)
+
+    return render_template('query.html', fields=fields, related_cards=related_cards, error=error)
+
+def parse_limit(args, default=20):
+    # Number of results asked for, clamped to 1..max_related_results. Raises ValueError if it isn't an integer.
+    try:
+        limit = int(args.get('limit', default))
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid limit: {args.get("limit")!r} (expected an integer)')
+    return max(1, min(limit, max_related_results))
+
+@app.route('/api/query', methods=['GET', 'POST'])
+def api_query():
+    # JSON version of /query. Takes the card fields (and facet filters) as query arguments or a JSON body.
+    args = request.get_json(silent=True) or request.args
+    if not isinstance(args, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    fields = {field: str(args.get(field, '')) for field in theoretical_card_fields}
+    if not any(fields[field].strip() for field in theoretical_card_fields if field != 'name'):
+        return jsonify({'error': f'Expected at least one of {theoretical_card_fields[1:]}'}), 400
+
+    try:
+        limit = parse_limit(args)
+        related_cards = fetch_theoretical_related_cards(fields, parse_facet_filters(args))[:limit]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 503
+
+    return jsonify({'card': make_theoretical_card(fields), 'results': [
+        {'id': related_card.id, 'name': related_card.name, 'distance': related_card.distance, 'axis': related_card.axis}
+        for related_card in related_cards]})
+
+# Versioned JSON API. Results are compact: sfid, axis and score, plus only the card fields the caller asks for.
+api_version = 'v1'
+
+# Cards searched together in one batched query per axis by the bulk endpoint
+api_batch_size = 256
+
+def get_api_args():
+    # Arguments from a JSON body, or from the query string (where lists are repeated or comma-separated).
+    # Raises ValueError if the body isn't a JSON object, or sfids or fields aren't lists of strings.
+    body = request.get_json(silent=True)
+    if body is not None:
+        if not isinstance(body, dict):
+            raise ValueError('Expected a JSON object')
+        for key in ['sfids', 'fields']:
+            if not isinstance(body.get(key, []), list) or not all(isinstance(value, str) for value in body.get(key, [])):
+                raise ValueError(f'Expected {key} to be a list of strings')
+        return body, body.get('sfids', []), body.get('fields', [])
+    sfids = [sfid for value in request.args.getlist('sfid') for sfid in value.split(',') if sfid]
+    fields = [field for value in request.args.getlist('fields') for field in value.split(',') if field]
+    return request.args, sfids, fields
+
+def get_api_result(related_sfid, score, axis, fields):
+    result = {'sfid': related_sfid, 'axis': axis, 'score': round(score, 6)}
+    card = get_context().cards_by_sfid.get(related_sfid, {})
+    for field in fields:
+        if field in card:
+            result[field] = card[field]
+    return result
+
+@app.route(f'/api/{api_version}/related/<sfid>')
+def api_related(sfid):
+    # Related cards for one card (the same ranking as the card page)
+    try:
+        args, _, fields = get_api_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not sfid in get_context().cards_by_sfid:
+        return jsonify({'sfid': sfid, 'error': 'Card not found'}), 404
+    try:
+        limit = parse_limit(args)
+        related_cards = fetch_related_ranking(sfid, parse_facet_filters(args))[:limit]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'sfid': sfid, 'results': [get_api_result(related_card.id, related_card.distance, related_card.axis, fields)
+                                              for related_card in related_cards]})
+
+@app.route(f'/api/{api_version}/related', methods=['GET', 'POST'])
+def api_related_bulk():
+    # Related cards for many cards at once, ex: POST {"sfids": [...], "fields": ["name", "mana_cost"], "limit": 20}
+    # Streamed as NDJSON, one line per requested sfid, in batches that each run one FAISS search per axis
+    context = get_context()
+    try:
+        args, sfids, fields = get_api_args()
+        limit = parse_limit(args)
+        filters = parse_facet_filters(args)
+        # Invalid filters (ex: unknown colors) are rejected here, before the stream starts
+        context.facet_index.select(filters)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def generate():
+        for start in range(0, len(sfids), api_batch_size):
+            batch = sfids[start:start + api_batch_size]
+            rankings = context.search_many(batch, num_results=limit, filters=filters)
+            for sfid, ranking in zip(batch, rankings):
+                if sfid in context.cards_by_sfid:
+                    line = {'sfid': sfid, 'results': [get_api_result(related_card.id, related_card.distance, related_card.axis, fields)
+                                                      for related_card in ranking]}
+                else:
+                    line = {'sfid': sfid, 'error': 'Card not found'}
+                yield json.dumps(line) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def fetch_deck_recommendations(args):
+    # Returns (recommendations as (sfid, score, axis) tuples, {sfid: count} of the deck, unresolved names)
+    # from a decklist in any common export format, and/or a list of sfids or card names
+    # Raises ValueError if the decklist isn't a string, or the cards aren't a string or a list of strings
+    decklist = args.get('decklist') or ''
+    if not isinstance(decklist, str):
+        raise ValueError('Expected decklist to be a string')
+    cards = args.get('cards') or []
+    if isinstance(cards, str):
+        cards = [cards]
+    if not isinstance(cards, list) or not all(isinstance(card, str) for card in cards):
+        raise ValueError('Expected cards to be a list of strings')
+    entries = parse_decklist(decklist) + [(1, card) for card in cards]
+    context = get_context()
+    counts_by_sfid, unresolved = resolve_deck(entries, context.cards_by_sfid, context.name_index)
+
+    limit = parse_limit(args, 50)
+    method = args.get('method') or 'matrix'
+    recommendations = recommend(context.search_engine, counts_by_sfid, num_results=limit, method=method,
+                                card_mask=context.facet_index.select(parse_facet_filters(args)))
+    return recommendations, counts_by_sfid, unresolved
+
+@app.route(f'/api/{api_version}/deck', methods=['POST'])
+def api_deck():
+    # Cards that belong with a whole deck, ex: POST {"decklist": "1 Sol Ring\n1 Arcane Signet\n...", "limit": 50}
+    try:
+        args, _, fields = get_api_args()
+        recommendations, counts_by_sfid, unresolved = fetch_deck_recommendations(args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'deck_size': sum(counts_by_sfid.values()), 'unresolved': unresolved,
+                    'results': [get_api_result(sfid, score, axis, fields) for sfid, score, axis in recommendations]})
+
+@app.route('/deck', methods=['GET', 'POST'])
+def deck():
+    # Form for pasting a decklist, and the recommendations for it
+    decklist = request.form.get('decklist', '')
+    recommended_cards = []
+    unresolved = []
+    if decklist.strip():
+        try:
+            recommendations, _, unresolved = fetch_deck_recommendations(request.form)
+        except ValueError as e:
+            return f'Invalid request: {e}', 400
+        recommended_cards = [RelatedCard(get_context().cards_by_sfid[sfid], score, axis) for sfid, score, axis in recommendations]
+
+    return render_template('deck.html', decklist=decklist, recommended_cards=recommended_cards, unresolved=unresolved)
+
+def fetch_theoretical_related_cards(fields, filters=None, timeout=30):
+    # Renders the theoretical card like the indexed cards on every axis, embeds all axes at once
+    # (the embedding service batches them together with concurrent requests), and searches with the vectors
+    theoretical_card = make_theoretical_card(fields)
+    futures = {}
+    for tag in tags:
+        content, num_valid_fields = render_card_text(theoretical_card, get_query_instruction(tag)[1])
+        if num_valid_fields > 0:
+            futures[tag] = embedding_service.submit(tag, content)
+
+    try:
+        queries_by_axis = {tag: np.asarray(future.result(timeout), dtype=np.float32).reshape(1, -1) for tag, future in futures.items()}
+    except FutureTimeoutError:
+        raise RuntimeError(f'Timed out after {timeout}s waiting for the query embeddings')
+    context = get_context()
+    results = context.search_engine.search_vectors(queries_by_axis, num_results=max_related_results, card_mask=context.facet_index.select(filters))
+    return [RelatedCard(context.cards_by_sfid[related_sfid], dist, axis)
+            for related_sfid, dist, axis in results[:max_related_results] if related_sfid in context.cards_by_sfid]
 
 def cosine_similarity(embedding1, embedding2):
     return spatial.distance.cosine(embedding1, embedding2)
 
-def fetch_related_cards(sfid, start_index = 0, end_index = 100):
-    print(f' Fetching related cards for {sfid} [{start_index}:{end_index}]...')
-
-    then = datetime.now()
-
-    result_sfids = {}
-
-    for collection_name in faiss_indices.keys():
-        sfids, dists = fetch_related_sfids(sfid, index_key=collection_name, num_results=end_index)
-        results = zip(sfids, dists, [collection_name] * len(sfids))
-        for sfid, dist, axis in results:
-            if sfid in result_sfids:
-                if dist > result_sfids[sfid][1]:
-                    result_sfids[sfid] = [sfid, dist, axis]
-            else:
-                result_sfids[sfid] = [sfid, dist, axis]
-
-    # Get a sorted list of results, ordered by distance
-    results = sorted(result_sfids.values(), key=lambda x: x[1], reverse=True)
+def fetch_related_ranking(sfid, filters=None):
+    # Full merged ranking for a card, cached so that every page is a slice of the same search
+    return get_context().get_related_ranking(sfid, filters)
 
+def fetch_related_cards(sfid, start_index = 0, end_index = 100, filters=None):
     # Trim the results to the start and end indices
-    results = results[start_index:end_index]
-
-    related_cards = []
-
-    for sfid, dist, axis in results:
-        if sfid in cards_by_sfid:
-            card_copy = json.loads(json.dumps(cards_by_sfid[sfid]))
-            card_copy['distance'] = dist
-            card_copy['axis'] = axis
-            
-            related_cards.append(card_copy)
-        else:
-            print(f'  {sfid} not found in cards_by_sfid')
-
-    print(f'  Populated {len(related_cards)} related cards in {datetime.now() - then}')
-
+    related_cards, _ = get_page(fetch_related_ranking(sfid, filters), cursor=start_index, limit=end_index - start_index)
     return related_cards
 
 
-def fetch_related_sfids(sfid, index_key='similar', num_results=100):
-    print(f' Fetching related sfids for {sfid} in index "{index_key}"...')
-
-    then = datetime.now()
-
-    # Find the index from the SFID
-    if not sfid in faiss_indices_by_key[index_key]:
-        print(f'  {sfid} not found in faiss_keys[{index_key}]')
+def fetch_related_sfids(sfid, index_key='similar', num_results=100, filters=None):
+    # Related sfids and their scores on a single axis
+    context = get_context()
+    search_engine = context.search_engine
+    if len(search_engine.get_axes([index_key])) == 0 or not sfid in search_engine.faiss_indices_by_key[index_key]:
         return [], []
-    
-    #sfid_embeddings = embeddings_by_sfid[index_key][sfid]
-
-    sfid_index = faiss_indices_by_key[index_key][sfid]
-    # Retrieve the embeddings for the SFID
-    sfid_embeddings = faiss_indices[index_key].reconstruct(sfid_index)
-
-    # Reshape the embeddings to be a 1xN array
-    sfid_embeddings = sfid_embeddings.reshape(1, -1)
-
-    # Find the card with the highest cosine similarity to the embedding_ref
-    dists, sfid_indices = faiss_indices[index_key].search(sfid_embeddings, num_results)
-
-    related_dists = dists[0]
-    related_sfids = [faiss_keys_by_index[index_key][index] for index in sfid_indices[0]]
-
-    now = datetime.now()
-    print(f'  Found {len(related_sfids)} related sfids in {now - then}')
 
-    # Find the card with the highest cosine similarity to the embedding_ref
+    card_mask = context.facet_index.select(filters)
+    positions, related_dists = search_engine.search_axis(index_key, sfid, num_results, card_mask)
+    related_sfids = [search_engine.sfids[position] for position in positions if position >= 0]
+    related_dists = related_dists[positions >= 0]
     return related_sfids, related_dists
 
 
 if __name__ == '__main__':
+    embedding_service.start()
     app.run(debug=True)
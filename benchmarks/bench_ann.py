@@ -0,0 +1,112 @@
+# Recall/latency benchmark of FAISS index types against the exact flat inner-product baseline.
+# For every configuration it reports build time, index size, recall@k against IndexFlatIP, and queries/sec
+# for single-card lookups (what /card/<sfid> does) and for batched searches.
+#
+# ex: python benchmarks/bench_ann.py --embeddings ./data/embeddings_oracle-cards-20231113220154_db_similar
+#     python benchmarks/bench_ann.py --synthetic 100000 --configs "Flat;HNSW32,Flat|efSearch=128;IVF1024,Flat|nprobe=32"
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from embedding_store import EmbeddingStore
+from index_builder import build_index
+
+# FACTORY|SEARCH_PARAMS, separated by semicolons
+default_configs = 'Flat;HNSW32,Flat|efSearch=64;HNSW32,Flat|efSearch=256;IVF256,Flat|nprobe=16;IVF256,PQ64|nprobe=16;SQ8'
+
+
+def make_clustered_embeddings(num_cards, dimension, num_clusters=500, noise=0.5, seed=0):
+    # Unit vectors scattered around random cluster centers, closer to real embeddings than pure noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dimension)).astype(np.float32)
+    embeddings = centers[rng.integers(0, num_clusters, num_cards)] + noise * rng.standard_normal((num_cards, dimension)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings
+
+
+def recall_at_k(result_ids, truth_ids):
+    k = truth_ids.shape[1]
+    hits = [len(np.intersect1d(result, truth)) for result, truth in zip(result_ids, truth_ids)]
+    return float(np.mean(hits)) / k
+
+
+def benchmark_config(embeddings, queries, truth_ids, index_factory, search_params, k, single_queries):
+    embeddings_by_key = dict(enumerate(embeddings))
+
+    then = time.perf_counter()
+    index, _ = build_index(embeddings_by_key, embeddings.shape[1], index_factory, search_params)
+    build_seconds = time.perf_counter() - then
+
+    # Batched search over every query
+    then = time.perf_counter()
+    _, result_ids = index.search(queries, k)
+    batch_seconds = time.perf_counter() - then
+
+    # One query at a time, like the card page
+    then = time.perf_counter()
+    for query in queries[:single_queries]:
+        index.search(query.reshape(1, -1), k)
+    single_seconds = time.perf_counter() - then
+
+    return {
+        'index_factory': index_factory,
+        'search_params': search_params,
+        'build_seconds': build_seconds,
+        'index_bytes': len(faiss.serialize_index(index)),
+        f'recall@{k}': recall_at_k(result_ids, truth_ids),
+        'batch_qps': len(queries) / batch_seconds,
+        'single_qps': single_queries / single_seconds,
+        'single_latency_ms': single_seconds / single_queries * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark FAISS index types against the exact flat index')
+    parser.add_argument('--embeddings', default=None, help='Embedding store prefix (see embedding_store.py)')
+    parser.add_argument('--synthetic', type=int, default=30000, help='Number of synthetic cards when no embeddings are given')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--configs', default=default_configs, help='FACTORY|SEARCH_PARAMS entries separated by semicolons')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--single-queries', type=int, default=200)
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.ascontiguousarray(EmbeddingStore(args.embeddings, mmap=False).matrix, dtype=np.float32)
+    else:
+        embeddings = make_clustered_embeddings(args.synthetic, args.dimension)
+
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)]
+    single_queries = min(args.single_queries, len(queries))
+
+    # Ground truth from the exact index
+    flat = faiss.IndexFlatIP(embeddings.shape[1])
+    flat.add(embeddings)
+    _, truth_ids = flat.search(queries, args.k)
+
+    print(f'{len(embeddings)} vectors of dimension {embeddings.shape[1]}, {len(queries)} queries, k={args.k}')
+    results = []
+    for config in args.configs.split(';'):
+        index_factory, _, search_params = config.partition('|')
+        result = benchmark_config(embeddings, queries, truth_ids, index_factory, search_params or None, args.k, single_queries)
+        results.append(result)
+        print(f' {config:<32} build {result["build_seconds"]:7.2f}s  size {result["index_bytes"] / 1024 / 1024:8.1f} MiB'
+              f'  recall@{args.k} {result[f"recall@{args.k}"]:.3f}  single {result["single_latency_ms"]:7.3f} ms'
+              f'  batch {result["batch_qps"]:9.0f} q/s')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'num_vectors': len(embeddings), 'dimension': embeddings.shape[1], 'k': args.k, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
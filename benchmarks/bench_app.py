@@ -0,0 +1,255 @@
+# End-to-end latency and throughput benchmark of the web app on a synthetic corpus, no data files or network needed.
+# It generates a Scryfall-shaped card file, random normalized embeddings, indices (and optionally neighbor tables)
+# for every axis at the requested scale, then measures in a fresh process:
+#  startup         time until the app is ready (primary axis loaded) and until every axis is loaded
+#  related_sfids   fetch_related_sfids latency percentiles (one axis)
+#  related_cards   fetch_related_cards latency percentiles, cold (every card once) and warm (ranking cache hits)
+#  requests        requests/sec of /card/<sfid> and / through the Flask test client
+#  peak_rss        peak resident memory of the measuring process
+# Results are written as JSON, and can be compared against an earlier run with --compare.
+#
+# ex: python benchmarks/bench_app.py --cards 30000 --json bench-30k.json
+#     python benchmarks/bench_app.py --cards 100000 --neighbor-tables --json bench-100k.json --compare bench-30k.json
+#     python benchmarks/bench_app.py --cards 1000000 --dimension 128 --index-factory "HNSW32,Flat" --work-dir /data/bench-1m
+# NOTE: At 768 dimensions every axis needs ~3 GiB of embeddings per million cards, so large runs need a smaller --dimension.
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_ann import make_clustered_embeddings
+
+axes = ['similar', 'dupe2', 'spike', 'melvin', 'timmy']
+
+card_types = ['Creature — Goblin Warrior', 'Legendary Creature — Human Wizard', 'Creature — Elf Druid', 'Instant', 'Sorcery',
+              'Artifact', 'Artifact — Equipment', 'Enchantment — Aura', 'Land', 'Legendary Planeswalker — Jace']
+card_effects = ['Draw a card.', 'Destroy target creature.', 'Counter target spell.', 'Add {G}.', 'Flying', 'Haste',
+                'Create a 1/1 white Soldier creature token.', 'Deal 3 damage to any target.', 'Scry 2.', 'Gain 4 life.']
+formats = ['standard', 'pioneer', 'modern', 'legacy', 'vintage', 'commander', 'pauper']
+
+
+def make_synthetic_cards(num_cards, seed=0):
+    # Cards with the fields the app and the loaders use, in Scryfall's bulk data shape
+    rng = random.Random(seed)
+    cards = []
+    for number in range(num_cards):
+        sfid = str(uuid.UUID(int=rng.getrandbits(128)))
+        colors = rng.sample('WUBRG', rng.randint(0, 2))
+        generic = rng.randint(0, 6)
+        card = {
+            'object': 'card',
+            'id': sfid,
+            'name': f'Synthetic Card {number}',
+            'layout': 'normal',
+            'set_type': 'expansion',
+            'mana_cost': (f'{{{generic}}}' if generic else '') + ''.join(f'{{{color}}}' for color in colors),
+            'cmc': float(generic + len(colors)),
+            'type_line': rng.choice(card_types),
+            'oracle_text': ' '.join(rng.sample(card_effects, rng.randint(1, 3))),
+            'color_identity': colors,
+            'legalities': {format_name: rng.choice(['legal', 'legal', 'not_legal']) for format_name in formats},
+            'edhrec_rank': rng.randint(1, num_cards),
+            'prices': {'usd': f'{rng.random() * 10:.2f}'},
+            'tcgplayer_id': number,
+            'image_uris': {'small': f'https://example.com/{sfid}/small.jpg', 'normal': f'https://example.com/{sfid}/normal.jpg'},
+        }
+        if 'Creature' in card['type_line']:
+            card['power'] = str(rng.randint(0, 6))
+            card['toughness'] = str(rng.randint(1, 6))
+        cards.append(card)
+    return cards
+
+
+def generate_corpus(db_dir, data_file, num_cards, dimension, index_factory, search_params, neighbor_tables):
+    # Writes everything app.py loads, in the same layout as data/create_db.py
+    from embedding_store import get_embedding_store_prefix, write_embedding_store
+    from index_builder import build_index, write_keys
+    import faiss
+
+    os.makedirs(db_dir, exist_ok=True)
+    cards = make_synthetic_cards(num_cards)
+    with open(f'{db_dir}/{data_file}.json', 'w') as f:
+        json.dump(cards, f)
+    sfids = [card['id'] for card in cards]
+
+    for axis_number, tag in enumerate(axes):
+        then = time.perf_counter()
+        embeddings_by_sfid = dict(zip(sfids, make_clustered_embeddings(num_cards, dimension, seed=axis_number)))
+        write_embedding_store(get_embedding_store_prefix(db_dir, data_file, tag), embeddings_by_sfid)
+
+        index, ids_by_sfid = build_index(embeddings_by_sfid, dimension, index_factory, search_params)
+        index_file = f'{db_dir}/faiss_{data_file}_db_{tag}.index'
+        faiss.write_index(index, index_file)
+        write_keys(f'{db_dir}/faiss_{data_file}_db_{tag}.keys', ids_by_sfid)
+
+        if neighbor_tables:
+            from embedding_store import EmbeddingStore
+            from neighbor_tables import build_neighbor_table, get_neighbor_table_prefix, write_neighbor_table
+            embedding_store = EmbeddingStore(get_embedding_store_prefix(db_dir, data_file, tag))
+            neighbors, scores = build_neighbor_table(index, ids_by_sfid, embedding_store)
+            write_neighbor_table(get_neighbor_table_prefix(db_dir, data_file, tag), neighbors, scores, index_file)
+
+        print(f' Generated {tag} in {time.perf_counter() - then:.1f}s')
+
+
+def percentiles(seconds):
+    milliseconds = np.array(seconds) * 1000
+    return {
+        'count': len(milliseconds),
+        'mean_ms': float(np.mean(milliseconds)),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p90_ms': float(np.percentile(milliseconds, 90)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+        'max_ms': float(np.max(milliseconds)),
+    }
+
+
+def time_calls(function, arguments):
+    seconds = []
+    for argument in arguments:
+        then = time.perf_counter()
+        function(argument)
+        seconds.append(time.perf_counter() - then)
+    return seconds
+
+
+def measure(num_queries, num_requests, seed=0):
+    # Runs in its own process, with MTGMATRIX_DATA_FILE and MTGMATRIX_DB_DIR pointing at the corpus.
+    # The app's progress prints are silenced so they don't distort the timings.
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        then = time.perf_counter()
+        import app
+        context = app.contexts.current
+        context.index_loader.wait([app.primary_axis])
+        results['ready_seconds'] = time.perf_counter() - then
+        context.index_loader.wait()
+        results['startup_seconds'] = time.perf_counter() - then
+
+        rng = random.Random(seed)
+        sfids = rng.sample(context.search_engine.sfids, min(num_queries, len(context.search_engine.sfids)))
+
+        results['related_sfids'] = percentiles(time_calls(lambda sfid: app.fetch_related_sfids(sfid, 'similar'), sfids))
+
+        context.ranking_cache.clear()
+        results['related_cards_cold'] = percentiles(time_calls(lambda sfid: app.fetch_related_cards(sfid, 0, 20), sfids))
+        results['related_cards_warm'] = percentiles(time_calls(lambda sfid: app.fetch_related_cards(sfid, 20, 40), sfids))
+
+        client = app.app.test_client()
+        context.ranking_cache.clear()
+        paths = {
+            'card': [f'/card/{rng.choice(sfids)}' for _ in range(num_requests)],
+            'home': ['/' for _ in range(num_requests)],
+        }
+        results['requests'] = {}
+        for name, urls in paths.items():
+            then = time.perf_counter()
+            statuses = [client.get(url).status_code for url in urls]
+            elapsed = time.perf_counter() - then
+            results['requests'][name] = {
+                'requests': len(urls),
+                'requests_per_second': len(urls) / elapsed,
+                'errors': sum(1 for status in statuses if status >= 400),
+            }
+
+    # ru_maxrss is in KiB on Linux, and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results['peak_rss_mib'] = max_rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+    return results
+
+
+def compare(results, previous):
+    # Prints the relative change of the headline numbers against an earlier run
+    def change(path, higher_is_better=False):
+        current, earlier = results, previous
+        for key in path:
+            current, earlier = current.get(key, {}), earlier.get(key, {})
+        if not isinstance(current, (int, float)) or not isinstance(earlier, (int, float)) or earlier == 0:
+            return
+        ratio = current / earlier - 1
+        better = ratio > 0 if higher_is_better else ratio < 0
+        print(f' {".".join(path):<40} {earlier:12.2f} -> {current:12.2f}  ({ratio * 100:+6.1f}%{", better" if better else ""})')
+
+    print('Compared with the previous run:')
+    change(['ready_seconds'])
+    change(['startup_seconds'])
+    for name in ['related_sfids', 'related_cards_cold', 'related_cards_warm']:
+        change([name, 'p50_ms'])
+        change([name, 'p99_ms'])
+    for name in results.get('requests', {}):
+        change(['requests', name, 'requests_per_second'], higher_is_better=True)
+    change(['peak_rss_mib'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the web app on a synthetic corpus')
+    parser.add_argument('--cards', type=int, default=30000, help='Number of synthetic cards, ex: 30000, 100000 or 1000000')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--index-factory', default='Flat', help='FAISS index factory string (see index_builder.py)')
+    parser.add_argument('--search-params', default=None, help='FAISS search parameters, ex: nprobe=32')
+    parser.add_argument('--neighbor-tables', action='store_true', help='Also precompute the top-100 neighbor tables')
+    parser.add_argument('--work-dir', default=None, help='Where to keep the corpus (reused if already generated); a temporary directory by default')
+    parser.add_argument('--queries', type=int, default=500, help='Number of cards for the latency measurements')
+    parser.add_argument('--requests', type=int, default=500, help='Number of requests per path for the throughput measurements')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # Child process: print the measurements as JSON for the parent
+        print(json.dumps(measure(args.queries, args.requests)))
+        return
+
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        data_file = f'synthetic-cards-{args.cards}-{args.dimension}'
+        if not os.path.exists(f'{work_dir}/{data_file}.json'):
+            print(f'Generating {args.cards} synthetic cards with {args.dimension}-dimensional embeddings in {work_dir}...')
+            generate_corpus(work_dir, data_file, args.cards, args.dimension, args.index_factory, args.search_params, args.neighbor_tables)
+
+        # Measure in a fresh process, so startup time and peak memory only cover the app itself
+        env = dict(os.environ, MTGMATRIX_DATA_FILE=data_file, MTGMATRIX_DB_DIR=work_dir, MTGMATRIX_QUERY_EMBEDDER='stub')
+        app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure', '--queries', str(args.queries), '--requests', str(args.requests)],
+                                cwd=app_dir, env=env, check=True, capture_output=True, text=True).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+
+    results['config'] = {
+        'cards': args.cards,
+        'dimension': args.dimension,
+        'index_factory': args.index_factory,
+        'search_params': args.search_params,
+        'neighbor_tables': args.neighbor_tables,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    print(f'Ready: {results["ready_seconds"]:.2f}s, all axes loaded: {results["startup_seconds"]:.2f}s, peak RSS {results["peak_rss_mib"]:.0f} MiB')
+    for name in ['related_sfids', 'related_cards_cold', 'related_cards_warm']:
+        result = results[name]
+        print(f' {name:<20} p50 {result["p50_ms"]:8.3f} ms  p90 {result["p90_ms"]:8.3f} ms  p99 {result["p99_ms"]:8.3f} ms')
+    for name, result in results['requests'].items():
+        print(f' GET {name:<16} {result["requests_per_second"]:8.0f} req/s  ({result["errors"]} errors)')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
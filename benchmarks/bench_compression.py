@@ -0,0 +1,112 @@
+# Memory and ranking-drift report for the reduced-precision index modes (see index_builder.compression_modes).
+# For every axis it builds each compressed index from the axis' embedding store, and compares its rankings
+# with the full-precision flat index: top-k overlap, mean rank shift of shared results, and score error.
+#
+# ex: python benchmarks/bench_compression.py --data-file oracle-cards-20231113220154 --db-dir ./data
+#     python benchmarks/bench_compression.py --synthetic 30000 --modes none,fp16,sq8,pca256
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import faiss
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from bench_ann import make_clustered_embeddings
+from embedding_store import EmbeddingStore, get_embedding_store_prefix, write_embedding_store
+from index_builder import compress_index, get_embedding_store_dtype
+
+
+def ranking_drift(baseline_ids, baseline_scores, result_ids, result_scores, k):
+    overlaps = []
+    rank_shifts = []
+    for baseline_row, result_row in zip(baseline_ids[:, :k], result_ids[:, :k]):
+        shared, baseline_ranks, result_ranks = np.intersect1d(baseline_row, result_row, return_indices=True)
+        overlaps.append(len(shared) / k)
+        if len(shared) > 0:
+            rank_shifts.append(np.mean(np.abs(baseline_ranks - result_ranks)))
+    return {
+        f'overlap@{k}': float(np.mean(overlaps)),
+        f'rank_shift@{k}': float(np.mean(rank_shifts)) if rank_shifts else None,
+        f'score_error@{k}': float(np.mean(np.abs(baseline_scores[:, :k] - result_scores[:, :k]))),
+    }
+
+
+def report_axis(embedding_store, ids_by_sfid, modes, num_queries, ks):
+    rng = np.random.default_rng(0)
+    sfids = list(ids_by_sfid.keys())
+    query_sfids = [sfids[i] for i in rng.choice(len(sfids), min(num_queries, len(sfids)), replace=False)]
+    queries, _ = embedding_store.get_many(query_sfids)
+    max_k = max(ks)
+
+    baseline = compress_index(embedding_store, ids_by_sfid, 'none')
+    baseline_scores, baseline_ids = baseline.search(queries, max_k)
+    baseline_bytes = len(faiss.serialize_index(baseline)) + embedding_store.matrix.nbytes
+
+    results = []
+    for mode in modes:
+        index = baseline if mode == 'none' else compress_index(embedding_store, ids_by_sfid, mode)
+        scores, ids = index.search(queries, max_k)
+
+        index_bytes = len(faiss.serialize_index(index))
+        store_bytes = embedding_store.matrix.size * np.dtype(get_embedding_store_dtype(mode)).itemsize
+        result = {
+            'mode': mode,
+            'index_bytes': index_bytes,
+            'store_bytes': store_bytes,
+            'memory_saved': 1.0 - (index_bytes + store_bytes) / baseline_bytes,
+        }
+        for k in ks:
+            result.update(ranking_drift(baseline_ids, baseline_scores, ids, scores, k))
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report memory saved and ranking drift of the index compression modes')
+    parser.add_argument('--data-file', default='oracle-cards-20231113220154')
+    parser.add_argument('--db-dir', default='./data')
+    parser.add_argument('--axes', default='similar,dupe2,spike,melvin,timmy')
+    parser.add_argument('--synthetic', type=int, default=None, help='Use N synthetic cards per axis instead of the data files')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--modes', default='none,fp16,sq8,pca256,pca128')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--ks', default='10,100')
+    parser.add_argument('--json', default=None, help='Write the report to this JSON file')
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    ks = [int(k) for k in args.ks.split(',')]
+    report = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for axis_number, tag in enumerate(args.axes.split(',')):
+            if args.synthetic:
+                embeddings = make_clustered_embeddings(args.synthetic, args.dimension, seed=axis_number)
+                embeddings_by_sfid = {f'card-{idx:07d}': embedding for idx, embedding in enumerate(embeddings)}
+                write_embedding_store(f'{tmp_dir}/{tag}', embeddings_by_sfid)
+                embedding_store = EmbeddingStore(f'{tmp_dir}/{tag}')
+                ids_by_sfid = {sfid: idx for idx, sfid in enumerate(embeddings_by_sfid)}
+            else:
+                embedding_store = EmbeddingStore(get_embedding_store_prefix(args.db_dir, args.data_file, tag))
+                with open(f'{args.db_dir}/faiss_{args.data_file}_db_{tag}.keys') as f:
+                    ids_by_sfid = json.load(f)
+
+            report[tag] = report_axis(embedding_store, ids_by_sfid, modes, args.queries, ks)
+
+            print(f'{tag} ({len(ids_by_sfid)} cards)')
+            for result in report[tag]:
+                drift = '  '.join(f'overlap@{k} {result[f"overlap@{k}"]:.3f}  rank shift@{k} {result[f"rank_shift@{k}"] or 0:.2f}' for k in ks)
+                print(f' {result["mode"]:<8} {(result["index_bytes"] + result["store_bytes"]) / 1024 / 1024:8.1f} MiB'
+                      f'  saved {result["memory_saved"] * 100:5.1f}%  {drift}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
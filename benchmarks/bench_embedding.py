@@ -0,0 +1,45 @@
+# Throughput benchmark for the batched embedding pipeline, using the stub embedder so no model download is needed.
+# The stub sleeps for a fixed cost per model call plus a cost per document, to mimic batching gains of a real model.
+#
+# ex: python benchmarks/bench_embedding.py --cards 5000 --workers 1,4,8 --batch-sizes 1,32
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from embed_pipeline import embed_documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the embedding pipeline with a stub embedder')
+    parser.add_argument('--cards', type=int, default=2000)
+    parser.add_argument('--batch-sizes', default='1,32')
+    parser.add_argument('--workers', default='1,4')
+    parser.add_argument('--executor', default='thread', choices=['thread', 'process'])
+    parser.add_argument('--delay-per-batch', type=float, default=0.005, help='Simulated fixed cost of one model call (seconds)')
+    parser.add_argument('--delay-per-document', type=float, default=0.0005, help='Simulated cost per document (seconds)')
+    args = parser.parse_args()
+
+    documents_by_sfid = {f'card-{idx}': f'Type Line: Creature\nOracle Text: Card number {idx}' for idx in range(args.cards)}
+    embedder_kwargs = {'delay_per_batch': args.delay_per_batch, 'delay_per_document': args.delay_per_document}
+
+    results = []
+    for batch_size in [int(value) for value in args.batch_sizes.split(',')]:
+        for workers in [int(value) for value in args.workers.split(',')]:
+            embeddings_by_sfid = {}
+            stats = embed_documents(documents_by_sfid, embeddings_by_sfid, 'stub', 'Represent the card: ',
+                embedder_kwargs=embedder_kwargs,
+                batch_size=batch_size,
+                workers=workers,
+                executor=args.executor,
+                label=f'batch_size={batch_size} workers={workers}')
+            results.append((batch_size, workers, stats['cards_per_second']))
+
+    print(f'{"batch size":>10} {"workers":>8} {"cards/s":>10}')
+    for batch_size, workers, cards_per_second in results:
+        print(f'{batch_size:>10} {workers:>8} {cards_per_second:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
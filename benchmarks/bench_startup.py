@@ -0,0 +1,77 @@
+# Startup-time benchmark for loading the oracle card data.
+# Compares the original path (json.load + cull with list.remove in a reversed loop) against
+# the single-pass cull in card_loader and against loading the prebuilt snapshot.
+#
+# ex: python benchmarks/bench_startup.py ./data/oracle-cards-20231113220154.json --repeat 3
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import card_loader
+
+
+def legacy_load(json_file):
+    # Copy of the loop that used to live in app.py, card_db.py and data/create_db.py (O(n^2) because of list.remove)
+    card_data = card_loader.load_raw_cards(json_file)
+    for card in card_data[::-1]:
+        if card['layout'] in ['art_series', 'token', 'double_faced_token']:
+            card_data.remove(card)
+        elif card['set_type'] in ['memorabilia', 'token', 'minigame']:
+            card_data.remove(card)
+
+        if not 'image_uris' in card:
+            if 'card_faces' in card:
+                for card_face in card['card_faces']:
+                    if 'image_uris' in card_face:
+                        card['image_uris'] = card_face['image_uris']
+                        break
+            if not 'image_uris' in card:
+                card_data.remove(card)
+    return card_data
+
+
+def single_pass_load(json_file):
+    return card_loader.cull_cards(card_loader.load_raw_cards(json_file), verbose=False)
+
+
+def time_it(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        then = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - then)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark card data startup time')
+    parser.add_argument('json_file', help='Scryfall oracle-cards bulk file')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-legacy', action='store_true', help='Skip the original O(n^2) path (slow on big files)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_file = os.path.join(tmp_dir, 'cards.snapshot.pickle')
+
+        build_time, _ = time_it(lambda: card_loader.build_snapshot(args.json_file, snapshot_file, verbose=False), 1)
+        snapshot_size = os.path.getsize(snapshot_file)
+
+        results = []
+        if not args.skip_legacy:
+            results.append(('legacy json + list.remove', *time_it(lambda: legacy_load(args.json_file), args.repeat)))
+        results.append(('json + single-pass cull', *time_it(lambda: single_pass_load(args.json_file), args.repeat)))
+        results.append(('snapshot', *time_it(lambda: card_loader.read_snapshot(snapshot_file, args.json_file), args.repeat)))
+
+    print(f'Snapshot build: {build_time:.3f}s ({snapshot_size / 1024 / 1024:.1f} MiB)')
+    baseline = results[0][1]
+    for name, seconds, card_data in results:
+        print(f' {name:<28} {seconds:8.3f}s  {len(card_data)} cards  ({baseline / seconds:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Per-worker memory of the production server (wsgi.py + gunicorn.conf.py) as the number of workers grows.
+# For every worker count it starts gunicorn on a synthetic corpus (see bench_app.py), sends requests so every
+# worker touches the card data and the indices, and reads each process' memory from /proc/<pid>/smaps_rollup:
+#  uss  memory only this process uses (Private_Clean + Private_Dirty), what every extra worker really costs
+#  pss  proportional share of the memory it shares with the other processes
+#  rss  everything it maps, shared pages included
+# With the data loaded before the fork and the GC frozen, per-worker USS should stay flat as workers are added.
+# Linux only.
+#
+# ex: python benchmarks/bench_workers.py --workers 1,2,4,8 --cards 30000 --json workers.json
+#     python benchmarks/bench_workers.py --workers 1,4 --no-gc-freeze
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from bench_app import generate_corpus
+
+app_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def read_memory(pid):
+    # Returns {'rss', 'pss', 'uss'} in MiB
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss': fields.get('Rss', 0.0),
+        'pss': fields.get('Pss', 0.0),
+        'uss': fields.get('Private_Clean', 0.0) + fields.get('Private_Dirty', 0.0),
+    }
+
+
+def get_children(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The parent pid is the 4th field, after the (possibly spaced) command name
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def get(url, timeout=10):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        response.read()
+        return response.status
+
+
+def wait_until_ready(base_url, process, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with status {process.returncode}')
+        with contextlib.suppress(OSError, urllib.error.URLError):
+            if get(f'{base_url}/readyz', timeout=1) == 200:
+                return
+        time.sleep(0.2)
+    raise RuntimeError(f'gunicorn was not ready after {timeout}s')
+
+
+def measure_workers(num_workers, env, port, sfids, requests_per_worker, timeout):
+    env = dict(env, MTGMATRIX_WORKERS=str(num_workers), MTGMATRIX_BIND=f'127.0.0.1:{port}')
+    base_url = f'http://127.0.0.1:{port}'
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application'],
+                               cwd=app_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        then = time.perf_counter()
+        wait_until_ready(base_url, process, timeout)
+        ready_seconds = time.perf_counter() - then
+
+        # Enough requests that every worker serves some of them
+        rng = random.Random(num_workers)
+        then = time.perf_counter()
+        for _ in range(requests_per_worker * num_workers):
+            get(f'{base_url}/card/{rng.choice(sfids)}')
+        requests_per_second = requests_per_worker * num_workers / (time.perf_counter() - then)
+
+        master = read_memory(process.pid)
+        workers = [read_memory(pid) for pid in get_children(process.pid)]
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+    return {
+        'workers': num_workers,
+        'ready_seconds': ready_seconds,
+        'requests_per_second': requests_per_second,
+        'master_rss_mib': master['rss'],
+        'worker_uss_mib': sum(worker['uss'] for worker in workers) / max(1, len(workers)),
+        'worker_pss_mib': sum(worker['pss'] for worker in workers) / max(1, len(workers)),
+        'worker_rss_mib': sum(worker['rss'] for worker in workers) / max(1, len(workers)),
+        'total_pss_mib': master['pss'] + sum(worker['pss'] for worker in workers),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-worker memory of the production server as workers are added')
+    parser.add_argument('--workers', default='1,2,4,8', help='Comma-separated worker counts')
+    parser.add_argument('--cards', type=int, default=30000)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--work-dir', default=None, help='Where to keep the corpus (reused if already generated); a temporary directory by default')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--requests-per-worker', type=int, default=50)
+    parser.add_argument('--timeout', type=int, default=300, help='Seconds to wait for the server to be ready')
+    parser.add_argument('--no-gc-freeze', action='store_true', help='Fork without freezing the GC, for comparison')
+    parser.add_argument('--index-mmap', action='store_true', help='Memory-map the FAISS indices')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        work_dir = args.work_dir or stack.enter_context(tempfile.TemporaryDirectory())
+        data_file = f'synthetic-cards-{args.cards}-{args.dimension}'
+        if not os.path.exists(f'{work_dir}/{data_file}.json'):
+            print(f'Generating {args.cards} synthetic cards with {args.dimension}-dimensional embeddings in {work_dir}...')
+            generate_corpus(work_dir, data_file, args.cards, args.dimension, 'Flat', None, False)
+        with open(f'{work_dir}/{data_file}.json') as f:
+            sfids = [card['id'] for card in json.load(f)]
+
+        env = dict(os.environ, MTGMATRIX_DATA_FILE=data_file, MTGMATRIX_DB_DIR=work_dir, MTGMATRIX_QUERY_EMBEDDER='stub',
+                   MTGMATRIX_GC_FREEZE='0' if args.no_gc_freeze else '1', MTGMATRIX_INDEX_MMAP='1' if args.index_mmap else '0')
+
+        results = []
+        for num_workers in [int(count) for count in args.workers.split(',')]:
+            result = measure_workers(num_workers, env, args.port, sfids, args.requests_per_worker, args.timeout)
+            results.append(result)
+            print(f' {num_workers:3d} workers: USS/worker {result["worker_uss_mib"]:7.1f} MiB  PSS/worker {result["worker_pss_mib"]:7.1f} MiB'
+                  f'  RSS/worker {result["worker_rss_mib"]:7.1f} MiB  total PSS {result["total_pss_mib"]:8.1f} MiB'
+                  f'  {result["requests_per_second"]:6.0f} req/s')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'cards': args.cards, 'dimension': args.dimension, 'gc_freeze': not args.no_gc_freeze,
+                       'index_mmap': args.index_mmap, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
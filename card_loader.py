@@ -0,0 +1,133 @@
+import json
+import os
+import pickle
+import sys
+
+# Shared loader for the Scryfall oracle bulk file, used by app.py, card_db.py and data/create_db.py.
+# The raw bulk file is parsed and culled once, then written to a preprocessed snapshot next to it.
+# Later loads (every server worker boot) only unpickle the snapshot.
+
+# Bump this whenever the culling rules or the snapshot layout change, so old snapshots get rebuilt.
+SNAPSHOT_VERSION = 1
+
+# Remove every card that has layout 'art_series' or 'token' or 'double_faced_token'
+excluded_layouts = {'art_series', 'token', 'double_faced_token'}
+# Remove every card that has a set_type of 'memorabilia' or 'token' or 'minigame'
+excluded_set_types = {'memorabilia', 'token', 'minigame'}
+
+
+def cull_cards(card_data, verbose=True):
+    culled = []
+
+    # Single pass over the cards, building a new list instead of calling list.remove() (which rescans the list every time)
+    for card in card_data:
+        if card['layout'] in excluded_layouts:
+            continue
+        if card['set_type'] in excluded_set_types:
+            continue
+
+        # For every card, if it doesn't have an image, check to see if a card_face has it. If so, move that up to the parent. Otherwise, remove the card entirely.
+        if not 'image_uris' in card:
+            for card_face in card.get('card_faces', []):
+                if 'image_uris' in card_face:
+                    card['image_uris'] = card_face['image_uris']
+                    break
+            if not 'image_uris' in card:
+                if verbose:
+                    print(f'  {card["name"]} ({card["id"]}) has no image_uris')
+                continue
+
+        culled.append(card)
+
+    return culled
+
+
+def load_raw_cards(json_file):
+    with open(json_file) as f:
+        return json.load(f)
+
+
+def get_snapshot_file(json_file):
+    # ex: ./data/oracle-cards-20231113220154.json -> ./data/oracle-cards-20231113220154.snapshot.pickle
+    base, _ = os.path.splitext(json_file)
+    return f'{base}.snapshot.pickle'
+
+
+def get_source_stamp(json_file):
+    # Size + mtime is enough to notice that a bulk file was replaced, without reading it
+    stat = os.stat(json_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def write_snapshot(card_data, snapshot_file, json_file=None):
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'source': os.path.basename(json_file) if json_file else None,
+        'source_stamp': get_source_stamp(json_file) if json_file else None,
+        'cards': card_data,
+    }
+
+    # Write to a temporary file first so a crashed build never leaves a half-written snapshot behind
+    tmp_file = f'{snapshot_file}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, snapshot_file)
+
+
+def read_snapshot(snapshot_file, json_file=None):
+    # Returns the culled card list, or None if the snapshot is missing or stale
+    if not os.path.exists(snapshot_file):
+        return None
+
+    with open(snapshot_file, 'rb') as f:
+        snapshot = pickle.load(f)
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        print(f' Snapshot {snapshot_file} has version {snapshot.get("version")}, expected {SNAPSHOT_VERSION}')
+        return None
+
+    # If the raw bulk file is still around, make sure that the snapshot was built from this exact file.
+    # Deployments that only ship the snapshot skip this check.
+    if json_file and os.path.exists(json_file) and snapshot.get('source_stamp') != get_source_stamp(json_file):
+        print(f' Snapshot {snapshot_file} is out of date with {json_file}')
+        return None
+
+    return snapshot['cards']
+
+
+def build_snapshot(json_file, snapshot_file=None, verbose=True):
+    if snapshot_file is None:
+        snapshot_file = get_snapshot_file(json_file)
+
+    card_data = load_raw_cards(json_file)
+    print(f'Loaded {len(card_data)} cards from {json_file}')
+
+    card_data = cull_cards(card_data, verbose=verbose)
+    print(f' Culled to {len(card_data)} cards')
+
+    write_snapshot(card_data, snapshot_file, json_file)
+    print(f' Wrote snapshot to {snapshot_file}')
+
+    return card_data
+
+
+def load_cards(json_file, snapshot_file=None, rebuild=False, verbose=True):
+    if snapshot_file is None:
+        snapshot_file = get_snapshot_file(json_file)
+
+    if not rebuild:
+        card_data = read_snapshot(snapshot_file, json_file)
+        if card_data is not None:
+            print(f'Loaded {len(card_data)} cards from snapshot {snapshot_file}')
+            return card_data
+
+    return build_snapshot(json_file, snapshot_file, verbose=verbose)
+
+
+if __name__ == '__main__':
+    # Prebuild the snapshot for a bulk file, ex: python card_loader.py ./data/oracle-cards-20231113220154.json
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} <oracle-cards.json> [<snapshot file>]')
+        sys.exit(1)
+
+    build_snapshot(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
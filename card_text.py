@@ -0,0 +1,112 @@
+# Text rendering of cards for embedding, shared by data/create_db.py and the query-time embedding code.
+
+import re
+
+# NOTE: Leave 'name' out of the similarity calculations.
+all_fields = ['type_line', 'mana_cost', 'cmc', 'power', 'toughness', 'loyalty', 'color_identity', 'produced_mana', 'oracle_text', 'flavor_text']
+
+query_instructions = [
+    ('similar', 'Represent the Magic: The Gathering card for retrieving similar cards: ',
+        all_fields),
+    ('duplicate', 'Represent the Magic: The Gathering card for retrieving duplicate cards: ',
+        ['type_line', 'mana_cost', 'color_identity', 'produced_mana', 'oracle_text']),
+    ('dupe2', 'Represent the Magic: The Gathering card for retrieving duplicate cards: ',
+        ['type_line', 'mana_cost', 'oracle_text']),
+    ('spike', 'Represent the functionality of the Magic: The Gathering card in terms of its overall effect on the game for retrieval of similar cards: ',
+        ['type_line', 'cmc', 'power', 'produced_mana', 'oracle_text']),
+    ('melvin', 'Represent the themes of the Magic: The Gathering card in terms of creature types, deck archetypes, and other functional archetypes (such as counters, planeswalkers, aristocrats, infect, etc) for retrieval of related cards: ',
+        ['type_line', 'produced_mana', 'oracle_text']),
+    ('vorthos', 'Represent the flavor of the Magic: The Gathering card in terms of its themes, characters, emotions, and flavor text for retrieval of related cards: ',
+        ['oracle_text', 'color_identity', 'flavor_text']),
+    ('timmy', 'Represent the power of the Magic: The Gathering card in terms of its mana cost, power, toughness, efficiency, and other numerical values for retrieval of similar cards: ',
+        ['type_line', 'mana_cost', 'cmc', 'color_identity', 'power', 'toughness', 'produced_mana', 'oracle_text']),
+    ('johnny', 'Represent the creativity of the Magic: The Gathering card in terms of its interactions with other cards, combos, complexity, and other creative uses for retrieval of related cards: ',
+        ['produced_mana', 'type_line', 'oracle_text']),
+    ('flavor', 'Represent the flavor of the Magic: The Gathering card in terms of its themes, characters, emotions, and flavor text for retrieval of related cards: ',
+        ['flavor_text'])
+]
+
+def get_card_fields(card, field):
+    fields = []
+
+    if field in card:
+        fields.append(str(card[field]))
+    else:
+        if 'card_faces' in card:
+            for face in card['card_faces']:
+                if field in face:
+                    fields.append(str(face[field]))
+
+    # Trim and remove empty fields
+    fields = [field.strip() for field in fields]
+    fields = [field for field in fields if len(field) > 0]
+
+    return fields
+
+def get_readable_card_fields(card, field):
+    field_name = field.replace('_', ' ').title()
+
+    fields = get_card_fields(card, field)
+
+    if len(fields) > 0:
+        return f'\n{field_name}: ' + ' // '.join(fields)
+    else:
+        return f'\n{field_name}: n/a'
+
+def render_card_text(card, embed_fields):
+    # Build a text representation of the card for one axis
+    # NOTE: Each representation includes a different set of fields, because each axis cares about different things.
+    # NOTE: We are not including the name in any of the representations, because the name is not a good indicator of similarity.
+    # Returns (card_content, num_valid_fields). Cards with zero valid fields should not be embedded.
+    card_content = ''
+    num_valid_fields = 0
+
+    for field in embed_fields:
+        num_valid_fields += len(get_card_fields(card, field))
+        card_content += get_readable_card_fields(card, field)
+
+    card_content = card_content.strip()
+
+    # Replace all instances of the card name with 'this card' in the card content
+    card_names = card['name'].split(' // ')
+    for card_name in card_names:
+        card_name = card_name.strip()
+        card_content = card_content.replace(card_name, 'this card')
+
+    return card_content, num_valid_fields
+
+def get_query_instruction(query_tag):
+    # Returns (embed_instruction, embed_fields) for an axis
+    for tag, embed_instruction, embed_fields in query_instructions:
+        if tag == query_tag:
+            return embed_instruction, embed_fields
+    raise KeyError(f'Unknown query tag: {query_tag}')
+
+theoretical_card_fields = ['name', 'type_line', 'mana_cost', 'power', 'toughness', 'loyalty', 'oracle_text', 'flavor_text']
+
+_mana_symbol = re.compile(r'\{([^}]+)\}')
+
+def get_mana_value(mana_cost):
+    # '{2}{U}{U}' -> 4.0, '{X}{R}' -> 1.0, '{W/P}' -> 1.0
+    mana_value = 0.0
+    for symbol in _mana_symbol.findall(mana_cost):
+        if symbol.isdigit():
+            mana_value += int(symbol)
+        elif symbol not in ('X', 'Y', 'Z'):
+            mana_value += 1
+    return mana_value
+
+def get_mana_colors(mana_cost):
+    # '{1}{W/U}{B}' -> ['W', 'U', 'B'] (in WUBRG order)
+    symbols = ''.join(_mana_symbol.findall(mana_cost))
+    return [color for color in 'WUBRG' if color in symbols]
+
+def make_theoretical_card(fields):
+    # A card dict from user-entered fields, shaped like a Scryfall card so it renders like the indexed cards.
+    # Mana value and color identity are derived from the mana cost and the rules text.
+    card = {field: fields[field].strip() for field in theoretical_card_fields if fields.get(field) and fields[field].strip()}
+    card['name'] = card.get('name') or 'Theoretical Card'
+    mana_cost = card.get('mana_cost', '')
+    card['cmc'] = get_mana_value(mana_cost)
+    card['color_identity'] = get_mana_colors(mana_cost + card.get('oracle_text', ''))
+    return card
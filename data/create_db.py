@@ -1,303 +1,217 @@
-import json
+import os
 import sys
 import argparse
-import pickle
 from datetime import datetime
 
-from tqdm import tqdm
-
-from scipy import spatial
 import numpy as np
 
 import faiss
 
-from langchain.schema import Document
-from langchain.embeddings import HuggingFaceInstructEmbeddings
-
-# NOTE: Leave 'name' out of the similarity calculations.
-all_fields = ['type_line', 'mana_cost', 'cmc', 'power', 'toughness', 'loyalty', 'color_identity', 'produced_mana', 'oracle_text', 'flavor_text']
-
-query_instructions = [
-    ('similar', 'Represent the Magic: The Gathering card for retrieving similar cards: ',
-        all_fields),
-    ('duplicate', 'Represent the Magic: The Gathering card for retrieving duplicate cards: ',
-        ['type_line', 'mana_cost', 'color_identity', 'produced_mana', 'oracle_text']),
-    ('dupe2', 'Represent the Magic: The Gathering card for retrieving duplicate cards: ',
-        ['type_line', 'mana_cost', 'oracle_text']),
-    ('spike', 'Represent the functionality of the Magic: The Gathering card in terms of its overall effect on the game for retrieval of similar cards: ',
-        ['type_line', 'cmc', 'power', 'produced_mana', 'oracle_text']),
-    ('melvin', 'Represent the themes of the Magic: The Gathering card in terms of creature types, deck archetypes, and other functional archetypes (such as counters, planeswalkers, aristocrats, infect, etc) for retrieval of related cards: ',
-        ['type_line', 'produced_mana', 'oracle_text']),
-    ('vorthos', 'Represent the flavor of the Magic: The Gathering card in terms of its themes, characters, emotions, and flavor text for retrieval of related cards: ',
-        ['oracle_text', 'color_identity', 'flavor_text']),
-    ('timmy', 'Represent the power of the Magic: The Gathering card in terms of its mana cost, power, toughness, efficiency, and other numerical values for retrieval of similar cards: ',
-        ['type_line', 'mana_cost', 'cmc', 'color_identity', 'power', 'toughness', 'produced_mana', 'oracle_text']),
-    ('johnny', 'Represent the creativity of the Magic: The Gathering card in terms of its interactions with other cards, combos, complexity, and other creative uses for retrieval of related cards: ',
-        ['produced_mana', 'type_line', 'oracle_text']),
-    ('flavor', 'Represent the flavor of the Magic: The Gathering card in terms of its themes, characters, emotions, and flavor text for retrieval of related cards: ',
-        ['flavor_text'])
-]
-
-# For debug, only use the first query instruction
-#query_instructions = [query_instructions[-1]]
-
-input_file = 'oracle-cards-20231113220154.json'
-output_dir = input_file.replace('.json', '_db')
-model_name = 'hkunlp/instructor-large'
-
-# Load card data
-with open(input_file) as f:
-    card_data = json.load(f)
-    # Remove every card that has layout 'art_series' or 'token' or 'double_faced_token'
-    # Remove every card that has a set_type of 'memorabilia' or 'token' or 'minigame'
-#    for card in card_data:
-    for card in card_data[::-1]:
-        if card['layout'] in ['art_series', 'token', 'double_faced_token']:
-            card_data.remove(card)
-        elif card['set_type'] in ['memorabilia', 'token', 'minigame']:
-            card_data.remove(card)
-
-        # For every card, if it doesn't have an image, check to see if a card_face has it. If so, move that up to the parent. Otherwise, remove the card entirely.
-        if not 'image_uris' in card:
-            if 'card_faces' in card:
-                for card_face in card['card_faces']:
-                    if 'image_uris' in card_face:
-                        card['image_uris'] = card_face['image_uris']
-                        break
-            if not 'image_uris' in card:
-                print(f'  {card["name"]} ({card["id"]}) has no image_uris')
-                card_data.remove(card)
-                
-    cards_by_sfid = {card['id']: card for card in card_data}
-
-def get_card_fields(card, field):
-    fields = []
-
-    if field in card:
-        fields.append(str(card[field]))
-    else:
-        if 'card_faces' in card:
-            for face in card['card_faces']:
-                if field in face:
-                    fields.append(str(face[field]))
-
-    # Trim and remove empty fields
-    fields = [field.strip() for field in fields]
-    fields = [field for field in fields if len(field) > 0]
-
-    return fields
-
-def get_readable_card_fields(card, field):
-    field_name = field.replace('_', ' ').title()
-
-    fields = get_card_fields(card, field)
-
-    if len(fields) > 0:
-        return f'\n{field_name}: ' + ' // '.join(fields)
-    else:
-        return f'\n{field_name}: n/a'
-
-def cosine_similarity(embedding1, embedding2):
-    return spatial.distance.cosine(embedding1, embedding2)
-
-def dot_similarity(embedding1, embedding2):
-    return np.dot(embedding1, embedding2)
-
-FORCE_RECALCULATE = False
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from card_loader import load_cards
+from card_text import query_instructions, render_card_text
+from embedding_cache import EmbeddingCache
+from embed_pipeline import embed_documents, executor_types, read_checkpoint, write_checkpoint
+from embedders import embedder_types, embedding_size, model_name
+from embedding_store import EmbeddingStore, write_embedding_store
+from index_builder import apply_compression, build_index, compression_modes, compute_text_hash, get_embedding_store_dtype, read_hashes, read_keys, update_index, write_hashes, write_keys
+
+parser = argparse.ArgumentParser(description='Generate embeddings and FAISS indices for every query axis')
+parser.add_argument('--input', default='oracle-cards-20231113220154.json', help='Scryfall oracle-cards bulk file')
+parser.add_argument('--axes', default=None, help='Comma-separated list of query tags to build (default: all)')
+parser.add_argument('--embedder', default='instructor', choices=list(embedder_types.keys()), help='Embedding backend (stub needs no model download)')
+parser.add_argument('--batch-size', type=int, default=32, help='Number of cards per model call')
+parser.add_argument('--workers', type=int, default=1, help='Number of worker threads or processes')
+parser.add_argument('--executor', default='thread', choices=executor_types, help='Run batches serially, on a thread pool or on a process pool')
+parser.add_argument('--checkpoint-every', type=int, default=20, help='Write the embedding cache every N batches')
+parser.add_argument('--previous-input', default=None, help='Bulk file of a previous build; only re-embed cards whose text changed and update its indices in place')
+parser.add_argument('--index-factory', default='Flat', help='FAISS index factory string for every axis, ex: Flat, HNSW32,Flat, IVF1024,Flat, IVF1024,PQ64')
+parser.add_argument('--axis-index-factory', action='append', default=[], metavar='TAG=FACTORY', help='Override the index factory for one axis, ex: similar=HNSW32,Flat (repeatable)')
+parser.add_argument('--search-params', default=None, help='Search parameters saved with every index, ex: nprobe=16 or efSearch=64')
+parser.add_argument('--axis-search-params', action='append', default=[], metavar='TAG=PARAMS', help='Override the search parameters for one axis, ex: similar=nprobe=16 (repeatable)')
+parser.add_argument('--compression', default='none', help=f'Reduced-precision storage for the indices and embedding stores, one of {compression_modes}')
+parser.add_argument('--force-recalculate', action='store_true', help='Ignore cached embeddings')
+parser.add_argument('--embedding-cache', default='embedding_cache.sqlite', help='Embedding cache shared by every axis and build, keyed by content (empty to disable)')
+args = parser.parse_args()
+
+# For debug, only build some of the query instructions (ex: --axes similar,dupe2)
+if args.axes:
+    axes = args.axes.split(',')
+    query_instructions = [query_instruction for query_instruction in query_instructions if query_instruction[0] in axes]
+
+# Index type and search parameters per axis, ex: --axis-index-factory similar=IVF1024,Flat --axis-search-params similar=nprobe=16
+index_factories = dict(axis_index_factory.split('=', 1) for axis_index_factory in args.axis_index_factory)
+search_params = dict(axis_search_params.split('=', 1) for axis_search_params in args.axis_search_params)
+
+# Fail early on unknown compression modes, rather than after the first axis is embedded
+apply_compression(args.index_factory, args.compression)
+
+input_file = args.input
+output_dir = os.path.basename(input_file).replace('.json', '_db')
+previous_dir = os.path.basename(args.previous_input).replace('.json', '_db') if args.previous_input else None
+
+# Load card data (from the preprocessed snapshot, building it from the bulk file on first run)
+card_data = load_cards(input_file)
+cards_by_sfid = {card['id']: card for card in card_data}
+
+FORCE_RECALCULATE = args.force_recalculate
+
+# Every distinct (model, instruction, text) is embedded once, across axes and builds (see embedding_cache.py).
+# The stub embedder gets its own keys, so its vectors never stand in for the real model's.
+embedding_cache = EmbeddingCache(args.embedding_cache) if args.embedding_cache else None
+cache_model_name = model_name if args.embedder == 'instructor' else f'{args.embedder}:{model_name}'
+build_stats = {'cards': 0, 'shared_cache_hits': 0, 'embedded': 0}
 
 for query_tag, embed_instruction, embed_fields in query_instructions:
 
-    cached_embeddings = {}
-
-    # Load the simple cache from the Pickle file for each query tag
-    try:
-        with open(f'embeddings_{output_dir}_{query_tag}.pickle', 'rb') as f:
-            cached_embeddings = pickle.load(f)
-    except:
-        pass
-
-    cached_ids = cached_embeddings.keys()
-    print(f' Loaded {len(cached_ids)} cached embeddings for {query_tag}.')
-    #print(f'  Embedding length: {len(list(cached_embeddings.values())[0])}')
-    embedding_size = 768
-
-    # Create an embeddings model for this query instruction
-    embedding_function = HuggingFaceInstructEmbeddings(
-        model_name=model_name,
-        embed_instruction=embed_instruction)
-
-    print(f' Generating embeddings for {len(card_data)} cards ({len(cached_ids)} precached) for {query_tag}: [{str(embed_fields)}]...')
-
-    idx = 0
-    # Generate embeddings for each document and add each document to the DB
-    for card in tqdm(card_data):
-        idx += 1
+    # Load the simple cache from the Pickle file for each query tag. It doubles as the checkpoint of an interrupted build.
+    # The hashes file records which card text each cached embedding was made from, so errata get re-embedded.
+    cache_file = f'embeddings_{output_dir}_{query_tag}.pickle'
+    hashes_file = f'hashes_{output_dir}_{query_tag}.json'
+    cached_embeddings = {} if FORCE_RECALCULATE else read_checkpoint(cache_file)
+    cached_hashes = {} if FORCE_RECALCULATE else read_hashes(hashes_file)
+    if cached_hashes is None and len(cached_embeddings) > 0:
+        # Caches from before content hashing was added are trusted as-is
+        print(f' No hashes found for the cached embeddings of {query_tag}, assuming they are up to date.')
+
+    print(f' Loaded {len(cached_embeddings)} cached embeddings for {query_tag}.')
+
+    # Build a text representation of each card, and hash it
+    documents_by_sfid = {}
+    text_hashes = {}
+    for card in card_data:
         card_id = card['id']
 
-        card_content = ''
-        num_valid_fields = 0
-
-        # Build a text representation of each card
-        # NOTE: Each representation includes a different set of fields, because each axis cares about different things.
-        # NOTE: We are not including the name in any of the representations (except for Vorthos), because the name is not a good indicator of similarity.
-        for field in embed_fields:
-            num_valid_fields += len(get_card_fields(card, field))
-            card_content += get_readable_card_fields(card, field)
+        card_content, num_valid_fields = render_card_text(card, embed_fields)
 
         # If the card fields are empty, skip this card.
         if num_valid_fields == 0:
             print(f'  Skipping card {card_id}: {card["name"]} because it has no fields.')
-            # Ensure that it's removed from the cache and the database
-            if card_id in cached_ids:
-                del cached_embeddings[card_id]
             continue
 
-        card_content = card_content.strip()
-
-        #print(f'  Generating embedding for card {card_id}: {card["name"]}...')
-        #print(f'   {card_content}')
-        #print(f'   ({num_valid_fields} valid fields)')
-        #exit()
-
-        # Check to see if we have a cached embedding for this card
-        if card_id in cached_ids and not FORCE_RECALCULATE:
-            embeddings = cached_embeddings[card_id]
+        documents_by_sfid[card_id] = card_content
+        text_hashes[card_id] = compute_text_hash(model_name, embed_instruction, card_content)
+
+    # Keep cached embeddings only for cards that are still around and whose text did not change
+    for card_id in list(cached_embeddings.keys()):
+        if card_id not in text_hashes or (cached_hashes is not None and cached_hashes.get(card_id) != text_hashes[card_id]):
+            del cached_embeddings[card_id]
+
+    # In incremental mode, reuse every embedding of the previous build whose text hash still matches
+    previous_index = None
+    if previous_dir:
+        previous_hashes = read_hashes(f'hashes_{previous_dir}_{query_tag}.json') or {}
+        previous_store = EmbeddingStore(f'embeddings_{previous_dir}_{query_tag}')
+        previous_index = faiss.read_index(f'faiss_{previous_dir}_{query_tag}.index')
+        previous_keys = read_keys(f'faiss_{previous_dir}_{query_tag}.keys')
+
+        for card_id, previous_hash in previous_hashes.items():
+            if card_id not in cached_embeddings and text_hashes.get(card_id) == previous_hash and card_id in previous_store:
+                cached_embeddings[card_id] = previous_store[card_id]
+        print(f' Reused {len(cached_embeddings)} embeddings from {previous_dir} for {query_tag}.')
+
+    # Anything left over still needs an embedding. Look it up in the shared cache by content first, then embed
+    # each remaining distinct text once, however many cards render to it.
+    documents_by_sfid = {card_id: card_content for card_id, card_content in documents_by_sfid.items() if card_id not in cached_embeddings}
+    cache_keys = {card_id: compute_text_hash(cache_model_name, embed_instruction, card_content) for card_id, card_content in documents_by_sfid.items()}
+    shared_embeddings = {} if embedding_cache is None or FORCE_RECALCULATE else embedding_cache.get_many(set(cache_keys.values()))
+    documents_by_key = {}
+    shared_cache_hits = 0
+    for card_id, key in cache_keys.items():
+        if key in shared_embeddings:
+            cached_embeddings[card_id] = shared_embeddings[key]
+            shared_cache_hits += 1
         else:
-            # Replace all instances of the card name with 'this card' in the card content
-            card_names = card['name'].split(' // ')
-            for card_name in card_names:
-                card_name = card_name.strip()
-                card_content = card_content.replace(card_name, 'this card')
-
-            # Calculate the card content
-            embeddings = embedding_function.embed_documents([card_content])
-
-        # Add it to the cache
-        cached_embeddings[card_id] = np.array(embeddings)
-
-        # Assert that the embeddings are the correct size
-        assert len(embeddings) == embedding_size
-
-    # Create a FAISS index for this query tag of type "IDMap,Flat"
-    tag_collection = faiss.IndexFlatIP(embedding_size)
-        #faiss.IndexIDMap(
-        #)
-
-    # Print stats about the index
-    print(f'  Index stats for {query_tag}:')
-    print(f'   is_trained: {tag_collection.is_trained}')
-    print(f'   ntotal: {tag_collection.ntotal}')
-
-    embeddings = list(cached_embeddings.values())
-    keys = list(cached_embeddings.keys())
-    keys_by_index = {idx: key for idx, key in enumerate(keys)}
-    indices_by_key = {key: idx for idx, key in enumerate(keys)}
-
-    print(f' Embeddings have len {len(embeddings)} and keys have shape {len(keys)}.')
-
-    # Add all of the embeddings to the index
-    embeddings = np.array(embeddings)
-    keys = np.array(keys)
-    print(f' Embeddings have len {len(embeddings)} and keys have shape {len(keys)}.')
-    print(f' Embeddings have shape {embeddings.shape} and keys have shape {keys.shape}.')
-    #tag_collection.add_with_ids(embeddings, keys)
-    tag_collection.add(embeddings)
-
-
-    print(f' {idx} cards added to the DB for {query_tag}.')
+            documents_by_key[key] = documents_by_sfid[card_id]
+    cached_hashes = {card_id: text_hashes[card_id] for card_id in cached_embeddings}
+
+    embeddings_by_key = {}
+    stored_keys = set()
+
+    def write_cache():
+        # Hand every new embedding to all the cards with that text, and add it to the shared cache
+        new_embeddings = {key: embedding for key, embedding in embeddings_by_key.items() if key not in stored_keys}
+        if embedding_cache is not None and new_embeddings:
+            embedding_cache.put_many(new_embeddings)
+        stored_keys.update(new_embeddings)
+        for card_id, key in cache_keys.items():
+            if key in embeddings_by_key:
+                cached_embeddings[card_id] = embeddings_by_key[key]
+
+        for card_id in cached_embeddings:
+            cached_hashes[card_id] = text_hashes[card_id]
+        write_checkpoint(cache_file, cached_embeddings)
+        write_hashes(hashes_file, cached_hashes)
+
+    print(f' Generating embeddings for {len(documents_by_key)} distinct texts of {len(documents_by_sfid) - shared_cache_hits} cards '
+          f'({shared_cache_hits} found in the shared cache) of {len(text_hashes)} cards for {query_tag}: [{str(embed_fields)}]...')
+
+    # Generate embeddings in batches, writing the cache every few batches so a restarted build picks up where it stopped
+    embed_documents(documents_by_key, embeddings_by_key,
+        embedder_type=args.embedder,
+        embed_instruction=embed_instruction,
+        embedder_kwargs={'model_name': model_name},
+        batch_size=args.batch_size,
+        workers=args.workers,
+        executor=args.executor,
+        checkpoint=write_cache,
+        checkpoint_every=args.checkpoint_every,
+        label=query_tag)
+    write_cache()
+
+    build_stats['cards'] += len(documents_by_sfid)
+    build_stats['shared_cache_hits'] += shared_cache_hits
+    build_stats['embedded'] += len(documents_by_key)
+
+    # Assert that the embeddings are the correct size
+    for card_id, embeddings in cached_embeddings.items():
+        cached_embeddings[card_id] = np.asarray(embeddings, dtype=np.float32).reshape(-1)
+        assert len(cached_embeddings[card_id]) == embedding_size
+
+    # Create a FAISS index for this query tag from its factory string (ex: "Flat" is wrapped as "IDMap2,Flat"),
+    # or update the previous one in place. Index types that can't remove vectors (HNSW) are rebuilt from this factory
+    # string instead, so incremental builds should pass the same --index-factory options as the previous build.
+    index_factory = apply_compression(index_factories.get(query_tag, args.index_factory), args.compression)
+    tag_collection = None
+    if previous_index is not None:
+        try:
+            tag_collection, indices_by_keys, update_stats = update_index(previous_index, previous_keys, previous_hashes, cached_embeddings, text_hashes)
+            print(f' Updated index from {previous_dir} for {query_tag}: {update_stats}')
+        except RuntimeError as e:
+            print(f' Could not update the previous index for {query_tag} in place ({e}), rebuilding it.')
+    if tag_collection is None:
+        then = datetime.now()
+        tag_collection, indices_by_keys = build_index(cached_embeddings, embedding_size, index_factory, search_params.get(query_tag, args.search_params))
+        print(f' {len(indices_by_keys)} cards added to the {index_factory} DB for {query_tag} in {datetime.now() - then}.')
 
     print(f'  Index stats for {query_tag}:')
     print(f'   is_trained: {tag_collection.is_trained}')
     print(f'   ntotal: {tag_collection.ntotal}')
 
-    
-    print(f' Writing {len(cached_ids)} embeddings to embeddings_{output_dir}_{query_tag}.pickle...')
+    print(f' Writing {len(cached_embeddings)} embeddings to embeddings_{output_dir}_{query_tag}.pickle...')
 
     # Output the embeddings to pickle for easier debugging and re-use in other indices
-    with open(f'embeddings_{output_dir}_{query_tag}.pickle', 'wb') as f:
-        pickle.dump(cached_embeddings, f)
+    write_cache()
     #with open(f'embeddings_{output_dir}_{query_tag}.json', 'w') as f:
     #    json.dump(cached_embeddings, f, indent=0)
     print(f'  Done writing embeddings for {query_tag}!')
 
+    # Output the same embeddings as a memory-mappable matrix + sfid array for the server
+    print(f' Writing embedding store to embeddings_{output_dir}_{query_tag}.npy...')
+    write_embedding_store(f'embeddings_{output_dir}_{query_tag}', cached_embeddings, dtype=get_embedding_store_dtype(args.compression))
+
     # Save tag_collection to disk
     print(f' Writing index to faiss_{output_dir}_{query_tag}.index...')
     faiss.write_index(tag_collection, f'faiss_{output_dir}_{query_tag}.index')
 
-    # Build a mapping of keys to indices, and save it to disk alongside the FAISS index.
+    # Save the mapping of keys to index ids to disk alongside the FAISS index.
     print(f' Writing keys to faiss_{output_dir}_{query_tag}.keys...')
-    #keys_by_index = {idx: key for idx, key in enumerate(keys)}
-    indices_by_keys = {key: idx for idx, key in enumerate(keys)}
-
-    with open(f'faiss_{output_dir}_{query_tag}.keys', 'w') as f:
-        json.dump(indices_by_keys, f, indent=0)
-
-    continue
-
-    # Test the collection by ensuring that a brute-force search returns the same results as the HNSW search
-    print(f' Testing {query_tag} collection...')
-
-    # Get the first 10 cards
-    test_cards = card_data[:5]
-
-    error_count = 0
-
-    embeddings = cached_embeddings.values()
-        
-
-    for test_card in test_cards:
-        test_card_id = test_card['id']
-        top_k = 4
-
-        print(f'  Testing {test_card_id}...')
-
-        # Get the embeddings for this card
-        test_card_embeddings = cached_embeddings[test_card_id]
-
-        then = datetime.now()
-
-        # Search for the 10 most similar cards using FAISS
-        faiss_dists, faiss_sfids = tag_collection.search(np.array([test_card_embeddings]), top_k)
-        faiss_dists = faiss_dists[0]
-        faiss_sfids = [keys_by_index[idx] for idx in faiss_sfids[0]]
-
-        print(f'  FAISS search took {datetime.now() - then}.')
-
-        # Search for the 10 most similar cards using brute force
-        then = datetime.now()
-
-        #bf_dists = [cosine_similarity(test_card_embeddings, embedding) for embedding in embeddings]
-        bf_dists = [dot_similarity(test_card_embeddings, embedding) for embedding in embeddings]
-
-        # Zip the SFIDs and distances together
-        sfids_and_dists = zip(cached_embeddings.keys(), bf_dists)
-
-        # Sort the SFIDs and distances by distance
-        #sfids_and_dists = sorted(sfids_and_dists, key=lambda x: x[1])
-        sfids_and_dists = sorted(sfids_and_dists, key=lambda x: x[1], reverse=True)
-        
-        bf_sfids = [sfid for sfid, dist in sfids_and_dists[:top_k]]
-        bf_dists = [dist for sfid, dist in sfids_and_dists[:top_k]]
-
-        print(f'  Brute force search took {datetime.now() - then}.')
-
-        print(f' Search results for {test_card_id}:')
-        print(f'  FAISS results:')
-        for faiss_sfid, faiss_dist in zip(faiss_sfids, faiss_dists):
-            print(f'   {faiss_dist}: {faiss_sfid}')
-
-        print(f'  Brute force results:')
-        for bf_sfid, bf_dist in sfids_and_dists[:top_k]:
-            print(f'   {bf_dist}: {bf_sfid}')
-
-        for bf_sfid in bf_sfids:
-            if bf_sfid not in faiss_sfids:
-                print(f'  ERROR: {bf_sfid} not in {faiss_sfids}')
-                error_count += 1
-
-    print(f' {error_count} errors found in {query_tag} collection.')
-
-
-
-        
-
+    write_keys(f'faiss_{output_dir}_{query_tag}.keys', indices_by_keys)
+
+# Of the cards that needed an embedding, how many were served by the shared cache or by another card with the same text
+if embedding_cache is not None:
+    embedding_cache.close()
+saved = build_stats['cards'] - build_stats['embedded']
+dedup_ratio = saved / build_stats['cards'] if build_stats['cards'] else 0.0
+print(f'Embedded {build_stats["embedded"]} distinct texts for {build_stats["cards"]} cards: {saved} model calls saved '
+      f'({build_stats["shared_cache_hits"]} from the shared cache), dedup ratio {dedup_ratio:.1%}')
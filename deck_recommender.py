@@ -0,0 +1,123 @@
+import re
+
+import numpy as np
+
+# "What else belongs in this deck": recommendations for a whole decklist at once.
+# Per axis, the deck is searched either
+#  matrix    with every member as a query: neighbor table rows where available, and one batched FAISS search
+#            for the rest (or for all of them when filtering). A candidate scores the sum of its similarities to
+#            the members that found it (weighted by copies), so cards close to many members rise to the top.
+#  centroid  with the normalized mean of the members' vectors, in a single query whose FAISS ID selector
+#            excludes the deck, so members never take up result slots
+# Deck members are never recommended, and the per-axis rankings are fused with reciprocal rank fusion (RRF).
+
+methods = ['matrix', 'centroid']
+
+# RRF constant, the usual value from the literature. Higher values flatten the difference between ranks.
+rrf_k = 60
+
+# Neighbors fetched per deck member on every axis in matrix mode
+neighbors_per_card = 50
+
+_count_prefix = re.compile(r'^(\d+)x?\s+')
+_set_suffix = re.compile(r'\s+\([A-Za-z0-9]+\)(\s+\S+)?(\s+\*F\*)?$')
+_section_headers = {'deck', 'commander', 'companion', 'sideboard', 'maybeboard', 'mainboard'}
+
+
+def parse_decklist(text):
+    # Parses the usual decklist export formats into (count, name) pairs, ex:
+    #  '1 Sol Ring', '4x Lightning Bolt', '1 Arcane Signet (CMR) 297', 'Counterspell'
+    # Blank lines, comments and section headers ('Commander', 'Deck', 'Sideboard', ...) are skipped.
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith('//') or line.startswith('#') or line.lower().rstrip(':') in _section_headers:
+            continue
+        count = 1
+        match = _count_prefix.match(line)
+        if match:
+            count = int(match.group(1))
+            line = line[match.end():]
+        line = _set_suffix.sub('', line).strip()
+        if line:
+            entries.append((count, line))
+    return entries
+
+
+def resolve_deck(entries, cards_by_sfid, name_index):
+    # Turns (count, sfid or name) pairs into ({sfid: count}, [unresolved names])
+    counts_by_sfid = {}
+    unresolved = []
+    for count, card in entries:
+        sfid = card if card in cards_by_sfid else name_index.find(card)
+        if sfid is None:
+            unresolved.append(card)
+        else:
+            counts_by_sfid[sfid] = counts_by_sfid.get(sfid, 0) + count
+    return counts_by_sfid, unresolved
+
+
+def score_axis_matrix(search_engine, axis, deck_sfids, weights, candidate_mask, num_candidates, filtered):
+    # The neighbors of every deck member, aggregated into one score per candidate position.
+    # Unfiltered searches can use the (unfiltered) neighbor tables, and drop the deck members afterwards.
+    positions, scores = search_engine.search_axis_many(axis, deck_sfids, num_candidates, candidate_mask if filtered else None)
+
+    valid = positions >= 0
+    valid[valid] = candidate_mask[positions[valid]]
+    weighted = (scores * weights[:, None])[valid]
+    totals = np.bincount(positions[valid], weights=weighted, minlength=len(search_engine.sfids))
+    candidates = np.nonzero(totals)[0]
+    return candidates, totals[candidates]
+
+
+def score_axis_centroid(search_engine, axis, deck_sfids, weights, candidate_mask, num_candidates, filtered):
+    # One search with the (count-weighted) mean direction of the deck
+    members = [row for row, sfid in enumerate(deck_sfids) if sfid in search_engine.faiss_indices_by_key[axis]]
+    if len(members) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+    vectors = search_engine.get_query_vectors(axis, [deck_sfids[row] for row in members])
+    centroid = (vectors * weights[members][:, None]).sum(axis=0, keepdims=True)
+    centroid /= max(np.linalg.norm(centroid), 1e-12)
+    positions, scores = search_engine.search_vector(axis, centroid.astype(np.float32), num_candidates, candidate_mask)
+    valid = positions >= 0
+    return positions[valid], scores[valid]
+
+
+def recommend(search_engine, counts_by_sfid, num_results=50, method='matrix', axes=None, card_mask=None):
+    # Returns a fused ranking of (sfid, score, axis) tuples of cards not in the deck.
+    # score is the RRF score over the axes, and axis is the axis that ranked the card highest.
+    if method not in methods:
+        raise ValueError(f'Unknown method: {method} (expected one of {methods})')
+    axes = search_engine.get_axes(axes)
+    deck_sfids = list(counts_by_sfid.keys())
+    weights = np.array([counts_by_sfid[sfid] for sfid in deck_sfids], dtype=np.float32)
+    if len(deck_sfids) == 0:
+        return []
+
+    # Everything allowed by the filters, minus the deck itself
+    candidate_mask = np.ones(len(search_engine.sfids), dtype=bool) if card_mask is None else card_mask.copy()
+    candidate_mask[[search_engine.positions_by_sfid[sfid] for sfid in deck_sfids if sfid in search_engine.positions_by_sfid]] = False
+
+    if method == 'matrix':
+        score_axis, num_candidates = score_axis_matrix, neighbors_per_card
+    else:
+        score_axis, num_candidates = score_axis_centroid, max(num_results * 2, neighbors_per_card)
+
+    fused = np.zeros(len(search_engine.sfids), dtype=np.float64)
+    best_rank = np.full(len(search_engine.sfids), np.iinfo(np.int64).max, dtype=np.int64)
+    best_axis = np.full(len(search_engine.sfids), -1, dtype=np.int64)
+    for axis in axes:
+        candidates, scores = score_axis(search_engine, axis, deck_sfids, weights, candidate_mask, num_candidates, card_mask is not None)
+        ranked = candidates[np.argsort(-scores, kind='stable')]
+        ranks = np.arange(len(ranked))
+        fused[ranked] += 1.0 / (rrf_k + 1 + ranks)
+
+        better = ranks < best_rank[ranked]
+        best_rank[ranked[better]] = ranks[better]
+        best_axis[ranked[better]] = search_engine.axis_numbers[axis]
+
+    candidates = np.nonzero(fused)[0]
+    order = np.lexsort((best_rank[candidates], -fused[candidates]))[:num_results]
+    return [(search_engine.sfids[position], float(fused[position]), search_engine.all_axes[best_axis[position]])
+            for position in candidates[order].tolist()]
@@ -1,42 +1,151 @@
 # Download content from https://api.scryfall.com/symbology and store symbol SVGs in the appropriate folder in static/symbols
+# static/symbols.json maps every downloaded symbol to its file ({"{W}": "W.svg", ...}), and is read by symbols.py.
+#
+# Files are fetched concurrently, with a timeout and retries. The ETag and sha256 of every file are kept in
+# static/symbols/manifest.json, so later runs send conditional requests (If-None-Match) and skip unchanged files,
+# and a run that was interrupted picks up where it stopped.
+#
+# ex: python download_static_resources.py
+#     python download_static_resources.py --symbology-url http://127.0.0.1:8001/symbology   (a local stand-in server)
 
-import requests
+import argparse
+import hashlib
 import json
 import os
-import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+symbology_url = 'https://api.scryfall.com/symbology'
+
+# Scryfall asks API clients to identify themselves
+request_headers = {'User-Agent': 'MtgMatrix/1.0', 'Accept': 'application/json;q=0.9,*/*;q=0.8'}
+
+# Statuses worth retrying, the others fail right away
+retry_statuses = {429, 500, 502, 503, 504}
+
+# The manifest is written every this many files, so an interrupted run loses little
+manifest_write_interval = 20
+
+_sessions = threading.local()
+
+
+def get_session():
+    # One requests.Session (and connection pool) per thread
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+        session.headers.update(request_headers)
+    return session
+
+
+def get_with_retries(url, headers=None, timeout=10, retries=3, backoff=0.5):
+    for attempt in range(retries + 1):
+        try:
+            response = get_session().get(url, headers=headers, timeout=timeout)
+            if response.status_code not in retry_statuses or attempt == retries:
+                response.raise_for_status()
+                return response
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+
+
+def read_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def write_json(data, filename):
+    # Write to a temporary file first, so an interrupted run never leaves a half-written file behind
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, filename)
+
+
+def download_file(url, filename, entry=None, timeout=10, retries=3):
+    # Returns (status, manifest entry), status is 'downloaded', 'unchanged' or 'not_modified'
+    entry = entry if entry and os.path.exists(filename) else None
+    headers = {'If-None-Match': entry['etag']} if entry and entry.get('etag') else None
+    response = get_with_retries(url, headers, timeout, retries)
+    if response.status_code == 304:
+        return 'not_modified', entry
+
+    sha256 = hashlib.sha256(response.content).hexdigest()
+    new_entry = {'url': url, 'etag': response.headers.get('ETag'), 'sha256': sha256}
+    if entry and entry.get('sha256') == sha256:
+        # Same content under a new ETag
+        return 'unchanged', new_entry
+
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(response.content)
+    os.replace(tmp_file, filename)
+    return 'downloaded', new_entry
+
+
+def download_symbols(url=symbology_url, static_dir='./static', max_workers=8, timeout=10, retries=3):
+    # Returns the number of files by status
+    symbols_dir = f'{static_dir}/symbols'
+    os.makedirs(symbols_dir, exist_ok=True)
+    manifest_file = f'{symbols_dir}/manifest.json'
+    manifest = read_manifest(manifest_file)
+
+    # Get the list of symbols
+    symbols = get_with_retries(url, timeout=timeout, retries=retries).json()['data']
 
-# Create the ./static/symbols folder if it doesn't exist
-if not os.path.exists('./static/symbols'):
-    os.mkdir('./static/symbols')
+    # Get the clean name from the symbol_uri, ex: https://svgs.scryfall.io/card-symbols/WU.svg -> WU.svg
+    symbol_dict = {symbol['symbol']: symbol['svg_uri'].split('/')[-1] for symbol in symbols if symbol.get('svg_uri')}
+    uris = {symbol['svg_uri'].split('/')[-1]: symbol['svg_uri'] for symbol in symbols if symbol.get('svg_uri')}
 
-# Get the list of symbols
-r = requests.get('https://api.scryfall.com/symbology')
+    counts = {'downloaded': 0, 'unchanged': 0, 'not_modified': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_file, uri, f'{symbols_dir}/{clean_name}', manifest.get(clean_name), timeout, retries): clean_name
+                   for clean_name, uri in uris.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            clean_name = futures[future]
+            try:
+                status, entry = future.result()
+            except requests.RequestException as e:
+                print(f'Failed to download {uris[clean_name]}: {e}')
+                counts['failed'] += 1
+                continue
+            manifest[clean_name] = entry
+            counts[status] += 1
+            if status == 'downloaded':
+                print(f'Downloaded {uris[clean_name]} to {symbols_dir}/{clean_name}')
+            if done % manifest_write_interval == 0:
+                write_json(manifest, manifest_file)
 
-# Load the list of symbols
-symbols = json.loads(r.content)['data']
+    write_json(manifest, manifest_file)
 
-symbol_dict = {}
+    # Save the symbol_dict to static/symbols.json, leaving out the symbols whose file failed to download (and isn't
+    # there from an earlier run), so they are rendered as text instead of as broken images
+    symbol_dict = {symbol: clean_name for symbol, clean_name in symbol_dict.items() if os.path.exists(f'{symbols_dir}/{clean_name}')}
+    write_json(symbol_dict, f'{static_dir}/symbols.json')
+    return counts
 
-# For each symbol, download the svg_uri and save it to the appropriate folder
-for symbol in symbols:
-    # Get the symbol name
-    symbol_name = symbol['symbol']
-    # Get the symbol SVG URI
-    symbol_uri = symbol['svg_uri']
-    # Get the symbol SVG
-    r = requests.get(symbol_uri)
 
-    # Get the clean name from the symbol_uri
-    clean_name = symbol_uri.split('/')[-1]
+def main():
+    parser = argparse.ArgumentParser(description='Download the Scryfall mana symbols into static/symbols')
+    parser.add_argument('--symbology-url', default=symbology_url)
+    parser.add_argument('--static-dir', default='./static')
+    parser.add_argument('--max-workers', type=int, default=8, help='Concurrent downloads')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds per request')
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args()
 
-    # Save the symbol SVG to the appropriate folder
-    with open(f'static/symbols/{clean_name}', 'wb') as f:
-        f.write(r.content)
-    print(f'Downloaded symbol "{symbol_name}" to static/symbols/{clean_name}')
+    then = time.perf_counter()
+    counts = download_symbols(args.symbology_url, args.static_dir, args.max_workers, args.timeout, args.retries)
+    print(f'{counts["downloaded"]} downloaded, {counts["unchanged"] + counts["not_modified"]} unchanged, '
+          f'{counts["failed"]} failed in {time.perf_counter() - then:.1f}s')
 
-    # Add the symbol to the symbol_dict
-    symbol_dict[symbol_name] = clean_name
 
-# Save the symbol_dict to static/symbols.json
-with open('static/symbols.json', 'w') as f:
-    json.dump(symbol_dict, f, indent=2)
+if __name__ == '__main__':
+    main()
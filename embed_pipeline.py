@@ -0,0 +1,110 @@
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+from embedders import create_embedder
+
+# Batched, parallel embedding generation used by data/create_db.py.
+# Documents are split into model-sized batches and spread across a pool of threads or processes.
+# Every worker builds its own embedder once and reuses it for all of its batches.
+# Results are handed back to the caller every checkpoint_every batches, so a crashed build can resume.
+
+executor_types = ['serial', 'thread', 'process']
+
+# One embedder per worker thread (or per worker process, where the main thread is the only thread)
+_worker_state = threading.local()
+
+
+def _get_worker_embedder(embedder_spec):
+    if getattr(_worker_state, 'embedder_spec', None) != embedder_spec:
+        embedder_type, embed_instruction, embedder_kwargs = embedder_spec
+        _worker_state.embedder = create_embedder(embedder_type, embed_instruction, **dict(embedder_kwargs))
+        _worker_state.embedder_spec = embedder_spec
+    return _worker_state.embedder
+
+
+def _embed_batch(embedder_spec, batch_sfids, batch_documents):
+    embeddings = _get_worker_embedder(embedder_spec).embed_documents(batch_documents)
+    return batch_sfids, np.asarray(embeddings, dtype=np.float32)
+
+
+def iter_batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def read_checkpoint(checkpoint_file):
+    # Returns the {sfid: embedding} dict saved by write_checkpoint, or an empty dict
+    try:
+        with open(checkpoint_file, 'rb') as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def write_checkpoint(checkpoint_file, embeddings_by_sfid):
+    # Write to a temporary file first so a crash in the middle of a checkpoint never corrupts the previous one
+    tmp_file = f'{checkpoint_file}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(embeddings_by_sfid, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, checkpoint_file)
+
+
+def embed_documents(documents_by_sfid, embeddings_by_sfid, embedder_type, embed_instruction, embedder_kwargs=None,
+                    batch_size=32, workers=1, executor='thread', checkpoint=None, checkpoint_every=10, label=''):
+    # documents_by_sfid: {sfid: text} of the documents that still need embeddings
+    # embeddings_by_sfid: output dict, updated in place as batches complete
+    # checkpoint: optional callable, called every checkpoint_every batches and once at the end
+    if executor not in executor_types:
+        raise ValueError(f'Unknown executor type: {executor} (expected one of {executor_types})')
+
+    embedder_spec = (embedder_type, embed_instruction, tuple(sorted((embedder_kwargs or {}).items())))
+    sfids = list(documents_by_sfid.keys())
+    batches = [(batch, [documents_by_sfid[sfid] for sfid in batch]) for batch in iter_batches(sfids, batch_size)]
+
+    then = time.perf_counter()
+    completed_batches = 0
+    progress = tqdm(total=len(sfids), desc=label or None, unit='cards')
+
+    def add_results(batch_sfids, embeddings):
+        nonlocal completed_batches
+        if len(embeddings) != len(batch_sfids):
+            raise ValueError(f'Embedder returned {len(embeddings)} embeddings for {len(batch_sfids)} documents')
+        for sfid, embedding in zip(batch_sfids, embeddings):
+            embeddings_by_sfid[sfid] = embedding
+        completed_batches += 1
+        progress.update(len(batch_sfids))
+        if checkpoint is not None and completed_batches % checkpoint_every == 0:
+            checkpoint()
+
+    try:
+        if executor == 'serial' or (executor == 'thread' and workers <= 1):
+            for batch_sfids, batch_documents in batches:
+                add_results(*_embed_batch(embedder_spec, batch_sfids, batch_documents))
+        else:
+            pool_type = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+            with pool_type(max_workers=workers) as pool:
+                futures = [pool.submit(_embed_batch, embedder_spec, batch_sfids, batch_documents) for batch_sfids, batch_documents in batches]
+                for future in as_completed(futures):
+                    add_results(*future.result())
+    finally:
+        progress.close()
+        # Save whatever finished, even if a batch failed
+        if checkpoint is not None and completed_batches > 0:
+            checkpoint()
+
+    seconds = time.perf_counter() - then
+    stats = {
+        'documents': len(sfids),
+        'batches': len(batches),
+        'seconds': seconds,
+        'cards_per_second': len(sfids) / seconds if seconds > 0 else 0.0,
+    }
+    print(f'  Embedded {stats["documents"]} cards in {stats["batches"]} batches in {seconds:.1f}s ({stats["cards_per_second"]:.1f} cards/s) {label}')
+
+    return stats
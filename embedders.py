@@ -0,0 +1,71 @@
+import hashlib
+import time
+
+import numpy as np
+
+# Embedding backends. Every embedder takes a list of documents and returns a float32 matrix with one row per document.
+#  instructor: the INSTRUCTOR model via Langchain (what the real indices are built with)
+#  stub:       deterministic pseudo-random unit vectors derived from the text, for benchmarks and offline runs
+
+model_name = 'hkunlp/instructor-large'
+embedding_size = 768
+
+
+class InstructorEmbedder:
+    def __init__(self, embed_instruction, model_name=model_name, **kwargs):
+        # Imported here so the rest of the pipeline (and the stub embedder) works without langchain installed
+        from langchain.embeddings import HuggingFaceInstructEmbeddings
+
+        self.model_name = model_name
+        self.embed_instruction = embed_instruction
+        self.embedding_function = HuggingFaceInstructEmbeddings(
+            model_name=model_name,
+            embed_instruction=embed_instruction,
+            **kwargs)
+
+    def set_instruction(self, embed_instruction):
+        # Switches the instruction without reloading the model
+        self.embed_instruction = embed_instruction
+        self.embedding_function.embed_instruction = embed_instruction
+
+    def embed_documents(self, documents):
+        return np.asarray(self.embedding_function.embed_documents(list(documents)), dtype=np.float32)
+
+
+class StubEmbedder:
+    # delay_per_batch and delay_per_document simulate the cost of a real model call
+    def __init__(self, embed_instruction='', model_name='stub', dimension=embedding_size, delay_per_batch=0.0, delay_per_document=0.0):
+        self.model_name = model_name
+        self.embed_instruction = embed_instruction
+        self.dimension = dimension
+        self.delay_per_batch = delay_per_batch
+        self.delay_per_document = delay_per_document
+
+    def set_instruction(self, embed_instruction):
+        self.embed_instruction = embed_instruction
+
+    def embed_document(self, document):
+        digest = hashlib.sha256(f'{self.embed_instruction}{document}'.encode('utf-8')).digest()
+        rng = np.random.default_rng(int.from_bytes(digest[:8], 'little'))
+        embedding = rng.standard_normal(self.dimension).astype(np.float32)
+        return embedding / np.linalg.norm(embedding)
+
+    def embed_documents(self, documents):
+        documents = list(documents)
+        if self.delay_per_batch or self.delay_per_document:
+            time.sleep(self.delay_per_batch + self.delay_per_document * len(documents))
+        if len(documents) == 0:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.stack([self.embed_document(document) for document in documents])
+
+
+embedder_types = {
+    'instructor': InstructorEmbedder,
+    'stub': StubEmbedder,
+}
+
+
+def create_embedder(embedder_type, embed_instruction, **kwargs):
+    if embedder_type not in embedder_types:
+        raise ValueError(f'Unknown embedder type: {embedder_type} (expected one of {list(embedder_types.keys())})')
+    return embedder_types[embedder_type](embed_instruction, **kwargs)
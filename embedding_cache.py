@@ -0,0 +1,48 @@
+import sqlite3
+
+import numpy as np
+
+# Content-addressed embedding cache shared by every axis and every build (see data/create_db.py).
+# Embeddings are keyed by index_builder.compute_text_hash(model, instruction, rendered text), so a text is embedded
+# once no matter how many cards render to it (reprints, vanilla creatures), which axes share its instruction,
+# or which bulk file it came from. Stored in one SQLite file, ex: data/embedding_cache.sqlite
+#  embeddings(key TEXT PRIMARY KEY, dimension INTEGER, vector BLOB)  vector is the float32 bytes of the embedding
+
+# SQLite limits the number of parameters of a query, so lookups go in chunks
+lookup_chunk_size = 500
+
+
+class EmbeddingCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        # Writes of an interrupted build are kept, and readers (another build) don't block on writers
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dimension INTEGER NOT NULL, vector BLOB NOT NULL)')
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get_many(self, keys):
+        # Returns {key: float32 embedding} for the keys that are cached
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), lookup_chunk_size):
+            chunk = keys[start:start + lookup_chunk_size]
+            rows = self.connection.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, embeddings_by_key):
+        rows = []
+        for key, embedding in embeddings_by_key.items():
+            embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+            rows.append((key, len(embedding), embedding.tobytes()))
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO embeddings (key, dimension, vector) VALUES (?, ?, ?)', rows)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,177 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from card_text import get_query_instruction
+from embedders import create_embedder
+
+# In-process embedding of query text at request time, for the theoretical card search.
+# A single background thread owns the embedder (the model is loaded once, and warmed up before the first request),
+# and groups the requests that arrive within max_wait seconds into micro-batches, one model call per axis
+# (the axes share the model, and only differ by instruction).
+# Embeddings are kept in an LRU cache keyed by (axis, normalized text), and identical requests that are
+# already in flight share one future instead of being embedded twice.
+
+
+def normalize_query_text(text):
+    # Whitespace differences don't change the meaning of a card, so they shouldn't miss the cache
+    return '\n'.join(' '.join(line.split()) for line in text.strip().splitlines() if line.strip())
+
+
+class EmbeddingService:
+    def __init__(self, axes, embedder_type='instructor', embedder_kwargs=None, max_batch_size=32, max_wait=0.005, cache_size=4096):
+        self.axes = list(axes)
+        self.embedder_type = embedder_type
+        self.embedder_kwargs = embedder_kwargs or {}
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+
+        self.cache = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_texts = 0
+
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        # Threads do not survive a fork, so every (gunicorn) worker process starts its own, at boot or on first use
+        with self.lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._ready = threading.Event()
+            self._error = None
+            self.in_flight = {}
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='embedding-service', daemon=True)
+            self._thread.start()
+
+    def wait_until_ready(self, timeout=None):
+        # Blocks until the model is loaded and warmed up. Raises if loading failed.
+        self.start()
+        if not self._ready.wait(timeout):
+            return False
+        if self._error is not None:
+            raise RuntimeError(f'Embedding service failed to start: {self._error}')
+        return True
+
+    def embed(self, axis, text, timeout=30):
+        # Returns the float32 query embedding of text for one axis
+        return self.submit(axis, text).result(timeout)
+
+    def submit(self, axis, text):
+        # Returns a future for the embedding of text on one axis
+        if axis not in self.axes:
+            raise ValueError(f'Unknown axis: {axis} (expected one of {self.axes})')
+        key = (axis, normalize_query_text(text))
+
+        self.start()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(self.cache[key])
+                return future
+            self.misses += 1
+            if key in self.in_flight:
+                return self.in_flight[key]
+            future = Future()
+            self.in_flight[key] = future
+
+        self._queue.put(key)
+        return future
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'cache_size': len(self.cache),
+                'batches': self.batches,
+                'mean_batch_size': self.batched_texts / self.batches if self.batches else 0.0,
+                'ready': self._ready.is_set() and self._error is None,
+            }
+
+    def _load(self):
+        # Warmed up with one call, so the first request doesn't pay for lazy initialization.
+        # embedder_kwargs can be a function, for settings that are only known once the indices are loaded.
+        embed_instruction, _ = get_query_instruction(self.axes[0])
+        embedder_kwargs = self.embedder_kwargs() if callable(self.embedder_kwargs) else self.embedder_kwargs
+        embedder = create_embedder(self.embedder_type, embed_instruction, **embedder_kwargs)
+        embedder.embed_documents(['warm-up'])
+        return embedder
+
+    def _next_batch(self):
+        # Blocks for the first request, then collects whatever else arrives within max_wait
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _finish(self, key, embedding=None, error=None):
+        with self.lock:
+            future = self.in_flight.pop(key, None)
+            if error is None:
+                self.cache[key] = embedding
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        if future is not None:
+            if error is None:
+                future.set_result(embedding)
+            else:
+                future.set_exception(error)
+
+    def _run(self):
+        try:
+            embedder = self._load()
+        except Exception as e:
+            self._error = e
+            embedder = None
+        self._ready.set()
+
+        while True:
+            batch = self._next_batch()
+            if embedder is None:
+                for key in batch:
+                    self._finish(key, error=RuntimeError(f'Embedding service failed to start: {self._error}'))
+                continue
+
+            texts_by_axis = {}
+            for axis, text in batch:
+                texts_by_axis.setdefault(axis, []).append(text)
+
+            for axis, texts in texts_by_axis.items():
+                try:
+                    embedder.set_instruction(get_query_instruction(axis)[0])
+                    embeddings = embedder.embed_documents(texts)
+                except Exception as e:
+                    for text in texts:
+                        self._finish((axis, text), error=e)
+                    continue
+                with self.lock:
+                    self.batches += 1
+                    self.batched_texts += len(texts)
+                for text, embedding in zip(texts, embeddings):
+                    self._finish((axis, text), embedding)
@@ -0,0 +1,121 @@
+import os
+import pickle
+import sys
+
+import numpy as np
+
+# On-disk embedding store: one contiguous float matrix per axis plus an aligned array of sfids.
+#  {prefix}.npy        float32 (or float16) matrix, one row per card
+#  {prefix}.sfids.npy  fixed-width unicode array of sfids, sorted, row i of the matrix belongs to sfids[i]
+# Both files are opened with mmap, so every gunicorn worker shares the same page cache instead of
+# unpickling its own dict of numpy arrays. Because the sfids are sorted, lookups are a binary search
+# over the mapped array and nothing has to be deserialized on open.
+
+
+def get_embedding_store_prefix(db_dir, data_file, tag):
+    # ex: ./data/embeddings_oracle-cards-20231113220154_db_dupe2
+    return f'{db_dir}/embeddings_{data_file}_db_{tag}'
+
+
+def embedding_store_exists(prefix):
+    return os.path.exists(f'{prefix}.npy') and os.path.exists(f'{prefix}.sfids.npy')
+
+
+def _save_npy(filename, array):
+    # Write to a temporary file first so readers never see a half-written matrix
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_file, filename)
+
+
+def write_embedding_store(prefix, embeddings_by_sfid, dtype=np.float32):
+    sfids = sorted(embeddings_by_sfid.keys())
+    if len(sfids) == 0:
+        raise ValueError(f'No embeddings to write to {prefix}')
+
+    # Old pickles hold arrays of shape (1, N), so flatten every row
+    matrix = np.stack([np.asarray(embeddings_by_sfid[sfid], dtype=np.float32).reshape(-1) for sfid in sfids])
+
+    _save_npy(f'{prefix}.npy', np.ascontiguousarray(matrix, dtype=dtype))
+    _save_npy(f'{prefix}.sfids.npy', np.array(sfids, dtype='U36'))
+
+    return len(sfids)
+
+
+class EmbeddingStore:
+    def __init__(self, prefix, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        self.prefix = prefix
+        self.matrix = np.load(f'{prefix}.npy', mmap_mode=mmap_mode)
+        self.sfids = np.load(f'{prefix}.sfids.npy', mmap_mode=mmap_mode)
+
+        if self.matrix.shape[0] != self.sfids.shape[0]:
+            raise ValueError(f'{prefix}: {self.matrix.shape[0]} embeddings but {self.sfids.shape[0]} sfids')
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __contains__(self, sfid):
+        return self.index_of(sfid) >= 0
+
+    def __getitem__(self, sfid):
+        row = self.index_of(sfid)
+        if row < 0:
+            raise KeyError(sfid)
+        return self.row(row)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def index_of(self, sfid):
+        row = int(np.searchsorted(self.sfids, sfid))
+        if row < len(self.sfids) and self.sfids[row] == sfid:
+            return row
+        return -1
+
+    def indices_of(self, sfids):
+        # Vectorized lookup of many sfids at once, -1 for unknown sfids
+        sfids = np.asarray(sfids, dtype=self.sfids.dtype)
+        rows = np.searchsorted(self.sfids, sfids)
+        rows = np.minimum(rows, len(self.sfids) - 1)
+        return np.where(self.sfids[rows] == sfids, rows, -1)
+
+    def row(self, row):
+        # Always hand out float32, even when the matrix is stored in reduced precision
+        return np.asarray(self.matrix[row], dtype=np.float32)
+
+    def get(self, sfid, default=None):
+        row = self.index_of(sfid)
+        if row < 0:
+            return default
+        return self.row(row)
+
+    def get_many(self, sfids):
+        # Returns (matrix, found) where found is a boolean mask of which sfids were in the store
+        rows = self.indices_of(sfids)
+        found = rows >= 0
+        return np.asarray(self.matrix[rows[found]], dtype=np.float32), found
+
+    def slice(self, start, stop):
+        return np.asarray(self.matrix[start:stop], dtype=np.float32)
+
+
+def convert_pickle(pickle_file, prefix):
+    # Convert one of the old embeddings_*.pickle dicts into an embedding store
+    with open(pickle_file, 'rb') as f:
+        embeddings_by_sfid = pickle.load(f)
+    count = write_embedding_store(prefix, embeddings_by_sfid)
+    print(f'Wrote {count} embeddings from {pickle_file} to {prefix}.npy')
+
+
+if __name__ == '__main__':
+    # ex: python embedding_store.py ./data/embeddings_oracle-cards-20231113220154_db_dupe2.pickle
+    if len(sys.argv) < 2:
+        print(f'Usage: {sys.argv[0]} <embeddings.pickle> [<output prefix>]')
+        sys.exit(1)
+
+    pickle_file = sys.argv[1]
+    prefix = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(pickle_file)[0]
+    convert_pickle(pickle_file, prefix)
@@ -0,0 +1,207 @@
+# Scores the indices against the hand-labelled groups of related cards in test.py (similar_cards).
+# Every labelled card is a query, and the other cards of its group are what it should find. For every axis
+# (and 'all', the merged search the site shows) the related cards of all queries are fetched in one batched search,
+# and recall@k, MRR and nDCG@k are computed with NumPy, per axis and per group. Search times are reported
+# alongside, so index configurations (--index-compression, --mmap, other builds via MTGMATRIX_DB_DIR) can be
+# compared on quality and speed.
+# Unfiltered searches are answered from the precomputed neighbor tables when an axis has one, which would hide the
+# index settings, so the tables are dropped when --index-compression or --mmap is given (or with --no-neighbor-tables).
+# The source that answered every axis (table or faiss) is reported with the scores.
+#
+# ex: python evaluate.py
+#     python evaluate.py --axes similar,spike --k 10,50 --by-group --json eval.json
+#     python evaluate.py --index-compression sq8
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from card_loader import load_cards
+from index_loader import IndexLoader
+from name_index import NameIndex
+from search_engine import SearchEngine
+
+# Same defaults (and environment overrides) as app.py
+default_data_file = os.environ.get('MTGMATRIX_DATA_FILE', 'oracle-cards-20231113220154')
+default_db_dir = os.environ.get('MTGMATRIX_DB_DIR', './data')
+default_axes = ['similar', 'dupe2', 'spike', 'melvin', 'timmy']
+
+# The merged search over every evaluated axis
+merged_axis = 'all'
+
+
+def resolve_groups(similar_cards, name_index):
+    # Returns (groups, missing names). Every group is {'label', 'sfids'}, ex: label '1.2 Flame Rift'
+    # (category 1, group 2, named after its first card). Groups with fewer than two known cards can't be scored.
+    groups = []
+    missing = []
+    for category_number, category in enumerate(similar_cards):
+        for group_number, names in enumerate(category):
+            sfids = []
+            for name in names:
+                sfid = name_index.find(name)
+                if sfid is None:
+                    missing.append(name)
+                elif sfid not in sfids:
+                    sfids.append(sfid)
+            if len(sfids) >= 2:
+                groups.append({'label': f'{category_number}.{group_number} {names[0]}', 'sfids': sfids})
+    return groups, missing
+
+
+def rank_without_queries(positions, query_positions, k):
+    # Drops every query's own hit from its row, keeping the first k of the rest in order (-1 padded)
+    keep = (positions >= 0) & (positions != query_positions[:, None])
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :k]
+    ranked = np.take_along_axis(positions, order, axis=1)
+    ranked[~np.take_along_axis(keep, order, axis=1)] = -1
+    return ranked
+
+
+def score_rankings(ranked, membership, pair_queries, pair_groups, num_relevant, ks):
+    # ranked: (queries, depth) positions. membership: (groups, cards) bool.
+    # Every (query, group) pair is scored on its own; returns {metric: per-pair values}.
+    rows = ranked[pair_queries]
+    relevant = membership[pair_groups[:, None], np.maximum(rows, 0)] & (rows >= 0)
+
+    scores = {}
+    # Reciprocal rank of the first relevant card, 0 if there is none in the ranking
+    first = np.argmax(relevant, axis=1)
+    scores['mrr'] = np.where(relevant.any(axis=1), 1.0 / (first + 1), 0.0)
+
+    discounts = 1.0 / np.log2(np.arange(2, ranked.shape[1] + 2))
+    cumulative_discounts = np.concatenate([[0.0], np.cumsum(discounts)])
+    for k in ks:
+        hits = relevant[:, :k]
+        scores[f'recall@{k}'] = hits.sum(axis=1) / num_relevant
+        ideal = cumulative_discounts[np.minimum(num_relevant, k).astype(np.int64)]
+        scores[f'ndcg@{k}'] = (hits * discounts[:k]).sum(axis=1) / ideal
+    return scores
+
+
+def get_source(search_engine, axes):
+    # What answers the unfiltered searches of these axes: 'table', 'faiss', or both ('table+faiss')
+    return '+'.join(sorted({'table' if axis in search_engine.neighbor_tables else 'faiss' for axis in axes}, reverse=True))
+
+
+def evaluate(search_engine, groups, axes, ks):
+    # Returns {'axes': {axis: {metric: mean, 'seconds', 'queries_per_second', 'source'}}, 'groups': {axis: {label: {metric: mean}}}}
+    depth = max(ks)
+    query_sfids = sorted({sfid for group in groups for sfid in group['sfids']})
+    rows_by_sfid = {sfid: row for row, sfid in enumerate(query_sfids)}
+    query_positions = np.array([search_engine.positions_by_sfid[sfid] for sfid in query_sfids], dtype=np.int64)
+
+    membership = np.zeros((len(groups), len(search_engine.sfids)), dtype=bool)
+    pair_queries = []
+    pair_groups = []
+    for group_number, group in enumerate(groups):
+        membership[group_number, [search_engine.positions_by_sfid[sfid] for sfid in group['sfids']]] = True
+        pair_queries += [rows_by_sfid[sfid] for sfid in group['sfids']]
+        pair_groups += [group_number] * len(group['sfids'])
+    pair_queries = np.array(pair_queries, dtype=np.int64)
+    pair_groups = np.array(pair_groups, dtype=np.int64)
+    # The query itself is never in its own ranking
+    num_relevant = np.array([len(groups[group_number]['sfids']) - 1 for group_number in pair_groups], dtype=np.float64)
+    group_sizes = np.bincount(pair_groups, minlength=len(groups))
+
+    results = {'axes': {}, 'groups': {}}
+    for axis in axes + [merged_axis]:
+        then = time.perf_counter()
+        if axis == merged_axis:
+            positions = np.full((len(query_sfids), depth + 1), -1, dtype=np.int64)
+            for row, ranking in enumerate(search_engine.search_many(query_sfids, depth + 1, axes=axes)):
+                ranking_positions = [search_engine.positions_by_sfid[sfid] for sfid, _, _ in ranking[:depth + 1]]
+                positions[row, :len(ranking_positions)] = ranking_positions
+        else:
+            positions, _ = search_engine.search_axis_many(axis, query_sfids, depth + 1)
+        seconds = time.perf_counter() - then
+
+        scores = score_rankings(rank_without_queries(positions, query_positions, depth), membership, pair_queries, pair_groups, num_relevant, ks)
+        results['axes'][axis] = {metric: float(values.mean()) for metric, values in scores.items()}
+        results['axes'][axis].update(seconds=seconds, queries_per_second=len(query_sfids) / seconds if seconds > 0 else 0.0,
+                                     source=get_source(search_engine, axes if axis == merged_axis else [axis]))
+
+        # Per-group means, one bincount per metric
+        means = {metric: np.bincount(pair_groups, weights=values, minlength=len(groups)) / group_sizes for metric, values in scores.items()}
+        results['groups'][axis] = {group['label']: {metric: float(means[metric][group_number]) for metric in scores}
+                                   for group_number, group in enumerate(groups)}
+    return results
+
+
+def print_table(title, rows, metrics, extra=None):
+    # rows: [(name, {metric: value})]
+    width = max([len(title)] + [len(name) for name, _ in rows])
+    extra = extra or []
+    print(f'{title:<{width}}  ' + '  '.join(f'{metric:>10}' for metric in metrics + extra))
+    for name, values in rows:
+        print(f'{name:<{width}}  ' + '  '.join(f'{values[metric]:10.3f}' if metric in metrics else f'{values[metric]:10.1f}' for metric in metrics + extra))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score every axis against the labelled groups of related cards in test.py')
+    parser.add_argument('--data-file', default=default_data_file)
+    parser.add_argument('--db-dir', default=default_db_dir)
+    parser.add_argument('--axes', default=','.join(default_axes), help='Comma-separated axes to evaluate')
+    parser.add_argument('--k', default='10,50', help='Comma-separated cutoffs for recall@k and nDCG@k')
+    parser.add_argument('--groups', default=None, help='JSON file with groups in the shape of test.similar_cards (default: test.py)')
+    parser.add_argument('--index-compression', default=None, help='Evaluate a reduced-precision copy of every index, ex: sq8, fp16, pca256')
+    parser.add_argument('--mmap', action='store_true', help='Memory-map the indices')
+    parser.add_argument('--no-neighbor-tables', action='store_true', help='Search FAISS instead of the neighbor tables (implied by --index-compression and --mmap)')
+    parser.add_argument('--by-group', action='store_true', help='Also print the scores of every group')
+    parser.add_argument('--json', default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    axes = args.axes.split(',')
+    ks = [int(k) for k in args.k.split(',')]
+
+    if args.groups:
+        with open(args.groups) as f:
+            similar_cards = json.load(f)
+    else:
+        from test import similar_cards
+
+    card_data = load_cards(f'{args.db_dir}/{args.data_file}.json')
+    cards_by_sfid = {card['id']: card for card in card_data}
+
+    groups, missing = resolve_groups(similar_cards, NameIndex(card_data))
+    if missing:
+        print(f'{len(missing)} labelled names are not in the card data: {", ".join(missing)}')
+    print(f'{len(groups)} groups, {sum(len(group["sfids"]) for group in groups)} labelled cards')
+    if len(groups) == 0:
+        print('No group has two cards in the card data, nothing to evaluate')
+        return
+
+    then = time.perf_counter()
+    search_engine = SearchEngine({}, {}, {}, {}, sfids=sorted(cards_by_sfid.keys()), axes=axes)
+    loader = IndexLoader(search_engine, args.db_dir, args.data_file, axes, mmap=args.mmap, index_compression=args.index_compression)
+    loader.start()
+    loader.wait()
+    axes = search_engine.get_axes(axes)
+    print(f'Loaded {len(axes)} axes in {time.perf_counter() - then:.1f}s')
+    if args.no_neighbor_tables or args.index_compression or args.mmap:
+        search_engine.neighbor_tables.clear()
+
+    then = time.perf_counter()
+    results = evaluate(search_engine, groups, axes, ks)
+    print(f'Evaluated in {time.perf_counter() - then:.2f}s\n')
+
+    metrics = ['mrr'] + [f'{metric}@{k}' for k in ks for metric in ('recall', 'ndcg')]
+    print_table('axis', list(results['axes'].items()), metrics, ['queries_per_second'])
+    print('Answered from ' + ', '.join(f'{axis}: {values["source"]}' for axis, values in results['axes'].items()))
+    if args.by_group:
+        for axis, groups_scores in results['groups'].items():
+            print()
+            print_table(f'{axis}', list(groups_scores.items()), metrics)
+
+    if args.json:
+        results.update(data_file=args.data_file, index_compression=args.index_compression, mmap=args.mmap,
+                       neighbor_tables=len(search_engine.neighbor_tables) > 0, ks=ks, missing=missing)
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# Pre-renders the site into a static directory, so a plain file server can answer most traffic and Flask only has to
+# serve the dynamic pages (search, /query, /deck, the API). Every page is rendered by the app itself (through Flask's
+# test client), so the files are byte-for-byte what the server would answer.
+#  {out}/index.html, {out}/page/<n>/index.html                         home pages
+#  {out}/card/<sfid>/index.html, {out}/card/<sfid>/page/<n>/index.html  related cards of every card
+#  {out}/static/...                                                     css, js and symbols
+# Every page is also written as index.html.gz and, if the brotli package is installed, index.html.br,
+# for servers that send pre-compressed files (ex: nginx gzip_static / brotli_static, with try_files $uri/index.html).
+# Only requests without a query string can be served from these files: the pages are rendered unfiltered, so
+# /card/<sfid>?type=creature&... (the facet filter form) has to go to Flask, or its filters are silently ignored.
+# ex (nginx): location / { if ($args) { proxy_pass http://app; } try_files $uri $uri/index.html @app; }
+#
+# Cards are rendered on a pool of processes forked from this one after the data and indices are loaded, so the
+# workers share them. {out}/export-manifest.json records a key of the inputs of every card's pages (the templates, the
+# snapshot, its card and index files, and the card itself), and cards whose key did not change are skipped on the next
+# export without searching for their related cards, which are a function of those inputs.
+# Files whose content did not change are not rewritten, so their modification times stay put.
+#
+# ex: python export_static.py --out-dir ./site
+#     MTGMATRIX_DATA_FILE=... MTGMATRIX_DB_DIR=... python export_static.py --out-dir ./site --workers 8
+
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bump this whenever the export layout changes, so every page is exported again
+EXPORT_VERSION = 2
+
+manifest_name = 'export-manifest.json'
+
+# The loaded app, and the export settings, inherited by the forked workers
+mtgmatrix = None
+export_settings = {}
+_client = None
+
+
+def write_if_changed(filename, content):
+    # Returns True if the file was (re)written
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            if f.read() == content:
+                return False
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_file, filename)
+    return True
+
+
+def write_page(out_dir, path, html):
+    # ex: /card/<sfid>/page/2 -> {out_dir}/card/<sfid>/page/2/index.html (+ .gz, .br)
+    filename = os.path.join(out_dir, path.strip('/'), 'index.html')
+    if not write_if_changed(filename, html):
+        return False
+    # mtime=0 keeps the gzip output identical for identical pages
+    write_if_changed(f'{filename}.gz', gzip.compress(html, compresslevel=9, mtime=0))
+    if brotli is not None and export_settings.get('brotli', True):
+        write_if_changed(f'{filename}.br', brotli.compress(html, quality=export_settings.get('brotli_quality', 11)))
+    return True
+
+
+def render_page(path):
+    response = _client.get(path)
+    if response.status_code != 200:
+        raise RuntimeError(f'{path} answered {response.status_code}')
+    return response.get_data()
+
+
+def get_page_paths(base, total_pages):
+    # ex: ['/card/<sfid>', '/card/<sfid>/page/2', ...]
+    return [base or '/'] + [f'{base}/page/{page}' for page in range(2, total_pages + 1)]
+
+
+def get_total_pages(num_results):
+    per_page = mtgmatrix.cards_per_page
+    return num_results // per_page + (1 if num_results % per_page else 0)
+
+
+def hash_file(hasher, filename):
+    with open(filename, 'rb') as f:
+        hasher.update(f.read())
+
+
+def get_global_key():
+    # Inputs shared by every page: the export layout, the templates, the symbols, and the snapshot with its card data
+    # (the fields shown of every related card) and indices (the rankings)
+    hasher = hashlib.sha256(f'{EXPORT_VERSION}\n{mtgmatrix.max_related_results}\n{mtgmatrix.cards_per_page}\n'.encode('utf-8'))
+    for filename in sorted(glob.glob(os.path.join(mtgmatrix.app.template_folder, '*.html'))):
+        hash_file(hasher, filename)
+    symbols_file = os.path.join(mtgmatrix.app.static_folder, 'symbols.json')
+    if os.path.exists(symbols_file):
+        hash_file(hasher, symbols_file)
+    # Size + mtime is enough to notice that an index or neighbor table was rebuilt, without reading it
+    snapshot = mtgmatrix.contexts.current.snapshot
+    hasher.update(f'{snapshot["id"]}\n'.encode('utf-8'))
+    filenames = {snapshot['cards_file']}
+    for files in snapshot['axis_files'].values():
+        for kind, path in files.items():
+            if path is not None:
+                # embeddings and neighbors are prefixes of several files
+                filenames.update(glob.glob(f'{path}.*') if kind in ('embeddings', 'neighbors') else [path])
+    for filename in sorted(filename for filename in filenames if os.path.exists(filename)):
+        stat = os.stat(filename)
+        hasher.update(f'{os.path.basename(filename)} {stat.st_size} {stat.st_mtime_ns}\n'.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def get_card_key(card):
+    # The card itself, on top of the inputs shared by every page
+    hasher = hashlib.sha256(export_settings['global_key'].encode('utf-8'))
+    hasher.update(json.dumps(card, sort_keys=True, default=str).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def init_worker():
+    global _client
+    # One search at a time per process, the pool already uses every core
+    import faiss
+    faiss.omp_set_num_threads(1)
+    _client = mtgmatrix.app.test_client()
+
+
+def export_card(sfid):
+    # Returns (sfid, key, status), status is 'exported' or 'skipped'
+    out_dir = export_settings['out_dir']
+    key = get_card_key(mtgmatrix.get_context().cards_by_sfid[sfid])
+    base = f'/card/{sfid}'
+    if (not export_settings['force'] and export_settings['previous_pages'].get(sfid) == key
+            and os.path.exists(os.path.join(out_dir, base.strip('/'), 'index.html'))):
+        return sfid, key, 'skipped'
+
+    # The same pages as the card page links to, fewer when the ranking is shorter than max_related_results
+    num_results = min(len(mtgmatrix.fetch_related_ranking(sfid)), mtgmatrix.max_related_results)
+    for path in get_page_paths(base, max(1, get_total_pages(num_results))):
+        write_page(out_dir, path, render_page(path))
+    return sfid, key, 'exported'
+
+
+def read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, manifest_name)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return manifest.get('pages', {}) if manifest.get('version') == EXPORT_VERSION else {}
+
+
+def write_manifest(out_dir, pages):
+    filename = os.path.join(out_dir, manifest_name)
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': EXPORT_VERSION, 'pages': pages}, f)
+    os.replace(tmp_file, filename)
+
+
+def export_site(out_dir, workers=None, force=False, limit=None, use_brotli=True, brotli_quality=11):
+    global mtgmatrix
+    global _client
+
+    import app as mtgmatrix
+
+    # Every eager axis has to be loaded before the fork, the loader threads don't survive it
+    context = mtgmatrix.contexts.current
+    context.index_loader.wait()
+
+    os.makedirs(out_dir, exist_ok=True)
+    previous_pages = read_manifest(out_dir)
+    export_settings.update(out_dir=out_dir, force=force, brotli=use_brotli, brotli_quality=brotli_quality, previous_pages=previous_pages, global_key=get_global_key())
+
+    then = time.perf_counter()
+
+    # Static assets and home pages, here in the parent
+    shutil.copytree(mtgmatrix.app.static_folder, os.path.join(out_dir, 'static'), dirs_exist_ok=True)
+    _client = mtgmatrix.app.test_client()
+    for path in get_page_paths('', get_total_pages(mtgmatrix.num_popular_cards)):
+        write_page(out_dir, path, render_page(path))
+
+    sfids = context.search_engine.sfids if limit is None else context.search_engine.sfids[:limit]
+    sfids = [sfid for sfid in sfids if sfid in context.cards_by_sfid]
+
+    pages = {}
+    counts = {'exported': 0, 'skipped': 0, 'removed': 0}
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        init_worker()
+        results = map(export_card, sfids)
+        for sfid, key, status in results:
+            pages[sfid] = key
+            counts[status] += 1
+    else:
+        # Forked, so the workers share the loaded data and indices instead of loading their own
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=init_worker) as executor:
+            for sfid, key, status in executor.map(export_card, sfids, chunksize=64):
+                pages[sfid] = key
+                counts[status] += 1
+
+    # Pages of cards that are gone from the card data
+    if limit is None:
+        for sfid in previous_pages:
+            if sfid not in pages:
+                shutil.rmtree(os.path.join(out_dir, 'card', sfid), ignore_errors=True)
+                counts['removed'] += 1
+    else:
+        pages = dict(previous_pages, **pages)
+
+    write_manifest(out_dir, pages)
+
+    seconds = time.perf_counter() - then
+    print(f'Exported {counts["exported"]} cards, skipped {counts["skipped"]} unchanged and removed {counts["removed"]} '
+          f'in {seconds:.1f}s with {workers} workers to {out_dir}{"" if brotli is not None and use_brotli else " (no brotli)"}')
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-render the home pages and every card page into a static directory')
+    parser.add_argument('--out-dir', default='./site')
+    parser.add_argument('--workers', type=int, default=None, help='Rendering processes (default: one per core)')
+    parser.add_argument('--force', action='store_true', help='Export every card, even the unchanged ones')
+    parser.add_argument('--limit', type=int, default=None, help='Only export the first N cards, for debug')
+    parser.add_argument('--no-brotli', action='store_true', help='Only write the gzip variants')
+    parser.add_argument('--brotli-quality', type=int, default=11, help='0-11, 11 is about 4x slower than 9 for 10%% smaller pages')
+    args = parser.parse_args()
+
+    export_site(args.out_dir, args.workers, args.force, args.limit, not args.no_brotli, args.brotli_quality)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import math
+
+import numpy as np
+
+# Facet indexes over the cards, built once and combined per request into a boolean mask over card positions.
+#  identity   color identity as a WUBRG bitmask per card (uint8), compared with vectorized bit operations
+#  type       sorted position arrays for every word of the type line ('creature', 'legendary', 'goblin', ...)
+#  cmc        mana values sorted once, ranges resolved with searchsorted
+#  format     a boolean array per format of the cards that are legal (or restricted) in it
+# All filters are ANDed. The search engine turns the resulting mask into a FAISS ID selector, so filtered
+# searches only ever score matching cards and still return a full page of results.
+
+color_bits = {'W': 1, 'U': 2, 'B': 4, 'R': 8, 'G': 16}
+
+# Modes for the identity filter, ex: identity=R&identity_mode=within
+#  within    the card's color identity is a subset of the given colors (Commander rules, colorless cards included)
+#  exact     the card's color identity is exactly the given colors ('mono-red' is identity=R&identity_mode=exact)
+#  includes  the card's color identity contains all of the given colors
+identity_modes = ['within', 'exact', 'includes']
+
+legal_statuses = {'legal', 'restricted'}
+
+
+def get_color_mask(colors):
+    # 'C' (colorless) adds no bits, so identity=C&identity_mode=exact selects colorless cards
+    mask = 0
+    for color in colors:
+        if color.upper() == 'C':
+            continue
+        if color.upper() not in color_bits:
+            raise ValueError(f'Unknown color: {color} (expected some of {"".join(color_bits.keys())})')
+        mask |= color_bits[color.upper()]
+    return mask
+
+
+def get_type_words(type_line):
+    # 'Legendary Creature — Human Wizard // Sorcery' -> {'legendary', 'creature', 'human', 'wizard', 'sorcery'}
+    return {word for word in type_line.lower().replace('—', ' ').replace('//', ' ').split() if word}
+
+
+def get_string_arg(args, key):
+    # JSON bodies can hold any type, so a filter that isn't a string is rejected rather than coerced
+    value = args.get(key)
+    if value is not None and not isinstance(value, str):
+        raise ValueError(f'Invalid {key}: {value!r} (expected a string)')
+    return value
+
+
+def parse_facet_filters(args):
+    # Facet filters from request arguments (a dict or Flask's request.args), keeping only the ones that are set.
+    # Raises ValueError on values of the wrong type, so the API answers 400 instead of failing.
+    filters = {}
+    identity = get_string_arg(args, 'identity')
+    if identity:
+        filters['identity'] = identity.upper()
+        filters['identity_mode'] = get_string_arg(args, 'identity_mode') or 'within'
+        if filters['identity_mode'] not in identity_modes:
+            raise ValueError(f'Unknown identity mode: {filters["identity_mode"]} (expected one of {identity_modes})')
+    types = args.getlist('type') if hasattr(args, 'getlist') else args.get('type', [])
+    if isinstance(types, str):
+        types = [types]
+    if not isinstance(types, list) or not all(isinstance(value, str) for value in types):
+        raise ValueError(f'Invalid type: {types!r} (expected a string or a list of strings)')
+    # Several types can be given as separate arguments or in one, ex: type=legendary+creature
+    types = [card_type for value in types for card_type in value.lower().replace(',', ' ').split()]
+    if types:
+        filters['type'] = types
+    for key in ['cmc_min', 'cmc_max']:
+        value = args.get(key)
+        if value in (None, ''):
+            continue
+        # bool is an int subclass, but cmc_min=true is a mistake rather than a mana value
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ValueError(f'Invalid {key}: {value!r} (expected a number)')
+        try:
+            filters[key] = float(value)
+        except ValueError:
+            raise ValueError(f'Invalid {key}: {value!r} (expected a number)')
+        # float() also parses 'nan' and 'inf', which would select nothing or everything
+        if not math.isfinite(filters[key]):
+            raise ValueError(f'Invalid {key}: {value!r} (expected a finite number)')
+    format_name = get_string_arg(args, 'format')
+    if format_name:
+        filters['format'] = format_name.lower()
+    return filters
+
+
+def get_filter_key(filters):
+    # Hashable form of a filter dict, used in cache keys
+    return tuple(sorted((key, tuple(value) if isinstance(value, list) else value) for key, value in filters.items()))
+
+
+class FacetIndex:
+    def __init__(self, sfids, cards_by_sfid):
+        # Positions follow the given sfid order (the search engine's card space). Unknown sfids never match a filter.
+        self.num_cards = len(sfids)
+        self.known = np.zeros(self.num_cards, dtype=bool)
+        self.identity = np.zeros(self.num_cards, dtype=np.uint8)
+        self.cmc = np.full(self.num_cards, np.nan, dtype=np.float32)
+        type_positions = {}
+        format_positions = {}
+
+        for position, sfid in enumerate(sfids):
+            card = cards_by_sfid.get(sfid)
+            if card is None:
+                continue
+            self.known[position] = True
+            self.identity[position] = get_color_mask(card.get('color_identity', []))
+            if card.get('cmc') is not None:
+                self.cmc[position] = card['cmc']
+            for word in get_type_words(card.get('type_line', '')):
+                type_positions.setdefault(word, []).append(position)
+            for format_name, status in card.get('legalities', {}).items():
+                if status in legal_statuses:
+                    format_positions.setdefault(format_name, []).append(position)
+
+        self.type_positions = {word: np.array(positions, dtype=np.int32) for word, positions in type_positions.items()}
+
+        self.legal = {}
+        for format_name, positions in format_positions.items():
+            self.legal[format_name] = np.zeros(self.num_cards, dtype=bool)
+            self.legal[format_name][positions] = True
+
+        # NaN mana values sort last and are never inside a range
+        self.cmc_order = np.argsort(self.cmc, kind='stable')
+        self.sorted_cmc = self.cmc[self.cmc_order]
+
+    def identity_mask(self, colors, mode='within'):
+        colors = get_color_mask(colors)
+        if mode == 'within':
+            return (self.identity & ~np.uint8(colors)) == 0
+        if mode == 'exact':
+            return self.identity == colors
+        if mode == 'includes':
+            return (self.identity & colors) == colors
+        raise ValueError(f'Unknown identity mode: {mode} (expected one of {identity_modes})')
+
+    def type_mask(self, card_type):
+        mask = np.zeros(self.num_cards, dtype=bool)
+        mask[self.type_positions.get(card_type.lower(), [])] = True
+        return mask
+
+    def cmc_mask(self, cmc_min=None, cmc_max=None):
+        start = 0 if cmc_min is None else np.searchsorted(self.sorted_cmc, cmc_min, side='left')
+        stop = np.searchsorted(self.sorted_cmc, np.inf if cmc_max is None else cmc_max, side='right')
+        mask = np.zeros(self.num_cards, dtype=bool)
+        mask[self.cmc_order[start:stop]] = True
+        return mask
+
+    def format_mask(self, format_name):
+        if format_name not in self.legal:
+            return np.zeros(self.num_cards, dtype=bool)
+        return self.legal[format_name]
+
+    def select(self, filters):
+        # ANDs every filter into one boolean mask over card positions, or returns None when nothing is filtered
+        if not filters:
+            return None
+
+        mask = self.known.copy()
+        if 'identity' in filters:
+            mask &= self.identity_mask(filters['identity'], filters.get('identity_mode', 'within'))
+        for card_type in filters.get('type', []):
+            mask &= self.type_mask(card_type)
+        if 'cmc_min' in filters or 'cmc_max' in filters:
+            mask &= self.cmc_mask(filters.get('cmc_min'), filters.get('cmc_max'))
+        if 'format' in filters:
+            mask &= self.format_mask(filters['format'])
+        return mask
@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+
+# gunicorn settings for wsgi.py, ex: MTGMATRIX_WORKERS=8 gunicorn -c gunicorn.conf.py wsgi:application
+
+bind = os.environ.get('MTGMATRIX_BIND', '0.0.0.0:8000')
+
+# One worker per core by default. Searches are CPU-bound in FAISS, so more workers than cores only adds memory.
+workers = int(os.environ.get('MTGMATRIX_WORKERS', multiprocessing.cpu_count()))
+
+# A few threads per worker let slow clients and cache hits overlap with searches
+worker_class = 'gthread'
+threads = int(os.environ.get('MTGMATRIX_THREADS', '4'))
+
+# Load the app (card data, indices) once in the master, and fork the workers from it
+preload_app = True
+
+timeout = 60
+graceful_timeout = 30
+accesslog = os.environ.get('MTGMATRIX_ACCESS_LOG', None)
+
+
+def post_fork(server, worker):
+    # FAISS parallelizes single searches with OpenMP. With one worker per core, that only oversubscribes the CPUs.
+    import faiss
+    faiss.omp_set_num_threads(int(os.environ.get('MTGMATRIX_OMP_THREADS', '1')))
+
+    # Load and warm up the query embedding model while the worker boots, instead of in the first /query.
+    # It isn't started in the master: the thread would not survive the fork, and the model would be loaded twice.
+    import app as mtgmatrix
+    mtgmatrix.embedding_service.start()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+
+import faiss
+import numpy as np
+
+# Helpers for building and incrementally updating the per-axis FAISS indices in data/create_db.py.
+# Indices are ID-mapped (IndexIDMap2), so every card keeps a stable int64 id across rebuilds, and the
+# .keys JSON maps sfid -> id. Removing or re-embedding a card only touches that card's vectors.
+
+
+def compute_text_hash(model_name, embed_instruction, card_content):
+    # Content hash of what actually goes into the model for one card on one axis
+    return hashlib.sha256(f'{model_name}\n{embed_instruction}\n{card_content}'.encode('utf-8')).hexdigest()
+
+
+def read_hashes(hashes_file):
+    try:
+        with open(hashes_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_hashes(hashes_file, hashes_by_sfid):
+    tmp_file = f'{hashes_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(hashes_by_sfid, f, indent=0)
+    os.replace(tmp_file, hashes_file)
+
+
+def read_keys(keys_file):
+    with open(keys_file) as f:
+        return json.load(f)
+
+
+def write_keys(keys_file, ids_by_sfid):
+    with open(keys_file, 'w') as f:
+        json.dump(ids_by_sfid, f, indent=0)
+
+
+def is_ivf(index):
+    try:
+        faiss.extract_index_ivf(index)
+        return True
+    except RuntimeError:
+        return False
+
+
+def create_index(embedding_size, index_factory='Flat'):
+    # index_factory is a FAISS factory string, ex: 'Flat', 'HNSW32,Flat', 'IVF1024,Flat', 'IVF1024,PQ64'
+    index = faiss.index_factory(embedding_size, index_factory, faiss.METRIC_INNER_PRODUCT)
+
+    # IVF indices store ids natively, everything else needs an id map
+    if is_ivf(index):
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+def train_index(index, embeddings, max_training_vectors=100000, seed=1234):
+    # IVF and PQ indices have to be trained on a sample of the data before anything can be added
+    if index.is_trained:
+        return
+    if len(embeddings) > max_training_vectors:
+        rng = np.random.default_rng(seed)
+        embeddings = embeddings[rng.choice(len(embeddings), max_training_vectors, replace=False)]
+    index.train(np.ascontiguousarray(embeddings, dtype=np.float32))
+
+
+def configure_index(index, search_params=None):
+    # IVF indices need a direct map to reconstruct vectors by id. A hashtable also allows removing ids.
+    if is_ivf(index):
+        faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+
+    # Search-time parameters such as 'nprobe=16' or 'efSearch=64' are saved with the index
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params)
+
+
+def ensure_id_map(index):
+    # Older builds wrote a bare IndexFlatIP, where the id of a vector is its position.
+    # Wrap those in an IndexIDMap2 with the same ids so they can be updated in place.
+    if isinstance(index, faiss.IndexIDMap2) or is_ivf(index):
+        return index
+
+    id_map = create_index(index.d)
+    if index.ntotal > 0:
+        id_map.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype=np.int64))
+    return id_map
+
+
+def build_index_with_ids(embeddings, ids, index_factory='Flat', search_params=None):
+    index = create_index(embeddings.shape[1], index_factory)
+
+    if len(ids) > 0:
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        train_index(index, embeddings)
+        index.add_with_ids(embeddings, np.asarray(ids, dtype=np.int64))
+
+    configure_index(index, search_params)
+
+    return index
+
+
+def build_index(embeddings_by_sfid, embedding_size, index_factory='Flat', search_params=None):
+    # Full build: ids are assigned in order
+    ids_by_sfid = {sfid: idx for idx, sfid in enumerate(embeddings_by_sfid.keys())}
+
+    if len(ids_by_sfid) > 0:
+        embeddings = np.stack([embeddings_by_sfid[sfid] for sfid in ids_by_sfid]).astype(np.float32)
+    else:
+        embeddings = np.zeros((0, embedding_size), dtype=np.float32)
+    index = build_index_with_ids(embeddings, list(ids_by_sfid.values()), index_factory, search_params)
+
+    return index, ids_by_sfid
+
+
+# Reduced-precision storage modes, applied on top of an index factory string:
+#  fp16    vectors stored as float16 (SQfp16), half the memory, practically no ranking drift
+#  sq8     8-bit scalar quantization (SQ8), a quarter of the memory
+#  pca<N>  PCA down to N dimensions before indexing, ex: pca256
+# Queries still use full-precision vectors of the original dimension, so the search code doesn't change.
+compression_modes = ['none', 'fp16', 'sq8', 'pca<N>']
+
+
+def apply_compression(index_factory, compression):
+    if not compression or compression == 'none':
+        return index_factory
+
+    if compression in ('fp16', 'sq8'):
+        encoding = 'SQfp16' if compression == 'fp16' else 'SQ8'
+        parts = index_factory.split(',')
+        if parts[-1] == 'Flat':
+            parts[-1] = encoding
+        elif len(parts) == 1 and parts[0].startswith('HNSW'):
+            parts.append(encoding)
+        else:
+            raise ValueError(f'Can not apply {compression} compression to index factory {index_factory}')
+        return ','.join(parts)
+
+    if compression.startswith('pca') and compression[3:].isdigit():
+        return f'PCA{int(compression[3:])},{index_factory}'
+
+    raise ValueError(f'Unknown compression mode: {compression} (expected one of {compression_modes})')
+
+
+def get_embedding_store_dtype(compression):
+    # The embedding stores only hold query vectors, so float16 is plenty whenever the index is compressed
+    if not compression or compression == 'none':
+        return np.float32
+    return np.float16
+
+
+def compress_index(embedding_store, ids_by_sfid, compression, index_factory='Flat', search_params=None):
+    # Build a compressed copy of an axis index from its embedding store, keeping the same ids.
+    # Used to compress full-precision indices at load time, and to compare compression modes.
+    sfids = [sfid for sfid in ids_by_sfid if sfid in embedding_store]
+    embeddings, _ = embedding_store.get_many(sfids)
+    ids = [ids_by_sfid[sfid] for sfid in sfids]
+    return build_index_with_ids(embeddings, ids, apply_compression(index_factory, compression), search_params)
+
+
+def update_index(index, ids_by_sfid, hashes_by_sfid, embeddings_by_sfid, new_hashes_by_sfid):
+    # Incremental build: keep every card whose text hash did not change, delete removed and changed cards,
+    # and upsert changed and new cards. Changed cards keep their old id, new cards get fresh ids.
+    # Returns (index, new ids_by_sfid, stats).
+    # Raises RuntimeError for index types that can't remove vectors (such as HNSW).
+    index = ensure_id_map(index)
+    configure_index(index)
+    hashes_by_sfid = hashes_by_sfid or {}
+
+    keep = {sfid for sfid in embeddings_by_sfid
+            if sfid in ids_by_sfid and hashes_by_sfid.get(sfid) == new_hashes_by_sfid.get(sfid)}
+    removed = [sfid for sfid in ids_by_sfid if sfid not in embeddings_by_sfid]
+    changed = [sfid for sfid in ids_by_sfid if sfid in embeddings_by_sfid and sfid not in keep]
+    added = [sfid for sfid in embeddings_by_sfid if sfid not in ids_by_sfid]
+
+    stale_ids = np.array([ids_by_sfid[sfid] for sfid in removed + changed], dtype=np.int64)
+    if len(stale_ids) > 0:
+        index.remove_ids(stale_ids)
+
+    new_ids_by_sfid = {sfid: ids_by_sfid[sfid] for sfid in ids_by_sfid if sfid in embeddings_by_sfid}
+    next_id = max(ids_by_sfid.values(), default=-1) + 1
+    for sfid in added:
+        new_ids_by_sfid[sfid] = next_id
+        next_id += 1
+
+    upserted = changed + added
+    if len(upserted) > 0:
+        embeddings = np.stack([embeddings_by_sfid[sfid] for sfid in upserted]).astype(np.float32)
+        index.add_with_ids(embeddings, np.array([new_ids_by_sfid[sfid] for sfid in upserted], dtype=np.int64))
+
+    stats = {'kept': len(keep), 'removed': len(removed), 'changed': len(changed), 'added': len(added)}
+    return index, new_ids_by_sfid, stats
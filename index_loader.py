@@ -0,0 +1,172 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+
+from embedding_store import EmbeddingStore, embedding_store_exists, get_embedding_store_prefix
+from index_builder import compress_index
+from metrics import startup_seconds
+from neighbor_tables import NeighborTable, get_neighbor_table_prefix, neighbor_table_exists
+
+# Loading of the per-axis search data (FAISS index, keys, embedding store and neighbor table) into a SearchEngine.
+#  eager axes  are read concurrently in the background as soon as start() is called, so the app can answer
+#              (/healthz, /readyz, cached pages) while they load. The primary axis decides readiness.
+#  lazy axes   are only read the first time a search needs them (see SearchEngine.get_axes). When the primary
+#              axis is lazy too (ex: web workers that search through search_service.py), nothing is read up front.
+# Indices can be memory-mapped (IO_FLAG_MMAP), so they load instantly and their pages are shared between
+# worker processes through the page cache instead of being copied into every process.
+
+# Axis states reported by status()
+axis_states = ['lazy', 'pending', 'loading', 'loaded', 'failed']
+
+
+def read_faiss_index(filename, mmap=False):
+    if not mmap:
+        return faiss.read_index(filename)
+    # IO_FLAG_MMAP maps IVF inverted lists, IO_FLAG_MMAP_IFC maps the codes of flat indices (newer FAISS only)
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+    return faiss.read_index(filename, flags)
+
+
+def get_axis_files(db_dir, data_file, tag):
+    # The files of one axis, in the layout written by data/create_db.py and neighbor_tables.py (see also snapshot.py)
+    return {
+        'index': f'{db_dir}/faiss_{data_file}_db_{tag}.index',
+        'keys': f'{db_dir}/faiss_{data_file}_db_{tag}.keys',
+        'embeddings': get_embedding_store_prefix(db_dir, data_file, tag),
+        'neighbors': get_neighbor_table_prefix(db_dir, data_file, tag),
+    }
+
+
+def load_axis(files, tag, mmap=False, index_compression=None):
+    # Returns (index, ids_by_sfid, embedding_store or None, neighbor_table or None) for one axis.
+    # files is {'index', 'keys', 'embeddings', 'neighbors'}, see get_axis_files(). The last two are optional.
+    then = time.perf_counter()
+    filename = files['index']
+    index = read_faiss_index(filename, mmap)
+    with open(files['keys'], 'rb') as f:
+        ids_by_sfid = json.load(f)
+    startup_seconds.set(time.perf_counter() - then, step='index', axis=tag)
+
+    # ex: embeddings_oracle-cards-20231113220154_db_dupe2.npy (memory-mapped, shared between workers)
+    then = time.perf_counter()
+    embedding_store = None
+    store_prefix = files.get('embeddings')
+    if store_prefix and embedding_store_exists(store_prefix):
+        embedding_store = EmbeddingStore(store_prefix)
+    else:
+        print(f'No embedding store for {tag}, query embeddings will be reconstructed from the index')
+
+    if index_compression and embedding_store is not None:
+        index = compress_index(embedding_store, ids_by_sfid, index_compression)
+    startup_seconds.set(time.perf_counter() - then, step='store', axis=tag)
+
+    # ex: neighbors_oracle-cards-20231113220154_db_dupe2.neighbors.npy (precomputed by neighbor_tables.py)
+    then = time.perf_counter()
+    neighbor_table = None
+    table_prefix = files.get('neighbors')
+    if table_prefix and neighbor_table_exists(table_prefix):
+        neighbor_table = NeighborTable(table_prefix)
+        if not neighbor_table.is_current(filename):
+            print(f'Neighbor table for {tag} is out of date with {filename}, falling back to live search')
+            neighbor_table = None
+    startup_seconds.set(time.perf_counter() - then, step='neighbor_table', axis=tag)
+
+    return index, ids_by_sfid, embedding_store, neighbor_table
+
+
+class IndexLoader:
+    def __init__(self, search_engine, db_dir, data_file, axes, primary_axis=None, lazy_axes=(), mmap=False,
+                 index_compression=None, max_workers=None, on_load=None, axis_files=None):
+        self.search_engine = search_engine
+        self.db_dir = db_dir
+        self.data_file = data_file
+        self.axes = list(axes)
+        self.primary_axis = primary_axis or self.axes[0]
+        self.lazy_axes = [axis for axis in lazy_axes if axis in self.axes]
+        self.mmap = mmap
+        self.index_compression = index_compression
+        self.max_workers = max_workers or len(self.axes)
+        # Called with the axis name after every axis is added to the search engine, ex: to clear result caches
+        self.on_load = on_load
+        # {axis: files} from a snapshot manifest, or the default file names of db_dir and data_file
+        self.axis_files = axis_files or {axis: get_axis_files(db_dir, data_file, axis) for axis in self.axes}
+
+        self.axis_locks = {axis: threading.Lock() for axis in self.axes}
+        self.done = {axis: threading.Event() for axis in self.axes}
+        self.states = {axis: 'lazy' if axis in self.lazy_axes else 'pending' for axis in self.axes}
+        self.seconds = {}
+        self.errors = {}
+        self.thread = None
+
+        search_engine.loader = self
+
+    def start(self):
+        # Loads the eager axes concurrently in the background, and returns immediately
+        eager_axes = [axis for axis in self.axes if axis not in self.lazy_axes]
+        self.thread = threading.Thread(target=self._load_all, args=(eager_axes,), name='index-loader', daemon=True)
+        self.thread.start()
+
+    def _load_all(self, axes):
+        then = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='index-loader') as executor:
+            list(executor.map(self.load, axes))
+        print(f'Loaded {len(self.search_engine.axes)} of {len(self.axes)} axes in {time.perf_counter() - then:.1f}s '
+              f'({len(self.search_engine.embedding_stores)} embedding stores, {len(self.search_engine.neighbor_tables)} neighbor tables'
+              f'{", memory-mapped" if self.mmap else ""}{", " + self.index_compression + " compression" if self.index_compression else ""})')
+
+    def load(self, axis):
+        # Loads one axis into the search engine, once. Returns True if the axis is loaded.
+        with self.axis_locks[axis]:
+            if self.states[axis] in ('loaded', 'failed'):
+                return self.states[axis] == 'loaded'
+            self.states[axis] = 'loading'
+            then = time.perf_counter()
+            try:
+                index, ids_by_sfid, embedding_store, neighbor_table = load_axis(self.axis_files[axis], axis, self.mmap, self.index_compression)
+                self.search_engine.add_axis(axis, index, ids_by_sfid, embedding_store, neighbor_table)
+                self.states[axis] = 'loaded'
+            except Exception as e:
+                print(f'Failed to load the {axis} axis: {e}')
+                self.errors[axis] = str(e)
+                self.states[axis] = 'failed'
+            self.seconds[axis] = time.perf_counter() - then
+            self.done[axis].set()
+
+        if self.states[axis] == 'loaded' and self.on_load is not None:
+            self.on_load(axis)
+        return self.states[axis] == 'loaded'
+
+    def ensure(self, axes):
+        # Loads the lazy axes among axes right away. Eager axes that are still loading are not waited for.
+        for axis in axes:
+            if self.states.get(axis) == 'lazy':
+                self.load(axis)
+
+    def wait(self, axes=None, timeout=None):
+        # Blocks until the given axes (every eager axis by default) are loaded or failed. Returns False on timeout.
+        # Lazy axes that are asked for explicitly are loaded first.
+        if axes:
+            self.ensure(axes)
+        axes = axes or [axis for axis in self.axes if axis not in self.lazy_axes]
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for axis in axes:
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            if not self.done[axis].wait(remaining):
+                return False
+        return True
+
+    def is_ready(self):
+        # Ready to take traffic as soon as the primary axis can be searched (or loaded on first use, if it is lazy)
+        return self.states[self.primary_axis] in ('loaded', 'lazy')
+
+    def status(self):
+        return {
+            'ready': self.is_ready(),
+            'primary_axis': self.primary_axis,
+            'mmap': self.mmap,
+            'axes': {axis: {'state': self.states[axis], 'seconds': self.seconds.get(axis), 'error': self.errors.get(axis)}
+                     for axis in self.axes},
+        }
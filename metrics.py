@@ -0,0 +1,210 @@
+import bisect
+import os
+import threading
+import time
+
+# Lightweight in-process instrumentation, exposed in the Prometheus text format (see app.py /metrics).
+#  Counter    monotonically increasing value, ex: requests served
+#  Gauge      value that is set, or computed by a function when scraped, ex: startup timings, cache hit rates
+#  Histogram  cumulative bucket counts, sum and count, ex: per-axis search latency
+# Every metric can have labels, ex: search_seconds.observe(0.002, axis='spike', source='faiss').
+# Timers can also be reported per request as a Server-Timing header, so a browser's dev tools show where
+# the time of one request went.
+#
+# MTGMATRIX_METRICS=0 disables recording (timers become a shared no-op context manager),
+# MTGMATRIX_SERVER_TIMING=1 enables the Server-Timing header.
+
+enabled = os.environ.get('MTGMATRIX_METRICS', '1') != '0'
+server_timing = os.environ.get('MTGMATRIX_SERVER_TIMING', '0') == '1'
+
+# Latency buckets in seconds, from 100us to 10s
+default_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+registry = []
+
+# Per-request Server-Timing entries, for the current thread only
+_request_timings = threading.local()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        # (suffix, labels, value) tuples
+        with self.lock:
+            return [('', labels, value) for labels, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(labels)} {value:.10g}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function, **labels):
+        # function() is called on every scrape
+        with self.lock:
+            self.functions[tuple(sorted(labels.items()))] = function
+
+    def samples(self):
+        samples = super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        return samples + [('', labels, function()) for labels, function in functions]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=default_buckets):
+        super().__init__(name, help_text)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def time(self, timing_name=None, **labels):
+        # Context manager that observes the elapsed time, and adds it to the Server-Timing header as timing_name
+        if not enabled:
+            return _null_timer
+        return Timer(self, labels, timing_name)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in items:
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + ['+Inf'], counts[:-1]):
+                cumulative += count
+                le = upper_bound if upper_bound == '+Inf' else f'{upper_bound:g}'
+                samples.append(('_bucket', labels + (('le', le),), cumulative))
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, cumulative))
+        return samples
+
+
+class Timer:
+    __slots__ = ('histogram', 'labels', 'timing_name', 'start', 'seconds')
+
+    def __init__(self, histogram, labels, timing_name):
+        self.histogram = histogram
+        self.labels = labels
+        self.timing_name = timing_name
+        self.seconds = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.histogram.observe(self.seconds, **self.labels)
+        if self.timing_name is not None:
+            add_timing(self.timing_name, self.seconds)
+        return False
+
+
+class NullTimer:
+    seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = NullTimer()
+
+
+def start_request_timings():
+    if server_timing:
+        _request_timings.entries = []
+
+
+def add_timing(name, seconds, description=None):
+    # Adds an entry to the Server-Timing header of the current request (if it is being collected on this thread)
+    entries = getattr(_request_timings, 'entries', None)
+    if entries is not None:
+        entries.append((name, seconds, description))
+
+
+def pop_server_timing_header():
+    # Returns the Server-Timing header value for the current request, or None
+    entries = getattr(_request_timings, 'entries', None)
+    _request_timings.entries = None
+    if not entries:
+        return None
+    return ', '.join(f'{name};dur={seconds * 1000:.3f}' + (f';desc="{description}"' if description else '')
+                     for name, seconds, description in entries)
+
+
+def render():
+    # Every registered metric in the Prometheus text exposition format
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics shared by the modules of the app
+request_seconds = Histogram('mtgmatrix_request_seconds', 'Time to serve a request, by endpoint')
+requests_total = Counter('mtgmatrix_requests_total', 'Requests served, by endpoint and status')
+axis_search_seconds = Histogram('mtgmatrix_axis_search_seconds', 'Time to search one axis, by axis and source (table or faiss)')
+merge_seconds = Histogram('mtgmatrix_merge_seconds', 'Time to merge the per-axis results of a search')
+ranking_seconds = Histogram('mtgmatrix_ranking_seconds', 'Time to compute a full related-card ranking (cache misses only)')
+render_seconds = Histogram('mtgmatrix_render_seconds', 'Time to render a template, by template')
+startup_seconds = Gauge('mtgmatrix_startup_seconds', 'Time spent loading at startup, by step and axis')
+cache_hit_rate = Gauge('mtgmatrix_cache_hit_rate', 'Hit rate of the in-memory caches, by cache')
+cache_entries = Gauge('mtgmatrix_cache_entries', 'Entries in the in-memory caches, by cache')
+snapshot_swaps_total = Counter('mtgmatrix_snapshot_swaps_total', 'Snapshot reloads, by result (swapped or failed)')
+active_requests = Gauge('mtgmatrix_active_requests', 'Requests in flight, by snapshot state (active or draining)')
+shard_search_seconds = Histogram('mtgmatrix_shard_search_seconds', 'Time for one search service shard to answer, by shard')
+shard_errors_total = Counter('mtgmatrix_shard_errors_total', 'Search service shards that failed or timed out, by shard')
@@ -0,0 +1,144 @@
+import bisect
+import re
+import unicodedata
+
+import numpy as np
+
+# In-memory card name index behind the sidebar search and the typeahead endpoint, built once at load time.
+# Every card name and card face name is an entry. Lookups try, in order:
+#  prefix     binary search over the sorted normalized names
+#  substring  intersection of the trigram posting lists, then a plain 'in' check on the candidates
+#  fuzzy      trigram similarity (shared trigrams / all trigrams), counted with np.bincount, for typos
+# Within each kind of match, more popular cards (lower edhrec_rank) come first.
+
+_non_word = re.compile(r'[^a-z0-9 ]+')
+_spaces = re.compile(r' +')
+
+
+def normalize_name(name):
+    # 'Æther Vial' -> 'aether vial', "Tormod's Crypt" -> 'tormods crypt'
+    name = name.replace('Æ', 'Ae').replace('æ', 'ae')
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii').lower()
+    name = _non_word.sub('', name.replace('-', ' ').replace('/', ' '))
+    return _spaces.sub(' ', name).strip()
+
+
+def get_trigrams(normalized_name):
+    padded = f'  {normalized_name} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    def __init__(self, card_data):
+        # One entry per (name, card) pair: the full name, plus each face name of multi-faced cards
+        self.names = []
+        self.normalized_names = []
+        self.sfids = []
+        ranks = []
+        for card in card_data:
+            names = [card['name']] + [face['name'] for face in card.get('card_faces', []) if face.get('name') and face['name'] != card['name']]
+            for name in names:
+                self.names.append(name)
+                self.normalized_names.append(normalize_name(name))
+                self.sfids.append(card['id'])
+                ranks.append(card.get('edhrec_rank') or float('inf'))
+
+        # Popularity order of every entry, used to rank matches of the same kind
+        order = sorted(range(len(self.names)), key=lambda entry: (ranks[entry], len(self.names[entry])))
+        self.popularity = np.empty(len(order), dtype=np.int64)
+        self.popularity[order] = np.arange(len(order))
+
+        # Sorted (normalized name, entry) pairs for prefix search
+        sorted_entries = sorted(zip(self.normalized_names, range(len(self.names))))
+        self.sorted_names = [name for name, _ in sorted_entries]
+        self.sorted_name_entries = np.array([entry for _, entry in sorted_entries], dtype=np.int64)
+
+        # Trigram -> sorted array of entries containing it
+        postings = {}
+        self.trigram_counts = np.zeros(len(self.names), dtype=np.int32)
+        for entry, normalized_name in enumerate(self.normalized_names):
+            trigrams = get_trigrams(normalized_name)
+            self.trigram_counts[entry] = len(trigrams)
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(entry)
+        self.postings = {trigram: np.array(entries, dtype=np.int32) for trigram, entries in postings.items()}
+
+    def __len__(self):
+        return len(self.names)
+
+    def _by_popularity(self, entries):
+        entries = np.asarray(entries, dtype=np.int64)
+        return entries[np.argsort(self.popularity[entries], kind='stable')]
+
+    def prefix_matches(self, query):
+        start = bisect.bisect_left(self.sorted_names, query)
+        stop = bisect.bisect_left(self.sorted_names, query + '\x7f')
+        return self._by_popularity(self.sorted_name_entries[start:stop])
+
+    def find(self, name):
+        # The sfid of the most popular card with exactly this (normalized) name or face name, or None
+        query = normalize_name(name)
+        for entry in self.prefix_matches(query):
+            if self.normalized_names[entry] == query:
+                return self.sfids[entry]
+        return None
+
+    def substring_matches(self, query):
+        trigrams = [trigram for trigram in get_trigrams(query) if not trigram.startswith(' ') and not trigram.endswith(' ')]
+        if len(trigrams) == 0:
+            # Too short for inner trigrams, check every name
+            candidates = range(len(self.names))
+        else:
+            postings = sorted((self.postings.get(trigram, np.zeros(0, dtype=np.int32)) for trigram in trigrams), key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        return self._by_popularity([entry for entry in candidates if query in self.normalized_names[entry]])
+
+    def fuzzy_matches(self, query, min_similarity=0.3, limit=10):
+        trigrams = get_trigrams(query)
+        postings = [self.postings[trigram] for trigram in trigrams if trigram in self.postings]
+        if len(postings) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.names))
+        candidates = np.nonzero(shared)[0]
+        similarity = shared[candidates] / (len(trigrams) + self.trigram_counts[candidates] - shared[candidates])
+
+        keep = similarity >= min_similarity
+        candidates, similarity = candidates[keep], similarity[keep]
+        order = np.lexsort((self.popularity[candidates], -similarity))[:limit]
+        return candidates[order], similarity[order]
+
+    def search(self, query, limit=10):
+        # Returns up to limit matches as dicts, at most one per card
+        query = normalize_name(query)
+        if len(query) == 0:
+            return []
+
+        results = []
+        seen_sfids = set()
+
+        def add_matches(entries, match):
+            for entry in entries:
+                sfid = self.sfids[entry]
+                if sfid in seen_sfids:
+                    continue
+                seen_sfids.add(sfid)
+                results.append({'id': sfid, 'name': self.names[entry], 'match': match})
+                if len(results) >= limit:
+                    return True
+            return False
+
+        if add_matches(self.prefix_matches(query), 'prefix'):
+            return results
+        if add_matches(self.substring_matches(query), 'substring'):
+            return results
+
+        # Only fall back to typo-tolerant matching when nothing contains the query
+        if len(results) > 0:
+            return results
+        add_matches(self.fuzzy_matches(query, limit=limit)[0], 'fuzzy')
+        return results
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+from embedding_store import EmbeddingStore, embedding_store_exists, get_embedding_store_prefix
+
+# Precomputed top-K neighbor tables, one per axis, stored next to the FAISS index files:
+#  neighbors_{data_file}_db_{tag}.neighbors.npy  int32 [rows, K]   FAISS ids of the K nearest cards (-1 padded)
+#  neighbors_{data_file}_db_{tag}.scores.npy     float16 [rows, K] inner-product scores
+#  neighbors_{data_file}_db_{tag}.json           K and the stamp of the index file the table was built from
+# Row r of the table belongs to FAISS id r, so serving a card is a direct array lookup.
+# The corpus only changes with a new bulk file, so the tables are rebuilt offline together with the indices.
+
+
+def get_neighbor_table_prefix(db_dir, data_file, tag):
+    # ex: ./data/neighbors_oracle-cards-20231113220154_db_dupe2
+    return f'{db_dir}/neighbors_{data_file}_db_{tag}'
+
+
+def get_index_stamp(index_file):
+    stat = os.stat(index_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def get_index_vectors(index, ids, embedding_store=None):
+    # Query vectors for the given FAISS ids. Prefer the exact vectors from the embedding store,
+    # since compressed or transformed indices only return approximate reconstructions.
+    if embedding_store is not None:
+        return embedding_store.get_many(list(ids.keys()))[0]
+    return index.reconstruct_batch(np.array(list(ids.values()), dtype=np.int64))
+
+
+def build_neighbor_table(index, ids_by_sfid, embedding_store=None, k=100, batch_size=1024, threads=None):
+    # Batched all-against-all search. FAISS spreads every batch across all cores with OpenMP.
+    if threads:
+        faiss.omp_set_num_threads(threads)
+
+    # Only keep sfids that the embedding store can answer for, so ids and vectors stay aligned
+    if embedding_store is not None:
+        ids_by_sfid = {sfid: faiss_id for sfid, faiss_id in ids_by_sfid.items() if sfid in embedding_store}
+    ids = np.array(list(ids_by_sfid.values()), dtype=np.int64)
+    vectors = get_index_vectors(index, ids_by_sfid, embedding_store)
+    num_rows = int(ids.max()) + 1 if len(ids) else 0
+
+    neighbors = np.full((num_rows, k), -1, dtype=np.int32)
+    scores = np.zeros((num_rows, k), dtype=np.float16)
+
+    for start in range(0, len(ids), batch_size):
+        stop = min(start + batch_size, len(ids))
+        dists, neighbor_ids = index.search(vectors[start:stop], k)
+        neighbors[ids[start:stop]] = neighbor_ids
+        scores[ids[start:stop]] = dists
+
+    return neighbors, scores
+
+
+def write_neighbor_table(prefix, neighbors, scores, index_file):
+    np.save(f'{prefix}.neighbors.npy', neighbors)
+    np.save(f'{prefix}.scores.npy', scores)
+    with open(f'{prefix}.json', 'w') as f:
+        json.dump({'k': neighbors.shape[1], 'index_stamp': get_index_stamp(index_file)}, f, indent=2)
+
+
+def neighbor_table_exists(prefix):
+    return all(os.path.exists(f'{prefix}{suffix}') for suffix in ['.neighbors.npy', '.scores.npy', '.json'])
+
+
+class NeighborTable:
+    def __init__(self, prefix, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        with open(f'{prefix}.json') as f:
+            self.meta = json.load(f)
+        self.k = self.meta['k']
+        self.neighbors = np.load(f'{prefix}.neighbors.npy', mmap_mode=mmap_mode)
+        self.scores = np.load(f'{prefix}.scores.npy', mmap_mode=mmap_mode)
+
+    def is_current(self, index_file):
+        # A table is only valid for the exact index file it was computed from
+        return self.meta.get('index_stamp') == get_index_stamp(index_file)
+
+    def lookup(self, faiss_id, num_results):
+        # Returns (neighbor ids, scores), or None if the table can't answer this query
+        if num_results > self.k or faiss_id < 0 or faiss_id >= len(self.neighbors):
+            return None
+        neighbor_ids = self.neighbors[faiss_id, :num_results]
+        if neighbor_ids[0] < 0:
+            return None
+        return neighbor_ids.astype(np.int64), self.scores[faiss_id, :num_results].astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the top-K neighbors of every card on every axis')
+    parser.add_argument('--data-file', default='oracle-cards-20231113220154')
+    parser.add_argument('--db-dir', default='./data')
+    parser.add_argument('--axes', default='similar,dupe2,spike,melvin,timmy', help='Comma-separated list of query tags')
+    parser.add_argument('--k', type=int, default=100, help='Number of neighbors to keep per card')
+    parser.add_argument('--batch-size', type=int, default=1024, help='Number of query vectors per FAISS search')
+    parser.add_argument('--threads', type=int, default=None, help='OpenMP threads (default: all cores)')
+    args = parser.parse_args()
+
+    for tag in args.axes.split(','):
+        index_file = f'{args.db_dir}/faiss_{args.data_file}_db_{tag}.index'
+        index = faiss.read_index(index_file)
+        with open(f'{args.db_dir}/faiss_{args.data_file}_db_{tag}.keys') as f:
+            ids_by_sfid = json.load(f)
+
+        store_prefix = get_embedding_store_prefix(args.db_dir, args.data_file, tag)
+        embedding_store = EmbeddingStore(store_prefix) if embedding_store_exists(store_prefix) else None
+
+        then = time.perf_counter()
+        neighbors, scores = build_neighbor_table(index, ids_by_sfid, embedding_store, k=args.k, batch_size=args.batch_size, threads=args.threads)
+        print(f'Computed top-{args.k} neighbors of {index.ntotal} cards for {tag} in {time.perf_counter() - then:.1f}s')
+
+        prefix = get_neighbor_table_prefix(args.db_dir, args.data_file, tag)
+        write_neighbor_table(prefix, neighbors, scores, index_file)
+        print(f' Wrote {prefix}.neighbors.npy ({(neighbors.nbytes + scores.nbytes) / 1024 / 1024:.1f} MiB)')
+
+
+if __name__ == '__main__':
+    main()
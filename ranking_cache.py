@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Cache of merged related-card rankings, and the lightweight result objects they hold.
+# Each entry is the full ranking for one card, so every page of /card/<sfid>/page/<n> is a slice of it
+# instead of a new search.
+
+
+class RelatedCard:
+    # A related card result: a reference to the shared card record plus its score and axis.
+    # Reads fall through to the card dict, so templates can use it like the card itself without copying it.
+    __slots__ = ('card', 'distance', 'axis')
+
+    def __init__(self, card, distance, axis):
+        self.card = card
+        self.distance = distance
+        self.axis = axis
+
+    def __getattr__(self, name):
+        # Only called for names that aren't slots. card itself can be unset (ex: while copy or pickle rebuild
+        # the object), and dunder lookups (ex: __setstate__) must not fall through to the card.
+        if name == 'card' or name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self.card[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        return (self.card, self.distance, self.axis)
+
+    def __setstate__(self, state):
+        self.card, self.distance, self.axis = state
+
+    def __getitem__(self, key):
+        if key == 'distance':
+            return self.distance
+        if key == 'axis':
+            return self.axis
+        return self.card[key]
+
+    def __contains__(self, key):
+        return key in ('distance', 'axis') or key in self.card
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return f'RelatedCard({self.card.get("name")!r}, {self.distance!r}, {self.axis!r})'
+
+
+def get_page(ranking, cursor=0, limit=20):
+    # Cursor pagination over a ranking: the cursor is the offset of the first result.
+    # Returns (results, next_cursor), where next_cursor is None on the last page.
+    cursor = max(0, cursor)
+    results = ranking[cursor:cursor + limit]
+    next_cursor = cursor + limit if cursor + limit < len(ranking) else None
+    return results, next_cursor
+
+
+class RankingCache:
+    # Thread-safe LRU cache with a time-to-live, and hit/miss/eviction counters
+    def __init__(self, maxsize=2048, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, value = entry
+            if self.ttl is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_compute(self, key, compute):
+        # compute() runs outside the lock, so a slow search never blocks other requests.
+        # Two requests racing for the same key may both compute it, which is harmless.
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,310 @@
+import gc
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from card_loader import load_cards
+from facets import FacetIndex, get_filter_key
+from index_loader import IndexLoader
+import metrics
+from name_index import NameIndex
+from ranking_cache import RankingCache, RelatedCard
+from search_engine import SearchEngine
+from snapshot import check_snapshot, read_manifest
+from symbols import render_card_symbols
+
+# Everything the server answers from one data snapshot (see snapshot.py), and the hot swap between snapshots.
+#  SearchContext     the cards, name index, search engine, facets and caches of one snapshot.
+#                    Requests acquire the active context once and use it throughout, so a request never mixes snapshots.
+#  ActiveContext     the context new requests get. swap() replaces it atomically; the old one is drained
+#                    (its in-flight requests finish on it) and then released.
+#  SnapshotReloader  watches a manifest file, loads a changed snapshot in the background, checks and warms it,
+#                    and swaps to it. A snapshot that fails its checks is never swapped in.
+# Every gunicorn worker reloads on its own, after the fork, so each one holds a private copy of the new snapshot
+# (N workers use N times its memory, and the old one's too until it is drained), instead of the single copy
+# shared from the preloaded master. Memory-mapped indices (MTGMATRIX_INDEX_MMAP=1) are still shared through the page cache.
+# With remote_search (a search_service.RemoteSearch), related-card rankings come from the search service shards,
+# and the local indices are only loaded if another feature (ex: decks, theoretical cards) needs them.
+
+
+class SearchContext:
+    def __init__(self, snapshot, axes, primary_axis, lazy_axes=(), mmap=False, index_compression=None,
+                 symbol_html=None, num_popular_cards=100, max_related_results=100, loader_workers=None, remote_search=None):
+        self.snapshot = snapshot
+        self.remote_search = remote_search
+        self.max_related_results = max_related_results
+        then = time.perf_counter()
+
+        # Load card data (from the preprocessed snapshot, building it from the bulk file on first run)
+        self.card_data = load_cards(snapshot['cards_file'])
+
+        # Mana costs and rules text with their symbols, rendered once here instead of in every template render
+        render_card_symbols(self.card_data, symbol_html or {})
+
+        # Create a dictionary of card data by SFID
+        self.cards_by_sfid = {card['id']: card for card in self.card_data}
+
+        # Card and face names for the sidebar search and typeahead
+        self.name_index = NameIndex(self.card_data)
+
+        # Most popular cards first, sorted once here instead of on every home page request
+        self.popular_cards = sorted(self.card_data, key=lambda x: x.get('edhrec_rank', float('inf')))[:num_popular_cards]
+
+        # Used as Last-Modified for the cached home pages
+        self.loaded_at = datetime.now(timezone.utc).replace(microsecond=0)
+        metrics.startup_seconds.set(time.perf_counter() - then, step='cards')
+
+        # Searches every axis at once and merges the results, over the card space of the loaded card data
+        then = time.perf_counter()
+        self.search_engine = SearchEngine({}, {}, {}, {}, sfids=sorted(self.cards_by_sfid.keys()), axes=axes)
+
+        # Color identity, type, mana value and legality facets over the search engine's card space
+        self.facet_index = FacetIndex(self.search_engine.sfids, self.cards_by_sfid)
+        metrics.startup_seconds.set(time.perf_counter() - then, step='search_engine')
+
+        # Full related-card rankings by sfid, served page by page.
+        # axes_generation counts the axes loaded so far, rankings computed across a change are not cached.
+        self.ranking_cache = RankingCache(maxsize=2048, ttl=3600)
+        self.axes_generation = 0
+
+        # Rendered home pages by page number, as (html, etag)
+        self.home_page_cache = {}
+
+        self.index_loader = IndexLoader(self.search_engine, None, None, axes, primary_axis=primary_axis, lazy_axes=lazy_axes,
+                                        mmap=mmap, index_compression=index_compression, max_workers=loader_workers,
+                                        on_load=self.on_axis_loaded, axis_files=snapshot['axis_files'])
+
+        # Requests in flight on this context, and whether it was swapped out
+        self.lock = threading.Lock()
+        self.active_requests = 0
+        self.retired = False
+        self.drained = threading.Event()
+
+    def on_axis_loaded(self, axis):
+        # Rankings computed before this axis was searchable are incomplete, and so are those still running
+        self.axes_generation += 1
+        self.ranking_cache.clear()
+
+    def start(self):
+        # Starts reading the indices in the background
+        self.index_loader.start()
+
+    def get_related_ranking(self, sfid, filters=None):
+        # Full merged ranking for a card, cached so that every page is a slice of the same search
+        filters = filters or {}
+        key = (sfid, get_filter_key(filters)) if filters else sfid
+        ranking = self.ranking_cache.get(key)
+        if ranking is None:
+            generation = self.axes_generation
+            with metrics.ranking_seconds.time('search'):
+                rankings, complete = self._search_many([sfid], self.max_related_results, filters)
+            ranking = rankings[0]
+            # Rankings missing a search service shard that failed or timed out, or an axis that loaded
+            # while they were computed, are served, but not cached
+            if complete and generation == self.axes_generation:
+                self.ranking_cache.put(key, ranking)
+        return ranking
+
+    def search_many(self, sfids, num_results=100, filters=None):
+        # Related cards (as RelatedCard) of many cards at once, searching every axis in one batch
+        return self._search_many(sfids, num_results, filters)[0]
+
+    def _search_many(self, sfids, num_results, filters):
+        # Returns (rankings, complete), complete is False if a search service shard failed or timed out
+        if self.remote_search is not None:
+            rankings, complete = self.remote_search.search_many(self.search_engine, sfids, num_results, filters=filters)
+        else:
+            # Search all axes together, keeping the best score (and its axis) for every card.
+            # Filters are applied inside FAISS, so a filtered ranking is just as long as an unfiltered one.
+            card_mask = self.facet_index.select(filters or {})
+            if len(sfids) == 1:
+                rankings = [self.search_engine.search(sfids[0], num_results=num_results, card_mask=card_mask)]
+            else:
+                rankings = self.search_engine.search_many(sfids, num_results=num_results, card_mask=card_mask)
+            complete = True
+        return [self.to_related_cards(results[:num_results]) for results in rankings], complete
+
+    def to_related_cards(self, results):
+        # Cards missing from the card data (ex: culled since the indices were built) are skipped
+        return [RelatedCard(self.cards_by_sfid[related_sfid], dist, axis)
+                for related_sfid, dist, axis in results if related_sfid in self.cards_by_sfid]
+
+    def check(self, dimension=None, timeout=None):
+        # Waits for the eager axes, and returns a list of problems, empty if this context can take traffic.
+        # dimension is what the query embedder produces, every axis has to match it.
+        if not self.index_loader.wait(timeout=timeout):
+            return [f'Timed out after {timeout}s loading the indices']
+        problems = [f'The {axis} axis failed to load: {error}' for axis, error in self.index_loader.errors.items()]
+        if not self.index_loader.is_ready():
+            problems.append(f'The primary axis {self.index_loader.primary_axis} is not loaded')
+        for axis in self.search_engine.axes:
+            index = self.search_engine.faiss_indices[axis]
+            if dimension is not None and index.d != dimension:
+                problems.append(f'The {axis} index has dimension {index.d}, expected {dimension}')
+            if index.ntotal != len(self.search_engine.faiss_indices_by_key[axis]):
+                problems.append(f'The {axis} index has {index.ntotal} vectors for {len(self.search_engine.faiss_indices_by_key[axis])} keys')
+        if not problems and self.popular_cards and len(self.get_related_ranking(self.popular_cards[0]['id'])) == 0:
+            problems.append(f'No related cards for {self.popular_cards[0]["name"]}')
+        return problems
+
+    def warm(self, num_cards=100):
+        # Fills the ranking cache with the most popular cards, so the first requests after a swap are cache hits
+        for card in self.popular_cards[:num_cards]:
+            self.get_related_ranking(card['id'])
+
+    def acquire(self):
+        with self.lock:
+            self.active_requests += 1
+
+    def release(self):
+        with self.lock:
+            self.active_requests -= 1
+            if self.retired and self.active_requests == 0:
+                self.drained.set()
+
+    def retire(self):
+        # No new requests will acquire this context, it is drained once the in-flight ones are released
+        with self.lock:
+            self.retired = True
+            if self.active_requests == 0:
+                self.drained.set()
+
+    def close(self):
+        # Drops the caches and the search threads. The cards and indices are freed with the last reference to the context.
+        self.ranking_cache.clear()
+        self.home_page_cache.clear()
+        self.search_engine.close()
+
+    def status(self):
+        status = dict(self.index_loader.status(), snapshot=self.snapshot['name'], snapshot_id=self.snapshot['id'],
+                      cards=len(self.card_data), loaded_at=self.loaded_at.isoformat())
+        if self.remote_search is not None:
+            status['search_shards'] = self.remote_search.status()
+        return status
+
+
+class ActiveContext:
+    def __init__(self, context):
+        self.context = context
+        self.lock = threading.Lock()
+        self.draining = []
+
+    @property
+    def current(self):
+        return self.context
+
+    def acquire(self):
+        # The active context, held until release(). Taken under the lock, so a swap can't retire it in between.
+        with self.lock:
+            context = self.context
+            context.acquire()
+        return context
+
+    def release(self, context):
+        context.release()
+
+    def swap(self, new_context, drain_timeout=60):
+        # Makes new_context the active context, and drains and releases the old one in the background
+        with self.lock:
+            old_context = self.context
+            self.context = new_context
+            old_context.retire()
+            self.draining.append(old_context)
+        threading.Thread(target=self._drain, args=(old_context, drain_timeout), name='context-drain', daemon=True).start()
+        return old_context
+
+    def _drain(self, context, timeout):
+        if not context.drained.wait(timeout):
+            print(f'{context.active_requests} requests still running on snapshot {context.snapshot["name"]} after {timeout}s, releasing it anyway')
+        context.close()
+        with self.lock:
+            self.draining.remove(context)
+        # The old snapshot's objects are freed by reference counting, even those frozen before the fork (see wsgi.py).
+        # They are not unfrozen: the next collections would walk every shared preloaded object and copy its pages.
+        gc.collect()
+        print(f'Released snapshot {context.snapshot["name"]}')
+
+    def active_requests(self):
+        with self.lock:
+            return self.context.active_requests, sum(context.active_requests for context in self.draining)
+
+
+class SnapshotReloader:
+    # make_context(snapshot) builds a SearchContext for a snapshot (without starting it)
+    def __init__(self, active_context, manifest_file, make_context, poll_interval=10, dimension=None, warm_cards=100, drain_timeout=60):
+        self.active_context = active_context
+        self.manifest_file = manifest_file
+        self.make_context = make_context
+        self.poll_interval = poll_interval
+        # Callable returning the dimension the query embedder produces, or None
+        self.dimension = dimension
+        self.warm_cards = warm_cards
+        self.drain_timeout = drain_timeout
+
+        self.lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.last_mtime = None
+        self.failed_id = None
+        self.last_error = None
+        self.swaps = 0
+
+    def start(self):
+        # Threads do not survive a fork, so every (gunicorn) worker process starts its own on first use
+        with self.lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='snapshot-reloader', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.check_now()
+            except Exception as e:
+                self.last_error = str(e)
+                print(f'Snapshot reload failed: {e}')
+
+    def check_now(self):
+        # Loads and swaps to the manifest's snapshot if it changed. Returns True if it swapped.
+        mtime = os.stat(self.manifest_file).st_mtime_ns
+        if mtime == self.last_mtime:
+            return False
+        self.last_mtime = mtime
+        snapshot = read_manifest(self.manifest_file)
+        if snapshot['id'] in (self.active_context.current.snapshot['id'], self.failed_id):
+            return False
+        return self.reload(snapshot)
+
+    def reload(self, snapshot):
+        # Loads a snapshot next to the active one, checks it, warms it and swaps to it. Returns True if it swapped.
+        then = time.perf_counter()
+        print(f'Loading snapshot {snapshot["name"]}...')
+        problems = check_snapshot(snapshot, self.active_context.current.search_engine.all_axes)
+        context = None
+        if not problems:
+            context = self.make_context(snapshot)
+            context.start()
+            problems = context.check(self.dimension() if self.dimension else None)
+        if problems:
+            self.failed_id = snapshot['id']
+            self.last_error = '; '.join(problems)
+            metrics.snapshot_swaps_total.inc(result='failed')
+            print(f'Not swapping to snapshot {snapshot["name"]}: {self.last_error}')
+            if context is not None:
+                context.close()
+            return False
+
+        context.warm(self.warm_cards)
+        old_context = self.active_context.swap(context, self.drain_timeout)
+        self.swaps += 1
+        self.last_error = None
+        metrics.snapshot_swaps_total.inc(result='swapped')
+        print(f'Swapped from snapshot {old_context.snapshot["name"]} to {snapshot["name"]} in {time.perf_counter() - then:.1f}s')
+        return True
+
+    def status(self):
+        return {'manifest': self.manifest_file, 'swaps': self.swaps, 'last_error': self.last_error}
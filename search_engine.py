@@ -0,0 +1,280 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+from index_builder import is_ivf
+from metrics import axis_search_seconds, merge_seconds
+
+# Multi-axis related-card search.
+# All axes are searched together (concurrently, FAISS releases the GIL while it searches), and the per-axis
+# results are merged with NumPy: every card keeps its best score over all axes, ties go to the earlier axis.
+# Results are expressed as positions into a shared card space (self.sfids), so no per-item dicts are needed.
+# Axes with a precomputed neighbor table (see neighbor_tables.py) are served by direct array lookup,
+# and only fall back to a live FAISS search for cards missing from the table.
+# Searches can be restricted to a boolean mask over the card space (see facets.py). The mask is turned into a
+# FAISS ID selector per axis, so only matching cards are scored and a filtered search still fills its page.
+
+
+def merge_ranked(positions, scores, axis_numbers):
+    # positions, scores and axis_numbers are flat arrays with one entry per (axis, hit).
+    # Returns the same three arrays with one entry per card (its best hit), ranked by score.
+    valid = positions >= 0
+    positions, scores, axis_numbers = positions[valid], scores[valid], axis_numbers[valid]
+
+    # Sort by score (descending), then axis order, so the first occurrence of each card is its best hit
+    order = np.lexsort((axis_numbers, -scores))
+    positions, scores, axis_numbers = positions[order], scores[order], axis_numbers[order]
+
+    _, first = np.unique(positions, return_index=True)
+    first.sort()
+    return positions[first], scores[first], axis_numbers[first]
+
+
+class SearchEngine:
+    def __init__(self, faiss_indices, faiss_indices_by_key, embedding_stores=None, neighbor_tables=None, max_workers=None, sfids=None, axes=None):
+        # sfids is the shared card space, by default every card of the given axes.
+        # axes is the configured axis order (used to break ties), when some axes are only added later with add_axis.
+        self.faiss_indices = faiss_indices
+        self.faiss_indices_by_key = faiss_indices_by_key
+        self.embedding_stores = embedding_stores if embedding_stores is not None else {}
+        self.neighbor_tables = neighbor_tables if neighbor_tables is not None else {}
+        self.all_axes = list(axes or faiss_indices.keys())
+        self.axis_numbers = {axis: number for number, axis in enumerate(self.all_axes)}
+        self.axes = []
+        self.max_workers = max_workers or max(1, len(self.all_axes))
+
+        # Optional loader of lazy axes (see index_loader.py), asked for axes that are not loaded yet
+        self.loader = None
+        self._axes_lock = threading.Lock()
+
+        # Shared card space over every axis, so hits from different axes can be merged by position
+        if sfids is None:
+            sfids = sorted(set().union(*[keys.keys() for keys in faiss_indices_by_key.values()]))
+        self.sfids = list(sfids)
+        self.positions_by_sfid = {sfid: position for position, sfid in enumerate(self.sfids)}
+
+        self.positions_by_id = {}
+        self.ids_by_position = {}
+        for axis in list(faiss_indices.keys()):
+            self.add_axis(axis, faiss_indices[axis], faiss_indices_by_key[axis], self.embedding_stores.get(axis), self.neighbor_tables.get(axis))
+
+        self._executor = None
+        self._executor_pid = None
+
+    def add_axis(self, axis, index, ids_by_sfid, embedding_store=None, neighbor_table=None):
+        # Makes an axis searchable. Safe to call while other threads are searching: everything the axis needs
+        # is in place before it is published in self.faiss_indices and self.axes.
+        with self._axes_lock:
+            if axis not in self.axis_numbers:
+                self.axis_numbers[axis] = len(self.all_axes)
+                self.all_axes.append(axis)
+
+        # A direct lookup table from FAISS id to card position (-1 for unused ids and cards outside the card space)
+        ids = np.fromiter(ids_by_sfid.values(), dtype=np.int64, count=len(ids_by_sfid))
+        positions = np.fromiter((self.positions_by_sfid.get(sfid, -1) for sfid in ids_by_sfid), dtype=np.int64, count=len(ids_by_sfid))
+        lookup = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, dtype=np.int64)
+        lookup[ids] = positions
+        self.positions_by_id[axis] = lookup
+
+        # And the reverse, from card position to FAISS id (-1 for cards missing from the axis)
+        ids_by_position = np.full(len(self.sfids), -1, dtype=np.int64)
+        used = lookup >= 0
+        ids_by_position[lookup[used]] = np.nonzero(used)[0]
+        self.ids_by_position[axis] = ids_by_position
+
+        if embedding_store is not None:
+            self.embedding_stores[axis] = embedding_store
+        if neighbor_table is not None:
+            self.neighbor_tables[axis] = neighbor_table
+        with self._axes_lock:
+            self.faiss_indices_by_key[axis] = ids_by_sfid
+            self.faiss_indices[axis] = index
+            self.axes = [configured_axis for configured_axis in self.all_axes if configured_axis in self.faiss_indices]
+
+    def get_axes(self, axes=None):
+        # The requested axes (every configured axis by default) that can be searched, loading lazy axes on first use
+        axes = axes or self.all_axes
+        if self.loader is not None and any(axis not in self.faiss_indices for axis in axes):
+            self.loader.ensure(axes)
+        return [axis for axis in axes if axis in self.faiss_indices]
+
+    def _get_executor(self):
+        # Thread pools do not survive a fork, so every (gunicorn) worker process creates its own on first use
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='search')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def close(self):
+        # Stops the search threads of this process, once nothing searches this engine any more (see search_context.py)
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+    def get_query_vector(self, axis, sfid):
+        # Returns a 1xN float32 query vector for a card on one axis, or None if the card is not on that axis
+        if sfid not in self.faiss_indices_by_key[axis]:
+            return None
+
+        vector = None
+        if axis in self.embedding_stores:
+            vector = self.embedding_stores[axis].get(sfid)
+        if vector is None:
+            vector = self.faiss_indices[axis].reconstruct(self.faiss_indices_by_key[axis][sfid])
+        return np.asarray(vector, dtype=np.float32).reshape(1, -1)
+
+    def get_query_vectors(self, axis, sfids):
+        # Returns a float32 matrix with the query vectors of many cards on one axis (all of them must be on the axis)
+        keys = self.faiss_indices_by_key[axis]
+        matrix = np.zeros((len(sfids), self.faiss_indices[axis].d), dtype=np.float32)
+        found = np.zeros(len(sfids), dtype=bool)
+        if axis in self.embedding_stores and len(sfids) > 0:
+            vectors, found = self.embedding_stores[axis].get_many(sfids)
+            matrix[found] = vectors
+        missing = np.nonzero(~found)[0]
+        if len(missing) > 0:
+            matrix[missing] = self.faiss_indices[axis].reconstruct_batch(np.array([keys[sfids[row]] for row in missing], dtype=np.int64))
+        return matrix
+
+    def ids_to_positions(self, axis, ids):
+        lookup = self.positions_by_id[axis]
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = (ids >= 0) & (ids < len(lookup))
+        return np.where(valid, lookup[np.where(valid, ids, 0)], -1)
+
+    def get_search_parameters(self, axis, card_mask):
+        # FAISS search parameters that only let through the ids of the cards in card_mask.
+        # The packed bitmap is returned too, since the selector only holds a pointer to it.
+        index = self.faiss_indices[axis]
+        ids = self.ids_by_position[axis][card_mask]
+        allowed = np.zeros(len(self.positions_by_id[axis]), dtype=bool)
+        allowed[ids[ids >= 0]] = True
+        bitmap = np.packbits(allowed, bitorder='little')
+        # The size is in bytes, ids past the end of the bitmap are rejected
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+        # IVF indices insist on their own parameter type, and would otherwise fall back to nprobe=1
+        if is_ivf(index):
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        return params, (selector, bitmap)
+
+    def search_matrix(self, axis, queries, num_results=100, card_mask=None):
+        # Returns (positions, scores) matrices with the nearest cards to every row of queries, in one FAISS search
+        with axis_search_seconds.time(axis=axis, source='faiss'):
+            if card_mask is not None:
+                params, _keep_alive = self.get_search_parameters(axis, card_mask)
+                dists, ids = self.faiss_indices[axis].search(queries, num_results, params=params)
+            else:
+                dists, ids = self.faiss_indices[axis].search(queries, num_results)
+            return self.ids_to_positions(axis, ids), dists
+
+    def search_vector(self, axis, query, num_results=100, card_mask=None):
+        # Returns (positions, scores) of the nearest cards to a 1xN query vector on one axis
+        positions, scores = self.search_matrix(axis, query, num_results, card_mask)
+        return positions[0], scores[0]
+
+    def search_axis(self, axis, sfid, num_results=100, card_mask=None):
+        # Returns (positions, scores) for a single axis.
+        # Neighbor tables are unfiltered, so filtered searches always go to FAISS.
+        if card_mask is None and axis in self.neighbor_tables and sfid in self.faiss_indices_by_key[axis]:
+            with axis_search_seconds.time(axis=axis, source='table'):
+                neighbors = self.neighbor_tables[axis].lookup(self.faiss_indices_by_key[axis][sfid], num_results)
+                if neighbors is not None:
+                    ids, scores = neighbors
+                    return self.ids_to_positions(axis, ids), scores
+
+        query = self.get_query_vector(axis, sfid)
+        if query is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return self.search_vector(axis, query, num_results, card_mask)
+
+    def search_axis_many(self, axis, sfids, num_results=100, card_mask=None):
+        # Returns (positions, scores) matrices with one row per sfid for a single axis (-1 padded for cards not on it).
+        # Rows found in the neighbor table are looked up directly, the rest go to FAISS as one batched search.
+        positions = np.full((len(sfids), num_results), -1, dtype=np.int64)
+        scores = np.zeros((len(sfids), num_results), dtype=np.float32)
+        keys = self.faiss_indices_by_key[axis]
+        rows = np.array([row for row, sfid in enumerate(sfids) if sfid in keys], dtype=np.int64)
+        ids = np.array([keys[sfids[row]] for row in rows], dtype=np.int64)
+        live = np.ones(len(rows), dtype=bool)
+
+        table = self.neighbor_tables.get(axis)
+        if table is not None and card_mask is None and num_results <= table.k and len(rows) > 0:
+            with axis_search_seconds.time(axis=axis, source='table'):
+                in_table = ids < len(table.neighbors)
+                neighbor_ids = np.full((len(rows), num_results), -1, dtype=np.int64)
+                neighbor_ids[in_table] = table.neighbors[ids[in_table], :num_results]
+                answered = neighbor_ids[:, 0] >= 0
+                positions[rows[answered]] = self.ids_to_positions(axis, neighbor_ids[answered])
+                scores[rows[answered]] = table.scores[ids[answered], :num_results]
+                live = ~answered
+
+        if live.any():
+            queries = self.get_query_vectors(axis, [sfids[row] for row in rows[live]])
+            positions[rows[live]], scores[rows[live]] = self.search_matrix(axis, queries, num_results, card_mask)
+        return positions, scores
+
+    def merge(self, axes, per_axis):
+        # Merges per-axis (positions, scores) into a ranked list of (sfid, score, axis) tuples
+        if len(per_axis) == 0:
+            return []
+        with merge_seconds.time():
+            return self._merge(axes, per_axis)
+
+    def _merge(self, axes, per_axis):
+        positions = np.concatenate([positions for positions, _ in per_axis])
+        scores = np.concatenate([scores for _, scores in per_axis])
+        axis_numbers = np.concatenate([np.full(len(positions), self.axis_numbers[axis], dtype=np.int64)
+                                       for axis, (positions, _) in zip(axes, per_axis)])
+
+        positions, scores, axis_numbers = merge_ranked(positions, scores, axis_numbers)
+
+        return [(self.sfids[position], float(score), self.all_axes[axis_number])
+                for position, score, axis_number in zip(positions.tolist(), scores.tolist(), axis_numbers.tolist())]
+
+    def search(self, sfid, num_results=100, axes=None, card_mask=None):
+        # Search every axis for one card, and return a ranked list of (sfid, score, axis) tuples.
+        # card_mask optionally restricts the results to a boolean mask over self.sfids.
+        axes = self.get_axes(axes)
+
+        # Table lookups are cheap enough that a thread pool would only add overhead
+        live_axes = [axis for axis in axes if axis not in self.neighbor_tables or card_mask is not None]
+        if len(live_axes) > 1 and self.max_workers > 1:
+            executor = self._get_executor()
+            futures = [executor.submit(self.search_axis, axis, sfid, num_results, card_mask) for axis in axes]
+            per_axis = [future.result() for future in futures]
+        else:
+            per_axis = [self.search_axis(axis, sfid, num_results, card_mask) for axis in axes]
+
+        return self.merge(axes, per_axis)
+
+    def search_many(self, sfids, num_results=100, axes=None, card_mask=None):
+        # Like search() for many cards at once, with one batched search per axis.
+        # Returns one ranked list of (sfid, score, axis) tuples per sfid.
+        axes = self.get_axes(axes)
+        live_axes = [axis for axis in axes if axis not in self.neighbor_tables or card_mask is not None]
+        if len(live_axes) > 1 and self.max_workers > 1:
+            executor = self._get_executor()
+            futures = [executor.submit(self.search_axis_many, axis, sfids, num_results, card_mask) for axis in axes]
+            per_axis = [future.result() for future in futures]
+        else:
+            per_axis = [self.search_axis_many(axis, sfids, num_results, card_mask) for axis in axes]
+
+        return [self.merge(axes, [(positions[row], scores[row]) for positions, scores in per_axis]) for row in range(len(sfids))]
+
+    def search_vectors(self, queries_by_axis, num_results=100, card_mask=None):
+        # Like search(), for 1xN query vectors instead of a card, ex: the embeddings of a theoretical card
+        axes = [axis for axis in self.get_axes() if axis in queries_by_axis]
+        if len(axes) > 1 and self.max_workers > 1:
+            executor = self._get_executor()
+            futures = [executor.submit(self.search_vector, axis, queries_by_axis[axis], num_results, card_mask) for axis in axes]
+            per_axis = [future.result() for future in futures]
+        else:
+            per_axis = [self.search_vector(axis, queries_by_axis[axis], num_results, card_mask) for axis in axes]
+
+        return self.merge(axes, per_axis)
@@ -0,0 +1,422 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import faiss
+import numpy as np
+
+from index_builder import is_ivf
+import metrics
+from search_engine import merge_ranked
+
+# Standalone search service, so the indices don't have to live in every web worker.
+# Each service process hosts a subset of the axes, or one corpus shard of them (--corpus-shard 0/2 keeps the cards
+# whose sfid hashes to shard 0 of 2 in its indices), and answers batched related-card searches as JSON over HTTP,
+# on a TCP port or a Unix socket. Web workers (app.py with MTGMATRIX_SEARCH_SHARDS) send every search to all the
+# shards at once, and merge the per-axis hits exactly like SearchEngine.search, so the rankings are the same as
+# with local indices. A shard that fails or times out is left out of the merge, and the incomplete ranking isn't cached.
+#  GET  /status  {'ready', 'axes', 'corpus_shard', 'snapshot'}
+#  POST /search  {'sfids': [...], 'num_results': 100, 'axes': [...] (optional), 'filters': {...} (optional, see facets.py)}
+#                -> {'axes': {axis: [[[sfid, score, order], ...] for every query sfid]}}
+#                   order breaks ties between the hits of several corpus shards, like a local search would
+#
+# ex: python search_service.py --axes similar,dupe2 --port 8101
+#     python search_service.py --axes spike,melvin,timmy --unix-socket /tmp/mtgmatrix-search-1.sock
+#     MTGMATRIX_SEARCH_SHARDS=http://127.0.0.1:8101,unix:/tmp/mtgmatrix-search-1.sock gunicorn -c gunicorn.conf.py wsgi:application
+
+
+def get_corpus_shard(sfid, num_shards):
+    # Stable across processes and runs, unlike hash()
+    return zlib.crc32(sfid.encode('utf-8')) % num_shards
+
+
+def has_explicit_ids(index):
+    # IDMap and IVF indices keep the ids they were given, the others number their vectors 0..ntotal-1
+    index = faiss.downcast_index(index)
+    return isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)) or is_ivf(index)
+
+
+def rebuild_shard_index(search_engine, axis, sfids):
+    # An empty clone of the axis index, with the vectors of sfids added under their ids, in id order
+    index = search_engine.faiss_indices[axis]
+    ids_by_sfid = search_engine.faiss_indices_by_key[axis]
+    sfids = sorted(sfids, key=ids_by_sfid.get)
+    vectors = search_engine.get_query_vectors(axis, sfids)
+    shard_index = faiss.clone_index(index)
+    shard_index.reset()
+    if not has_explicit_ids(shard_index):
+        shard_index = faiss.IndexIDMap2(shard_index)
+    shard_index.add_with_ids(vectors, np.array([ids_by_sfid[sfid] for sfid in sfids], dtype=np.int64))
+    return shard_index
+
+
+def slice_axis(search_engine, axis, shard, num_shards):
+    # Removes the cards of the other corpus shards from an axis index (same index type, so the same scores).
+    # Their sfids stay on the axis with ids that are no longer in the index, so they can still be queried
+    # (from the embedding store) but are never found.
+    if axis not in search_engine.embedding_stores:
+        raise ValueError(f'The {axis} axis has no embedding store, which corpus shards need for their query vectors')
+    index = search_engine.faiss_indices[axis]
+    ids_by_sfid = search_engine.faiss_indices_by_key[axis]
+    in_shard = {sfid: get_corpus_shard(sfid, num_shards) == shard for sfid in ids_by_sfid}
+    other_ids = np.array([faiss_id for sfid, faiss_id in ids_by_sfid.items() if not in_shard[sfid]], dtype=np.int64)
+    explicit_ids = has_explicit_ids(index)
+    try:
+        index.remove_ids(other_ids)
+    except RuntimeError:
+        # Graph indices (HNSW) can't remove vectors, so the shard's index is rebuilt from its cards' vectors,
+        # as an empty copy of the index (same factory and parameters). Like any HNSW build, its graph differs
+        # from the full index's, so its approximate results can differ slightly from a local search.
+        index = rebuild_shard_index(search_engine, axis, [sfid for sfid in ids_by_sfid if in_shard[sfid]])
+        explicit_ids = True
+
+    # Flat indices renumber the vectors they keep (in order), and the other cards get the ids after them
+    if not explicit_ids:
+        kept_ids = sorted(faiss_id for sfid, faiss_id in ids_by_sfid.items() if in_shard[sfid])
+        new_ids = {faiss_id: number for number, faiss_id in enumerate(kept_ids)}
+        next_id = len(kept_ids)
+        sliced_ids_by_sfid = {}
+        for sfid, faiss_id in ids_by_sfid.items():
+            if in_shard[sfid]:
+                sliced_ids_by_sfid[sfid] = new_ids[faiss_id]
+            else:
+                sliced_ids_by_sfid[sfid] = next_id
+                next_id += 1
+        ids_by_sfid = sliced_ids_by_sfid
+
+    # Neighbor tables are over the whole corpus, the search engine can no longer use them on this axis
+    search_engine.neighbor_tables.pop(axis, None)
+    search_engine.add_axis(axis, index, ids_by_sfid, search_engine.embedding_stores[axis])
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so web workers reuse their connection to every shard
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address, and per-request logs would only slow searches down
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/search':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self.send_json(200, self.server.service.search(body.get('sfids', []), int(body.get('num_results', 100)),
+                                                           body.get('axes'), body.get('filters')))
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': str(e)})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class SearchService:
+    def __init__(self, context, corpus_shard=None):
+        # context is a started SearchContext (see search_context.py) with the hosted axes.
+        # corpus_shard is (shard, num_shards) or None.
+        self.context = context
+        self.corpus_shard = corpus_shard
+        self.ready = False
+        # Corpus shards answer unfiltered searches from the whole neighbor table like a local search would,
+        # keeping the hits of their shard: {axis: (table, ids by sfid, positions by id)} from before the slicing
+        self.shard_tables = {}
+        self.shard_mask = None
+        # FAISS ids by card position from before the slicing, to order tied hits like a local search (see search())
+        self.original_ids = {}
+
+    def prepare(self):
+        # Waits for the indices, and slices them to the corpus shard
+        self.context.index_loader.wait()
+        if self.corpus_shard is not None:
+            search_engine = self.context.search_engine
+            self.shard_mask = np.array([get_corpus_shard(sfid, self.corpus_shard[1]) == self.corpus_shard[0] for sfid in search_engine.sfids], dtype=bool)
+            for axis in search_engine.axes:
+                if axis in search_engine.neighbor_tables:
+                    self.shard_tables[axis] = (search_engine.neighbor_tables[axis], search_engine.faiss_indices_by_key[axis], search_engine.positions_by_id[axis])
+                self.original_ids[axis] = search_engine.ids_by_position[axis]
+                slice_axis(search_engine, axis, *self.corpus_shard)
+        self.ready = True
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'axes': self.context.search_engine.axes if self.ready else [],
+            'corpus_shard': list(self.corpus_shard) if self.corpus_shard else None,
+            'snapshot': self.context.snapshot['name'],
+        }
+
+    def search_shard_table(self, axis, sfids, num_results):
+        # Like SearchEngine.search_axis_many, with the neighbor table rows cut down to this shard's cards.
+        # Also returns the tie-break order of every hit: its column in the table, or its FAISS id when not from the table.
+        table, ids_by_sfid, lookup = self.shard_tables[axis]
+        positions = np.full((len(sfids), num_results), -1, dtype=np.int64)
+        scores = np.zeros((len(sfids), num_results), dtype=np.float32)
+        orders = np.tile(np.arange(num_results, dtype=np.int64), (len(sfids), 1))
+        rows = np.array([row for row, sfid in enumerate(sfids) if ids_by_sfid.get(sfid, len(table.neighbors)) < len(table.neighbors)], dtype=np.int64)
+        ids = np.array([ids_by_sfid[sfids[row]] for row in rows], dtype=np.int64)
+        answered = np.zeros(len(sfids), dtype=bool)
+        if len(rows) > 0:
+            neighbor_ids = table.neighbors[ids, :num_results]
+            valid = (neighbor_ids >= 0) & (neighbor_ids < len(lookup))
+            neighbor_positions = np.where(valid, lookup[np.where(valid, neighbor_ids, 0)], -1)
+            keep = (neighbor_positions >= 0) & self.shard_mask[np.maximum(neighbor_positions, 0)]
+            positions[rows] = np.where(keep, neighbor_positions, -1)
+            scores[rows] = table.scores[ids, :num_results]
+            answered[rows] = neighbor_ids[:, 0] >= 0
+
+        # Cards missing from the table go to the sliced index
+        missing = np.nonzero(~answered)[0]
+        if len(missing) > 0:
+            positions[missing], scores[missing] = self.context.search_engine.search_axis_many(axis, [sfids[row] for row in missing], num_results)
+            orders[missing] = self.original_ids[axis][np.maximum(positions[missing], 0)]
+        return positions, scores, orders
+
+    def search(self, sfids, num_results=100, axes=None, filters=None):
+        if not self.ready:
+            raise ValueError('The search service is still loading')
+        search_engine = self.context.search_engine
+        card_mask = self.context.facet_index.select(filters or {})
+        results = {}
+        for axis in [axis for axis in (axes or search_engine.axes) if axis in search_engine.axes]:
+            if card_mask is None and axis in self.shard_tables and num_results <= self.shard_tables[axis][0].k:
+                positions, scores, orders = self.search_shard_table(axis, sfids, num_results)
+            else:
+                positions, scores = search_engine.search_axis_many(axis, sfids, num_results, card_mask)
+                # FAISS breaks ties by id, and the ids from before the slicing are comparable across corpus shards
+                if axis in self.original_ids:
+                    orders = self.original_ids[axis][np.maximum(positions, 0)]
+                else:
+                    orders = np.tile(np.arange(num_results, dtype=np.int64), (len(sfids), 1))
+            # Every hit is [sfid, score, order], the client orders tied scores from several shards by order
+            results[axis] = [[[search_engine.sfids[position], float(score), order]
+                              for position, score, order in zip(row_positions.tolist(), row_scores.tolist(), row_orders.tolist()) if position >= 0]
+                             for row_positions, row_scores, row_orders in zip(positions, scores, orders)]
+        return {'axes': results}
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class SearchShard:
+    # One search service, ex: 'http://127.0.0.1:8101' or 'unix:/tmp/mtgmatrix-search-1.sock'
+    def __init__(self, address, timeout=2.0):
+        self.address = address
+        self.timeout = timeout
+        self.axes = None
+        # One keep-alive connection per thread
+        self._connections = threading.local()
+
+    def _connect(self):
+        if self.address.startswith('unix:'):
+            return UnixHTTPConnection(self.address[len('unix:'):], self.timeout)
+        host = self.address.split('://', 1)[-1].rstrip('/')
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+    def request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            connection = getattr(self._connections, 'connection', None)
+            if connection is None or getattr(self._connections, 'pid', None) != os.getpid():
+                connection = self._connections.connection = self._connect()
+                self._connections.pid = os.getpid()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                result = json.loads(response.read())
+                if response.status != 200:
+                    raise RuntimeError(f'{self.address}{path} answered {response.status}: {result.get("error")}')
+                return result
+            except (ConnectionError, http.client.HTTPException):
+                # The service closed a kept-alive connection (ex: it restarted), reconnect once
+                connection.close()
+                self._connections.connection = None
+                if attempt == 1:
+                    raise
+            except OSError:
+                connection.close()
+                self._connections.connection = None
+                raise
+
+    def get_axes(self):
+        # The axes this shard hosts, asked once it is ready
+        if self.axes is None:
+            status = self.request('GET', '/status')
+            if status['ready']:
+                self.axes = status['axes']
+        return self.axes or []
+
+
+class RemoteSearch:
+    # Scatter-gather client of the search service shards, used by SearchContext when MTGMATRIX_SEARCH_SHARDS is set
+    def __init__(self, addresses, timeout=2.0, max_workers=None):
+        self.shards = [SearchShard(address, timeout) for address in addresses]
+        self.timeout = timeout
+        # Enough threads for every shard of several concurrent requests (ex: gthread workers)
+        self.max_workers = max_workers or 8 * max(1, len(self.shards))
+        self._executor = None
+        self._executor_pid = None
+
+    def _get_executor(self):
+        # Thread pools do not survive a fork, so every (gunicorn) worker process creates its own on first use
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='search-shard')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def _search_shard(self, shard, request):
+        with metrics.shard_search_seconds.time(shard=shard.address):
+            axes = [axis for axis in shard.get_axes() if axis in request['axes']]
+            if len(axes) == 0:
+                return {}
+            return shard.request('POST', '/search', dict(request, axes=axes))['axes']
+
+    def search_many(self, search_engine, sfids, num_results=100, axes=None, filters=None):
+        # Returns (one ranked list of (sfid, score, axis) tuples per sfid, complete), like SearchEngine.search_many.
+        # Hits are mapped into search_engine's card space, and complete is False if a shard failed or timed out.
+        axes = axes or search_engine.all_axes
+        request = {'sfids': list(sfids), 'num_results': num_results, 'axes': axes, 'filters': filters or {}}
+        futures = {self._get_executor().submit(self._search_shard, shard, request): shard for shard in self.shards}
+        done, not_done = wait(futures, timeout=self.timeout)
+
+        complete = len(not_done) == 0
+        for future in not_done:
+            metrics.shard_errors_total.inc(shard=futures[future].address)
+        # Per query row and axis, the (positions, scores, orders) arrays of every shard that answered it
+        per_row = [{} for _ in sfids]
+        answered_axes = set()
+        for future in done:
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f'Search shard {futures[future].address} failed: {e}')
+                metrics.shard_errors_total.inc(shard=futures[future].address)
+                complete = False
+                continue
+            for axis, rows in results.items():
+                answered_axes.add(axis)
+                for row, hits in enumerate(rows):
+                    positions = np.array([search_engine.positions_by_sfid.get(sfid, -1) for sfid, _, _ in hits], dtype=np.int64)
+                    scores = np.array([score for _, score, _ in hits], dtype=np.float32)
+                    orders = np.array([order for _, _, order in hits], dtype=np.int64)
+                    per_row[row].setdefault(axis, []).append((positions, scores, orders))
+        # An axis no shard answered for is missing from every ranking
+        complete = complete and answered_axes.issuperset(axes)
+
+        rankings = []
+        for hits_by_axis in per_row:
+            per_axis = []
+            for axis, hits in hits_by_axis.items():
+                positions = np.concatenate([positions for positions, _, _ in hits])
+                scores = np.concatenate([scores for _, scores, _ in hits])
+                if len(hits) > 1:
+                    # Corpus shards each return their own top num_results, keep the axis' overall top num_results,
+                    # in the order a local search of the whole axis would have found them
+                    orders = np.concatenate([orders for _, _, orders in hits])
+                    order = np.lexsort((orders, -scores))[:num_results]
+                    positions, scores = positions[order], scores[order]
+                per_axis.append((axis, positions, scores))
+            if len(per_axis) == 0:
+                rankings.append([])
+                continue
+            positions, scores, axis_numbers = merge_ranked(
+                np.concatenate([positions for _, positions, _ in per_axis]),
+                np.concatenate([scores for _, _, scores in per_axis]),
+                np.concatenate([np.full(len(positions), search_engine.axis_numbers[axis], dtype=np.int64) for axis, positions, _ in per_axis]))
+            rankings.append([(search_engine.sfids[position], float(score), search_engine.all_axes[axis_number])
+                             for position, score, axis_number in zip(positions.tolist(), scores.tolist(), axis_numbers.tolist())])
+        return rankings, complete
+
+    def status(self):
+        shards = {}
+        for shard in self.shards:
+            try:
+                shards[shard.address] = shard.request('GET', '/status')
+            except Exception as e:
+                shards[shard.address] = {'ready': False, 'error': str(e)}
+        return shards
+
+
+def main():
+    from search_context import SearchContext
+    from snapshot import get_default_snapshot, read_manifest
+
+    parser = argparse.ArgumentParser(description='Serve related-card searches over a subset of the axes')
+    parser.add_argument('--axes', required=True, help='Comma-separated axes to host, ex: similar,dupe2')
+    parser.add_argument('--data-file', default=os.environ.get('MTGMATRIX_DATA_FILE', 'oracle-cards-20231113220154'))
+    parser.add_argument('--db-dir', default=os.environ.get('MTGMATRIX_DB_DIR', './data'))
+    parser.add_argument('--snapshot', default=os.environ.get('MTGMATRIX_SNAPSHOT'), help='Snapshot manifest (see snapshot.py), instead of --data-file')
+    parser.add_argument('--corpus-shard', default=None, metavar='I/N', help='Only index the cards of corpus shard I of N, ex: 0/2')
+    parser.add_argument('--mmap', action='store_true', help='Memory-map the indices (not with --corpus-shard, which edits them)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8101)
+    parser.add_argument('--unix-socket', default=None, help='Listen on this Unix socket instead of a TCP port')
+    args = parser.parse_args()
+
+    axes = args.axes.split(',')
+    corpus_shard = tuple(int(part) for part in args.corpus_shard.split('/')) if args.corpus_shard else None
+    if corpus_shard is not None and args.mmap:
+        parser.error('--corpus-shard removes vectors from the indices, which memory-mapped indices do not allow')
+
+    then = time.perf_counter()
+    snapshot = read_manifest(args.snapshot) if args.snapshot else get_default_snapshot(args.db_dir, args.data_file, axes)
+    context = SearchContext(snapshot, axes, axes[0], mmap=args.mmap)
+    context.start()
+    service = SearchService(context, corpus_shard)
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, SearchRequestHandler)
+        address = f'unix:{args.unix_socket}'
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), SearchRequestHandler)
+        address = f'http://{args.host}:{args.port}'
+    server.service = service
+
+    # Answers /status (not ready) while the indices load
+    threading.Thread(target=server.serve_forever, name='search-service', daemon=True).start()
+    service.prepare()
+    print(f'Serving {", ".join(context.search_engine.axes)}{f" (corpus shard {args.corpus_shard})" if corpus_shard else ""} '
+          f'of {snapshot["name"]} on {address}, ready in {time.perf_counter() - then:.1f}s')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+from embedding_store import embedding_store_exists
+from index_loader import get_axis_files
+from neighbor_tables import neighbor_table_exists
+
+# Versioned data snapshots. A manifest names every file one version of the data is served from, so moving to a
+# new Scryfall dump means building its files and writing a new manifest, instead of editing data_file in the code.
+# The server watches the manifest (MTGMATRIX_SNAPSHOT) and hot swaps to a new snapshot when it changes (see search_context.py).
+#  {
+#    "version": 1, "name": "oracle-cards-20231113220154", "created_at": "2023-11-14T10:00:00+00:00",
+#    "cards": "oracle-cards-20231113220154.json",
+#    "axes": {"similar": {"index": "faiss_..._db_similar.index", "keys": "faiss_..._db_similar.keys",
+#                         "embeddings": "embeddings_..._db_similar", "neighbors": "neighbors_..._db_similar"}, ...}
+#  }
+# Paths are relative to the directory of the manifest. embeddings and neighbors are prefixes, and optional (null).
+#
+# ex: python snapshot.py --data-file oracle-cards-20240101100000 --output ./data/current.json
+
+MANIFEST_VERSION = 1
+
+
+def make_manifest(db_dir, data_file, axes):
+    # A manifest for the files of data_file in db_dir, with paths relative to db_dir
+    manifest_axes = {}
+    for axis in axes:
+        files = get_axis_files(db_dir, data_file, axis)
+        manifest_axes[axis] = {
+            'index': os.path.basename(files['index']),
+            'keys': os.path.basename(files['keys']),
+            'embeddings': os.path.basename(files['embeddings']) if embedding_store_exists(files['embeddings']) else None,
+            'neighbors': os.path.basename(files['neighbors']) if neighbor_table_exists(files['neighbors']) else None,
+        }
+    return {
+        'version': MANIFEST_VERSION,
+        'name': data_file,
+        'created_at': datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+        'cards': f'{data_file}.json',
+        'axes': manifest_axes,
+    }
+
+
+def resolve_manifest(manifest, base_dir, manifest_id=None):
+    # The snapshot the server loads: {'id', 'name', 'cards_file', 'axis_files': {axis: files}} with full paths
+    def resolve(path):
+        return None if path is None else os.path.join(base_dir, path)
+
+    return {
+        'id': manifest_id or manifest['name'],
+        'name': manifest['name'],
+        'cards_file': resolve(manifest['cards']),
+        'axis_files': {axis: {kind: resolve(path) for kind, path in files.items()} for axis, files in manifest['axes'].items()},
+    }
+
+
+def read_manifest(filename):
+    # Returns the resolved snapshot of a manifest file. Its id changes whenever the manifest does.
+    with open(filename, 'rb') as f:
+        content = f.read()
+    manifest = json.loads(content)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'Unsupported snapshot manifest version {manifest.get("version")} in {filename}')
+    return resolve_manifest(manifest, os.path.dirname(os.path.abspath(filename)), f'{manifest["name"]}@{hashlib.sha1(content).hexdigest()[:12]}')
+
+
+def get_default_snapshot(db_dir, data_file, axes):
+    # The snapshot of the default file names, for servers started without a manifest
+    return resolve_manifest(make_manifest(db_dir, data_file, axes), db_dir)
+
+
+def write_manifest(manifest, filename):
+    # Write to a temporary file first, so a watching server never reads a half-written manifest
+    tmp_file = f'{filename}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, filename)
+
+
+def check_snapshot(snapshot, axes=None):
+    # Returns a list of problems (missing files), empty if every required file is there
+    problems = []
+    if not os.path.exists(snapshot['cards_file']):
+        problems.append(f'Missing card file {snapshot["cards_file"]}')
+    for axis in axes or snapshot['axis_files'].keys():
+        files = snapshot['axis_files'].get(axis)
+        if files is None:
+            problems.append(f'No files for the {axis} axis')
+            continue
+        for kind in ('index', 'keys'):
+            if not os.path.exists(files[kind]):
+                problems.append(f'Missing {kind} file for {axis}: {files[kind]}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a snapshot manifest for the files of one data file')
+    parser.add_argument('--data-file', required=True, help='ex: oracle-cards-20231113220154')
+    parser.add_argument('--db-dir', default='./data')
+    parser.add_argument('--axes', default='similar,dupe2,spike,melvin,timmy', help='Comma-separated axes')
+    parser.add_argument('--output', default=None, help='Manifest file to write (default: {db-dir}/current.json)')
+    args = parser.parse_args()
+
+    manifest = make_manifest(args.db_dir, args.data_file, args.axes.split(','))
+    problems = check_snapshot(resolve_manifest(manifest, args.db_dir))
+    if problems:
+        raise SystemExit('Not writing the manifest:\n ' + '\n '.join(problems))
+
+    output = args.output or os.path.join(args.db_dir, 'current.json')
+    if os.path.dirname(os.path.abspath(output)) != os.path.abspath(args.db_dir):
+        raise SystemExit(f'The manifest has to be written to {args.db_dir}, its paths are relative to it')
+    write_manifest(manifest, output)
+    print(f'Wrote snapshot {manifest["name"]} with {len(manifest["axes"])} axes to {output}')
+
+
+if __name__ == '__main__':
+    main()
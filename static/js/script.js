@@ -22,4 +22,40 @@ document.addEventListener('DOMContentLoaded', (event) => {
     else {
         searchMenu.style.width = '0';
     }
-});
\ No newline at end of file
+});
+// Typeahead for the search box: ask the server for name completions as the user types
+document.addEventListener('DOMContentLoaded', (event) => {
+    var searchName = document.getElementById("searchName");
+    var typeaheadResults = document.getElementById("typeaheadResults");
+    if (!searchName || !typeaheadResults) {
+        return;
+    }
+
+    var latestQuery = '';
+    searchName.addEventListener('input', () => {
+        var query = searchName.value.trim();
+        latestQuery = query;
+        if (query.length === 0) {
+            typeaheadResults.innerHTML = '';
+            return;
+        }
+
+        fetch('/api/typeahead?q=' + encodeURIComponent(query))
+            .then((response) => response.json())
+            .then((data) => {
+                // Ignore responses that arrive after the user kept typing
+                if (data.query !== latestQuery) {
+                    return;
+                }
+                typeaheadResults.innerHTML = '';
+                data.results.forEach((result) => {
+                    var item = document.createElement('li');
+                    var link = document.createElement('a');
+                    link.href = '/card/' + result.id;
+                    link.textContent = result.name;
+                    item.appendChild(link);
+                    typeaheadResults.appendChild(item);
+                });
+            });
+    });
+});
@@ -0,0 +1,55 @@
+import html
+import json
+import os
+import re
+
+from markupsafe import Markup
+
+# Mana symbol rendering. Scryfall writes symbols in braces, ex: "{2}{R}" or "{T}: Add {G}."
+# render_card_symbols() turns the mana cost and rules text of every card into HTML once, when the card data is
+# loaded, so templates only insert card.mana_cost_html / card.oracle_text_html instead of substituting on every render.
+# The symbol images come from download_static_resources.py. Without them the text is only escaped.
+
+# One pass over the text finds every symbol and line break
+symbol_pattern = re.compile(r'\{[^{}\s]+\}|\n')
+
+# Card fields rendered to <field>_html, and how the faces of multi-faced cards are joined when the card has no top-level value
+rendered_fields = {'mana_cost': ' // ', 'oracle_text': '\n//\n'}
+
+
+def load_symbol_html(symbols_file, symbols_url):
+    # Returns {symbol: <img> tag}, ex: {'{W}': '<img class="mana-symbol" src="/static/symbols/W.svg" alt="{W}">'}
+    if not os.path.exists(symbols_file):
+        return {}
+    with open(symbols_file) as f:
+        symbol_files = json.load(f)
+    return {symbol: f'<img class="mana-symbol" src="{symbols_url}/{html.escape(filename)}" alt="{html.escape(symbol)}" title="{html.escape(symbol)}">'
+            for symbol, filename in symbol_files.items()}
+
+
+def render_symbols(text, symbol_html):
+    # Escaped text with the known symbols replaced by their images, and line breaks by <br>
+    if not text:
+        return Markup('')
+
+    def replace(match):
+        token = match.group(0)
+        if token == '\n':
+            return '<br>'
+        return symbol_html.get(token, token)
+
+    return Markup(symbol_pattern.sub(replace, html.escape(text, quote=False)))
+
+
+def get_card_field(card, field):
+    if field in card:
+        return card[field]
+    faces = [face[field] for face in card.get('card_faces', []) if face.get(field)]
+    return rendered_fields[field].join(faces) if faces else None
+
+
+def render_card_symbols(card_data, symbol_html):
+    # Adds mana_cost_html and oracle_text_html to every card
+    for card in card_data:
+        for field in rendered_fields:
+            card[f'{field}_html'] = render_symbols(get_card_field(card, field), symbol_html)
@@ -40,7 +40,7 @@ similar_cards = [
         # Counter spell unless opponent does X
         ['Mana Leak', 'Miscalculation', 'Daze', 'Spell Stutter', 'Spell Pierce', 'Force Spike', 'Mystic Confluence'],
         # Hard counters
-        ['Counterspell', 'Mana Drain', 'Force of Will', 'Force of Negation', 'Pact of Negation', 'Cryptic Command', ]
+        ['Counterspell', 'Mana Drain', 'Force of Will', 'Force of Negation', 'Pact of Negation', 'Cryptic Command', ],
         # Free counterspells
         ['Force of Will', 'Force of Negation', 'Misdirection', 'Foil', 'Snapback', 'Disrupting Shoal', 'Thwart', 'Commandeer', 'Out of Bounds',],
         # Counter with an additional cost
@@ -0,0 +1,40 @@
+# Shared fixtures: the app served from a small synthetic corpus (see benchmarks/bench_app.py),
+# so the tests need no data files, network or embedding model.
+
+import os
+import sys
+
+import pytest
+
+repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, 'benchmarks'))
+
+num_cards = 500
+dimension = 32
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    from bench_app import generate_corpus
+
+    db_dir = str(tmp_path_factory.mktemp('db'))
+    data_file = f'synthetic-cards-{num_cards}-{dimension}'
+    generate_corpus(db_dir, data_file, num_cards, dimension, 'Flat', None, False)
+
+    os.environ['MTGMATRIX_DATA_FILE'] = data_file
+    os.environ['MTGMATRIX_DB_DIR'] = db_dir
+    os.environ['MTGMATRIX_QUERY_EMBEDDER'] = 'stub'
+    import app
+    app.contexts.current.index_loader.wait()
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def sfid(app_module):
+    return app_module.contexts.current.search_engine.sfids[0]
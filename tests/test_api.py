@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+
+@pytest.mark.parametrize('limit, expected', [('0', 1), ('-5', 1), ('3', 3), ('500', 50), ('abc', 10)])
+def test_typeahead_limit_is_clamped(client, limit, expected):
+    response = client.get('/api/typeahead', query_string={'q': 'Synthetic', 'limit': limit})
+    assert response.status_code == 200
+    assert len(response.get_json()['results']) == expected
+
+
+invalid_filters = [{'identity': 5}, {'identity': 'X'}, {'format': 1}, {'type': 3}, {'cmc_min': [1]}, {'cmc_min': 'nan'}]
+
+
+@pytest.mark.parametrize('filters', invalid_filters)
+def test_related_rejects_invalid_filters(client, sfid, filters):
+    response = client.get(f'/api/v1/related/{sfid}', json=filters)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('filters', invalid_filters)
+def test_related_bulk_rejects_invalid_filters(client, sfid, filters):
+    response = client.post('/api/v1/related', json={'sfids': [sfid], **filters})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('filters', invalid_filters)
+def test_query_rejects_invalid_filters(client, filters):
+    response = client.post('/api/query', json={'oracle_text': 'Draw a card.', **filters})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_related_filters(client, sfid):
+    response = client.post('/api/v1/related', json={'sfids': [sfid], 'identity': 'R', 'type': ['creature'], 'cmc_max': 3,
+                                                    'fields': ['color_identity', 'type_line', 'cmc']})
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == 1
+    results = json.loads(lines[0])['results']
+    assert results
+    for result in results:
+        assert set(result['color_identity']) <= {'R'}
+        assert 'Creature' in result['type_line']
+        assert result['cmc'] <= 3
+
+
+@pytest.mark.parametrize('body', [{'decklist': 5}, {'decklist': ['1 Sol Ring']}, {'cards': [1, 2]}, {'cards': {'name': 'Sol Ring'}}])
+def test_deck_rejects_invalid_body(client, body):
+    response = client.post('/api/v1/deck', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_deck(client, app_module):
+    cards = app_module.contexts.current.search_engine.sfids[:10]
+    response = client.post('/api/v1/deck', json={'decklist': '1 Synthetic Card 0\n1 Not A Card', 'cards': cards, 'limit': 5})
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['unresolved'] == ['Not A Card']
+    assert len(result['results']) == 5
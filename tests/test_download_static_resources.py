@@ -0,0 +1,43 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from download_static_resources import download_symbols
+
+
+class SymbologyHandler(BaseHTTPRequestHandler):
+    # A stand-in for Scryfall, where R.svg is missing
+    def do_GET(self):
+        base_url = f'http://127.0.0.1:{self.server.server_port}'
+        if self.path == '/symbology':
+            body = json.dumps({'data': [{'symbol': '{W}', 'svg_uri': f'{base_url}/W.svg'},
+                                        {'symbol': '{R}', 'svg_uri': f'{base_url}/R.svg'}]}).encode()
+        elif self.path == '/W.svg':
+            body = b'<svg></svg>'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def symbology_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SymbologyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/symbology'
+    server.shutdown()
+
+
+def test_download_symbols_leaves_out_failed_files(tmp_path, symbology_url):
+    counts = download_symbols(symbology_url, str(tmp_path), retries=0)
+    assert counts['downloaded'] == 1 and counts['failed'] == 1
+    assert (tmp_path / 'symbols' / 'W.svg').exists()
+    assert json.loads((tmp_path / 'symbols.json').read_text()) == {'{W}': 'W.svg'}
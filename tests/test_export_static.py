@@ -0,0 +1,17 @@
+import os
+
+import export_static
+
+
+def test_export_skips_unchanged_cards_without_searching(app_module, tmp_path, monkeypatch):
+    counts = export_static.export_site(str(tmp_path), workers=1, limit=5, use_brotli=False)
+    assert counts['exported'] == 5
+    sfid = app_module.contexts.current.search_engine.sfids[0]
+    assert os.path.exists(tmp_path / 'card' / sfid / 'index.html')
+
+    def fetch_related_ranking(sfid, filters=None):
+        raise AssertionError(f'searched for the related cards of unchanged card {sfid}')
+
+    monkeypatch.setattr(app_module, 'fetch_related_ranking', fetch_related_ranking)
+    counts = export_static.export_site(str(tmp_path), workers=1, limit=5, use_brotli=False)
+    assert counts == {'exported': 0, 'skipped': 5, 'removed': 0}
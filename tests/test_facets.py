@@ -0,0 +1,21 @@
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from facets import parse_facet_filters
+
+
+def test_parse_facet_filters():
+    args = MultiDict([('identity', 'rg'), ('type', 'legendary creature'), ('type', 'elf'), ('cmc_max', '3'), ('format', 'Commander')])
+    assert parse_facet_filters(args) == {'identity': 'RG', 'identity_mode': 'within', 'type': ['legendary', 'creature', 'elf'],
+                                         'cmc_max': 3.0, 'format': 'commander'}
+    assert parse_facet_filters({'type': ['instant'], 'cmc_min': 2}) == {'type': ['instant'], 'cmc_min': 2.0}
+
+
+@pytest.mark.parametrize('args', [
+    {'identity': 5}, {'identity': 'R', 'identity_mode': 1}, {'identity': 'R', 'identity_mode': 'some'},
+    {'format': 1}, {'type': 3}, {'type': ['creature', 3]}, {'cmc_min': [1]}, {'cmc_min': True},
+    {'cmc_min': 'two'}, {'cmc_min': 'nan'}, {'cmc_max': 'inf'}, {'cmc_max': float('-inf')},
+])
+def test_parse_facet_filters_rejects_invalid_values(args):
+    with pytest.raises(ValueError):
+        parse_facet_filters(args)